@@ -1,7 +1,12 @@
-import requests, re, json, sys, os, datetime, logging
+import re, json, sys, os, datetime, logging, hashlib, threading, time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from keycloak import KeycloakOpenID
 from config import VERSION1, INPUT_JSON_FILE_NAME
+from setting import IBUS_GZIP_PARAMETERS, IBUS_REQUEST_TIMEOUT, IBUS_TRANSFER_CHUNK_SIZE, IBUS_TRANSFER_WORKERS, KEYCLOAK_REQUEST_TIMEOUT, KEYCLOAK_TOKEN_KEY_PREFIX, KEYCLOAK_TOKEN_SHARED, LIVE_LOG_ASYNC, LOG_FILE_BUFFER_SIZE, LOG_FILE_FLUSH_INTERVAL, LOG_MIN_LEVEL, LOG_RATE_WINDOW, TASKS
+from live_log import shipper as liveLogShipper
+from http_session import MultipartFileBody, get_session
+from artifact_cache import fetch_artifact, store_artifact
 
 class IBusPlatformInterface:
     
@@ -12,6 +17,19 @@ class IBusPlatformInterface:
     iBusEdge = False
     logFileName = 'digimop_execution.log'
     logFileHandle = None
+    logFileFlushedAt = 0
+    # Keycloak tokens of all the instances of the process, by server, realm,
+    # client and user. A token is used until keycloakTokenMargin seconds
+    # before it expires, then renewed with its refresh token. The renewal is
+    # done outside the lock by one thread per key, keycloakTokenRenewals has
+    # the event the other threads wait on
+    keycloakTokenCache = {}
+    keycloakTokenRenewals = {}
+    keycloakTokenLock = threading.Lock()
+    keycloakTokenMargin = 30
+    # messages below the minimum level, LOG_MIN_LEVEL or "log-level" of the
+    # input json, are dropped before they are formatted
+    logLevels = {"DEBUG": 10, "INFO": 20, "WARN": 30, "ERROR": 40}
     
     def __init__(self, version, debugMsgReq, digimopInputParameterJson):
         self.version = version
@@ -21,12 +39,20 @@ class IBusPlatformInterface:
             self.digimopInputParameterJson = digimopInputParameterJson
         self.__readInputParametersFromJsonObj(self.digimopInputParameterJson)
         self.debugMsgReq = debugMsgReq
+        # "debug-logs": false in the input json turns DEBUG off, ex: production runs
+        if 'debug-logs' in self.digimopInputParameterJson:
+            self.debugMsgReq = str(self.digimopInputParameterJson['debug-logs']).lower() in ('true', '1', 'yes')
+        minLevel = str(self.digimopInputParameterJson.get('log-level', LOG_MIN_LEVEL)).upper()
+        self.minLogLevel = self.logLevels.get(minLevel, self.logLevels[LOG_MIN_LEVEL])
+        # {(file, line): sampling and rate limit state} of the log calls
+        self.logCallSites = {}
         self.logFileName = 'id_'+str(self.workflowHistoryId)+'_'+self.logFileName
         
     def __reInitializeLog(self):
+        # opened once, then again after uploadLogFile closed and removed the file
         print ("Execution happening for History Id : "+ str(self.workflowHistoryId))
-        if not os.path.exists(self.logFileName) or self.logFileHandle == None:
-            self.logFileHandle = open(self.logFileName,"a+")
+        self.logFileHandle = open(self.logFileName, "a", buffering=LOG_FILE_BUFFER_SIZE)
+        self.logFileFlushedAt = time.time()
             
     def uploadOutputJsonFile(self):
         if self.version == VERSION1:
@@ -41,6 +67,31 @@ class IBusPlatformInterface:
         if self.version == VERSION1:
             return self.__uploadOutputParameterFileV1(parameter, completeFilePath)
 
+    def getInputParameterFiles(self, parameterFiles):
+        # {parameter: filename} downloaded concurrently, returns the first parameter which failed, None if all were downloaded
+        if self.version == VERSION1:
+            return self.__transferConcurrently(self.__getInputParameterFileV1, parameterFiles)
+        
+    def uploadOutputParameterFiles(self, parameterFiles):
+        # {parameter: completeFilePath} uploaded concurrently, returns the first parameter which failed, None if all were uploaded
+        if self.version == VERSION1:
+            return self.__transferConcurrently(self.__uploadOutputParameterFileV1, parameterFiles)
+        
+    def __transferConcurrently(self, transfer, parameterFiles):
+        # when one transfer fails the ones not started yet are cancelled, returns once the running ones have finished, no file is written after it returns
+        executor = ThreadPoolExecutor(max_workers=max(min(len(parameterFiles), IBUS_TRANSFER_WORKERS), 1), thread_name_prefix='ibus_transfer')
+        futures = {}
+        try:
+            futures = {executor.submit(transfer, parameter, filename): parameter for parameter, filename in parameterFiles.items()}
+            for future in as_completed(futures):
+                if not future.result():
+                    return futures[future]
+            return None
+        finally:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+
     def uploadLogFile(self):
         if self.version == VERSION1:
             return self.__uploadLogFileV1()
@@ -79,14 +130,93 @@ class IBusPlatformInterface:
         self.workflowManagerServiceUrl = digimopInputParameterJson['workflow-manager-service-base-url']
         
     def __getKeycloakToken(self):
+        cacheKey = "|".join([self.keycloakServiceUrl, self.keycloakRealm, self.keycloakClient, self.keycloakClientUser])
+        with IBusPlatformInterface.keycloakTokenLock:
+            token = self.keycloakTokenCache.get(cacheKey)
+            if self.__isTokenValid(token, "expires_at"):
+                return token["access_token"]
+            renewal = self.keycloakTokenRenewals.get(cacheKey)
+            if renewal is None:
+                renewal = threading.Event()
+                IBusPlatformInterface.keycloakTokenRenewals[cacheKey] = renewal
+                renewing = True
+            else:
+                renewing = False
+        if not renewing:
+            # another thread is renewing it, the token is used until it
+            # really expires, then the renewal is waited for
+            if not (token and token["expires_at"] > time.time()):
+                renewal.wait(KEYCLOAK_REQUEST_TIMEOUT)
+                token = self.keycloakTokenCache.get(cacheKey) or token
+            if not token:
+                raise Exception("KEYCLOAK : No token after waiting for its renewal")
+            return token["access_token"]
+        try:
+            sharedToken = self.__readSharedKeycloakToken(cacheKey)
+            if self.__isTokenValid(sharedToken, "expires_at"):
+                token = sharedToken
+            else:
+                token = self.__requestKeycloakToken(token or sharedToken)
+                self.__writeSharedKeycloakToken(cacheKey, token)
+            with IBusPlatformInterface.keycloakTokenLock:
+                IBusPlatformInterface.keycloakTokenCache[cacheKey] = token
+        finally:
+            with IBusPlatformInterface.keycloakTokenLock:
+                IBusPlatformInterface.keycloakTokenRenewals.pop(cacheKey, None)
+            renewal.set()
+        return token["access_token"]
+
+    def __isTokenValid(self, token, expiresAtKey):
+        return bool(token) and token[expiresAtKey] > time.time() + self.keycloakTokenMargin
+
+    def __requestKeycloakToken(self, expiredToken):
 #         print("KEYCLOAK : Url={} user={}, password={}, ClientID={}, Realm={}, Client Secret={}".format(self.keycloakServiceUrl, self.keycloakClientUser, self.keycloakClientPassword, self.keycloakClient, self.keycloakRealm, self.keycloakCltSecret))
         keycloak_openid = KeycloakOpenID(server_url=self.keycloakServiceUrl,
                                              client_id=self.keycloakClient,
                                              realm_name=self.keycloakRealm,
                                              client_secret_key=self.keycloakCltSecret)
+        keycloak_openid.connection.timeout = KEYCLOAK_REQUEST_TIMEOUT
+        if self.__isTokenValid(expiredToken, "refresh_expires_at"):
+            try:
+                return self.__toCachedToken(keycloak_openid.refresh_token(expiredToken["refresh_token"]))
+            except Exception as e:
+                print("KEYCLOAK : Error in refreshing token, requesting a new one: " + str(e))
         keycloakToken = keycloak_openid.token(username=self.keycloakClientUser,
                                           password=self.keycloakClientPassword)
-        return keycloakToken["access_token"]
+        return self.__toCachedToken(keycloakToken)
+
+    def __toCachedToken(self, keycloakToken):
+        now = time.time()
+        refreshToken = keycloakToken.get("refresh_token")
+        return {"access_token": keycloakToken["access_token"],
+                "expires_at": now + keycloakToken.get("expires_in", 0),
+                "refresh_token": refreshToken,
+                "refresh_expires_at": now + keycloakToken.get("refresh_expires_in", 0) if refreshToken else 0}
+
+    def __getSharedKeycloakTokenKey(self, cacheKey):
+        return KEYCLOAK_TOKEN_KEY_PREFIX + hashlib.sha1(cacheKey.encode('utf-8')).hexdigest()
+
+    def __readSharedKeycloakToken(self, cacheKey):
+        # tokens of the other gunicorn workers, with KEYCLOAK_TOKEN_SHARED
+        if not KEYCLOAK_TOKEN_SHARED:
+            return None
+        try:
+            token = TASKS.get(self.__getSharedKeycloakTokenKey(cacheKey))
+            return json.loads(token) if token else None
+        except Exception as e:
+            print("KEYCLOAK : Error in reading shared token: " + str(e))
+            return None
+
+    def __writeSharedKeycloakToken(self, cacheKey, token):
+        if not KEYCLOAK_TOKEN_SHARED:
+            return
+        ttl = int(max(token["expires_at"], token["refresh_expires_at"]) - time.time())
+        if ttl <= 0:
+            return
+        try:
+            TASKS.set(self.__getSharedKeycloakTokenKey(cacheKey), json.dumps(token), ex=ttl)
+        except Exception as e:
+            print("KEYCLOAK : Error in writing shared token: " + str(e))
     
     def __uploadLiveLogV1(self, level, message):
         if not self.iBusEdge:
@@ -96,8 +226,11 @@ class IBusPlatformInterface:
                 today = datetime.datetime.now()
                 currentTimestamp = today.strftime("%Y-%m-%dT%H:%M:%S%ZZ")
                 liveLogJson = {"workflowInstanceId" : self.workflowInstanceId, "digimopOperationId" : self.digimopOperationId, "timestamp" : str(currentTimestamp), "severity" : str(level), "message" : str(message)}
+                if LIVE_LOG_ASYNC:
+                    # sent by the background thread, see live_log.py
+                    return liveLogShipper.put(liveLogUploadUrl, self.__getKeycloakToken, liveLogJson)
                 postReqHeaders = {"authorization": "Bearer " + self.__getKeycloakToken(), "content-type": "application/json"}
-                response = requests.post(url=liveLogUploadUrl, data=json.dumps(liveLogJson), headers=postReqHeaders)
+                response = get_session().post(url=liveLogUploadUrl, data=json.dumps(liveLogJson), headers=postReqHeaders, timeout=IBUS_REQUEST_TIMEOUT)
                 print("UPLOAD_LIVE_LOG : Status Code ={}".format(response.status_code))
                 if response.status_code == 200:
                     return True
@@ -111,16 +244,18 @@ class IBusPlatformInterface:
     def __uploadLogFileV1(self):
         logFileUploadUrl = (self.workflowManagerServiceUrl + '/api/workflow-manager/v1/digimop/operation/{}/workflow/instance/{}/file/{}/workflowInstanceHistoryId/{}'.format(self.digimopOperationId, self.workflowInstanceId, 'log', self.workflowHistoryId))
         try:
+            if not self.iBusEdge and LIVE_LOG_ASYNC:
+                liveLogShipper.flush()
             if not self.logFileHandle == None:
                 self.logFileHandle.close();
+                self.logFileHandle = None
             file_with_path = os.path.realpath(self.logFileName)
             print ("file  exist "+ file_with_path + " " + str(os.path.exists(file_with_path)))
-            postReqFiles = {'file': open(file_with_path, 'rb')}
-            if self.iBusEdge:
-                response = requests.post(logFileUploadUrl, files=postReqFiles)
-            else:
-                postReqHeaders = {"authorization": "Bearer " + self.__getKeycloakToken()}
-                response = requests.post(logFileUploadUrl, headers=postReqHeaders, files=postReqFiles)
+            with MultipartFileBody('file', file_with_path) as postReqBody:
+                postReqHeaders = postReqBody.get_headers()
+                if not self.iBusEdge:
+                    postReqHeaders["authorization"] = "Bearer " + self.__getKeycloakToken()
+                response = get_session().post(logFileUploadUrl, headers=postReqHeaders, data=postReqBody, timeout=IBUS_REQUEST_TIMEOUT)
             print("UPLOAD_LOG_FILE : status_code ={}".format(response.status_code))
             if os.path.exists(file_with_path):
                 os.remove(file_with_path)
@@ -142,7 +277,7 @@ class IBusPlatformInterface:
                 postReqHeaders = {"content-type": "application/json"}
             else:
                 postReqHeaders = {"authorization": "Bearer " + self.__getKeycloakToken(), "content-type": "application/json"}
-            response = requests.post(url=outputJsonFileUploadUrl, data=json.dumps(self.outputModelJson), headers=postReqHeaders)
+            response = get_session().post(url=outputJsonFileUploadUrl, data=json.dumps(self.outputModelJson), headers=postReqHeaders, timeout=IBUS_REQUEST_TIMEOUT)
             print("UPLOAD_OUTPUT_JSON_FILE : status_code ={}".format(response.status_code))
             if response.status_code == 200:
                 return True
@@ -157,23 +292,27 @@ class IBusPlatformInterface:
     def __getInputParameterFileV1(self, parameter, filename=None):
         inputFileDownloadUrl = (self.workflowManagerServiceUrl + '/api/workflow-manager/v1/digimop/operation/{}/workflow/instance/{}/file/{}/parameter/'.format(self.digimopOperationId, self.workflowInstanceId, 'input'))
         try:
-            url = inputFileDownloadUrl + parameter
-            if self.iBusEdge:
-                response = requests.get(url)
-            else:
-                getReqHeaders = {"authorization": "Bearer " + self.__getKeycloakToken()}
-                response = requests.get(url, headers=getReqHeaders)
-                
-            print("GET_INPUT_PARAMETER_FILE : status_code ={}".format(response.status_code))
-            if response.status_code == 200:
-                if not filename and "Content-Disposition" in response.headers.keys():
-                    filename = re.findall("filename=(.+)", response.headers["Content-Disposition"])[0]
-                with open(filename, 'wb') as file:
-                    file.write(response.content)
+            # parameter files uploaded by a previous stage on this host
+            if fetch_artifact(self.workflowInstanceId, parameter, filename):
+                print("GET_INPUT_PARAMETER_FILE : {} read from the local artifact cache".format(parameter))
                 return True
-            else:
-                print('GET_INPUT_PARAMETER_FILE : response text = ' + response.text)
-                return False
+            url = inputFileDownloadUrl + parameter
+            # gzip, deflate is accepted by default, iter_content decompresses
+            getReqHeaders = {}
+            if not self.iBusEdge:
+                getReqHeaders["authorization"] = "Bearer " + self.__getKeycloakToken()
+            with get_session().get(url, headers=getReqHeaders, stream=True, timeout=IBUS_REQUEST_TIMEOUT) as response:
+                print("GET_INPUT_PARAMETER_FILE : status_code ={}".format(response.status_code))
+                if response.status_code == 200:
+                    if not filename and "Content-Disposition" in response.headers.keys():
+                        filename = re.findall("filename=(.+)", response.headers["Content-Disposition"])[0]
+                    with open(filename, 'wb') as file:
+                        for chunk in response.iter_content(chunk_size=IBUS_TRANSFER_CHUNK_SIZE):
+                            file.write(chunk)
+                    return True
+                else:
+                    print('GET_INPUT_PARAMETER_FILE : response text = ' + response.text)
+                    return False
         except Exception as e:
             print("GET_INPUT_PARAMETER_FILE : Error in downloading input parameter file: " + str(e))
             exc_type, exc_obj, exc_tb = sys.exc_info()
@@ -185,16 +324,16 @@ class IBusPlatformInterface:
             url = outputFileUploadUrl + parameter
             file_with_path = os.path.realpath(completeFilePath)
             print("UPLOAD_OUTPUT_PARAMETER_FILE : File to be uploaded ={}".format(file_with_path))
-            postReqFiles = {'file': open(file_with_path, 'rb')}
-            
-            if self.iBusEdge:
-                response = requests.post(url, files=postReqFiles)
-            else:
-                postReqHeaders = {"authorization": "Bearer " + self.__getKeycloakToken()}
-                response = requests.post(url, headers=postReqHeaders, files=postReqFiles)
+            compress = parameter.lower() in (name.lower() for name in IBUS_GZIP_PARAMETERS)
+            with MultipartFileBody('file', file_with_path, compress) as postReqBody:
+                postReqHeaders = postReqBody.get_headers()
+                if not self.iBusEdge:
+                    postReqHeaders["authorization"] = "Bearer " + self.__getKeycloakToken()
+                response = get_session().post(url, headers=postReqHeaders, data=postReqBody, timeout=IBUS_REQUEST_TIMEOUT)
                 
             print("UPLOAD_OUTPUT_PARAMETER_FILE : status_code ={}".format(response.status_code))
             if response.status_code == 200:
+                store_artifact(self.workflowInstanceId, parameter, file_with_path)
                 return True
             else:
                 print('UPLOAD_OUTPUT_PARAMETER_FILE : response text = ' + response.text)
@@ -204,26 +343,80 @@ class IBusPlatformInterface:
             exc_type, exc_obj, exc_tb = sys.exc_info()
             print("Exception Type : {} at line {}".format(exc_type, exc_tb.tb_lineno));
             
-    def logInfo(self, message):
-        self.__reInitializeLog()
-        self.uploadLiveLog("INFO", str(message))
-        self.logFileHandle.write(str(datetime.datetime.now()) + " INFO "+str(message)+ " \n")
+    # The log methods take printf style arguments, message % args is only
+    # built for the messages which are logged:
+    #     logInfo("payload %s", payload, every=100, limit=10)
+    # every=N logs one of every N calls from the same line, limit=N logs at
+    # most N messages of that line per LOG_RATE_WINDOW seconds. The next
+    # message logged from the line tells how many were suppressed.
+    def logInfo(self, message, *args, every=1, limit=None):
+        self.__log("INFO", message, args, every, limit)
         
-    def logWarning(self, message):
-        self.__reInitializeLog()
-        self.uploadLiveLog("WARN", str(message))
-        self.logFileHandle.write(str(datetime.datetime.now()) + " WARN "+ str(message)+ " \n")
+    def logWarning(self, message, *args, every=1, limit=None):
+        self.__log("WARN", message, args, every, limit)
         
-    def logError(self, message):
-        self.__reInitializeLog()
-        self.uploadLiveLog("ERROR", str(message))
-        self.logFileHandle.write(str(datetime.datetime.now()) + " ERROR " + str(message)+ " \n")
+    def logError(self, message, *args, every=1, limit=None):
+        self.__log("ERROR", message, args, every, limit)
 
-    def logDebug(self, message):
-        self.__reInitializeLog()
+    def logDebug(self, message, *args, every=1, limit=None):
         if self.debugMsgReq:
-            self.uploadLiveLog("DEBUG", str(message))
-            self.logFileHandle.write(str(datetime.datetime.now()) + " DEBUG " + str(message)+ " \n")
+            self.__log("DEBUG", message, args, every, limit)
+
+    def isLogEnabled(self, level):
+        # for messages which are expensive to build even lazily
+        if level == "DEBUG" and not self.debugMsgReq:
+            return False
+        return self.logLevels[level] >= self.minLogLevel
+
+    def __log(self, level, message, args, every, limit):
+        if self.logLevels[level] < self.minLogLevel:
+            return
+        suppressed = 0
+        if every > 1 or limit is not None:
+            # caller of logInfo / logWarning / ...
+            caller = sys._getframe(2)
+            suppressed = self.__checkCallSite((caller.f_code.co_filename, caller.f_lineno), every, limit)
+            if suppressed is None:
+                return
+        message = str(message)
+        if args:
+            try:
+                message = message % args
+            except (TypeError, ValueError):
+                message = message + " " + " ".join(str(arg) for arg in args)
+        if suppressed:
+            message = message + " ({} similar messages suppressed)".format(suppressed)
+        if self.logFileHandle == None:
+            self.__reInitializeLog()
+        self.uploadLiveLog(level, message)
+        now = datetime.datetime.now()
+        self.logFileHandle.write(str(now) + " " + level + " " + message + " \n")
+        # written in LOG_FILE_BUFFER_SIZE blocks, flushed every LOG_FILE_FLUSH_INTERVAL seconds
+        if now.timestamp() - self.logFileFlushedAt >= LOG_FILE_FLUSH_INTERVAL:
+            self.logFileHandle.flush()
+            self.logFileFlushedAt = now.timestamp()
+
+    def __checkCallSite(self, callSite, every, limit):
+        # returns None to suppress the message, else the number suppressed since the last one logged
+        now = time.time()
+        state = self.logCallSites.get(callSite)
+        if state is None:
+            state = self.logCallSites[callSite] = {"calls": 0, "windowStart": now, "logged": 0, "suppressed": 0}
+        state["calls"] += 1
+        if (state["calls"] - 1) % every:
+            state["suppressed"] += 1
+            return None
+        if limit is not None:
+            if now - state["windowStart"] >= LOG_RATE_WINDOW:
+                state["windowStart"] = now
+                state["logged"] = 0
+            if state["logged"] >= limit:
+                state["suppressed"] += 1
+                return None
+            state["logged"] += 1
+        suppressed = state["suppressed"]
+        state["suppressed"] = 0
+        return suppressed
     
 if __name__ == "__main__":
     iBusObj = IBusPlatformInterface(sys.argv[1], sys.argv[2], None)
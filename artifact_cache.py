@@ -0,0 +1,166 @@
+"""
+Local cache of the parameter files this service uploads to the workflow
+manager, for the next stage of the same workflow instance to read them from
+disk instead of downloading them again.
+
+Files are stored once by sha256 of their content under
+ARTIFACT_CACHE_DIR/blobs, ARTIFACT_CACHE_DIR/refs maps the workflow instance
+id and parameter name to the blob. Blobs are touched when read and the least
+recently used ones are deleted when a new blob makes them take more than
+ARTIFACT_CACHE_MAX_BYTES. Writes go to a temporary file which is renamed,
+so the processes of the service can share the directory.
+
+Errors are only printed, a stage falls back to the download.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+from setting import (ARTIFACT_CACHE_DIR, ARTIFACT_CACHE_ENABLED,
+                     ARTIFACT_CACHE_MAX_BYTES, IBUS_TRANSFER_CHUNK_SIZE)
+
+BLOBS_DIR = os.path.join(ARTIFACT_CACHE_DIR, 'blobs')
+REFS_DIR = os.path.join(ARTIFACT_CACHE_DIR, 'refs')
+
+# bytes of the blobs, counted by evict_artifacts and increased by the blobs
+# this process adds, None until the first count
+blobs_size = None
+
+
+def get_ref_path(workflow_instance_id, parameter):
+    """
+    Parameter names are not case sensitive, the stages upload 'NDPd-Data'
+    and download 'Ndpd-Data'
+    """
+    key = f"{workflow_instance_id}|{parameter.lower()}".encode()
+    return os.path.join(REFS_DIR, hashlib.sha1(key).hexdigest())
+
+
+def write_atomic(directory, write):
+    """
+    :param write: function writing the content to the file object it gets
+    :return: path of the temporary file in directory, to be renamed
+    """
+    os.makedirs(directory, exist_ok=True)
+    handle, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'wb') as file:
+            write(file)
+    except Exception:
+        os.remove(temp_path)
+        raise
+    return temp_path
+
+
+def store_artifact(workflow_instance_id, parameter, file_path):
+    """
+    Caches the uploaded file_path as parameter of the workflow instance
+    :return: False if the file was not cached
+    """
+    if not ARTIFACT_CACHE_ENABLED:
+        return False
+    try:
+        digest = hashlib.sha256()
+
+        def copy(target):
+            with open(file_path, 'rb') as source:
+                for chunk in iter(lambda: source.read(
+                        IBUS_TRANSFER_CHUNK_SIZE), b''):
+                    digest.update(chunk)
+                    target.write(chunk)
+
+        temp_path = write_atomic(BLOBS_DIR, copy)
+        blob_path = os.path.join(BLOBS_DIR, digest.hexdigest())
+        if os.path.exists(blob_path):
+            os.remove(temp_path)
+            os.utime(blob_path)
+            added_size = 0
+        else:
+            os.replace(temp_path, blob_path)
+            added_size = os.path.getsize(blob_path)
+        ref = json.dumps({"blob": digest.hexdigest(),
+                          "filename": os.path.basename(file_path)}).encode()
+        ref_path = get_ref_path(workflow_instance_id, parameter)
+        os.replace(write_atomic(REFS_DIR, lambda file: file.write(ref)),
+                   ref_path)
+        if added_size:
+            add_blobs_size(added_size)
+        return True
+    except Exception as error:
+        print(f"ARTIFACT_CACHE : {parameter} of {workflow_instance_id} not "
+              f"cached : {error}")
+        return False
+
+
+def fetch_artifact(workflow_instance_id, parameter, filename=None):
+    """
+    Copies the cached parameter file of the workflow instance to filename
+    :param filename: path to copy to, None for the name it was uploaded with
+    :return: path of the copy, None if the parameter is not cached
+    """
+    if not ARTIFACT_CACHE_ENABLED:
+        return None
+    try:
+        with open(get_ref_path(workflow_instance_id, parameter)) as file:
+            ref = json.load(file)
+        blob_path = os.path.join(BLOBS_DIR, ref["blob"])
+        filename = filename or ref["filename"]
+        shutil.copyfile(blob_path, filename)
+        os.utime(blob_path)
+        return filename
+    except FileNotFoundError:
+        return None
+    except Exception as error:
+        print(f"ARTIFACT_CACHE : {parameter} of {workflow_instance_id} not "
+              f"read : {error}")
+        return None
+
+
+def add_blobs_size(size):
+    """Counts a new blob, evicts blobs once they take too much space"""
+    global blobs_size
+    if blobs_size is None:
+        evict_artifacts(ARTIFACT_CACHE_MAX_BYTES)
+        return
+    blobs_size += size
+    if blobs_size > ARTIFACT_CACHE_MAX_BYTES:
+        evict_artifacts(ARTIFACT_CACHE_MAX_BYTES)
+
+
+def evict_artifacts(max_bytes=ARTIFACT_CACHE_MAX_BYTES):
+    """
+    Deletes the least recently used blobs until they take at most max_bytes
+    and the refs of the deleted blobs, counts the blobs of every process
+    :return: number of blobs deleted
+    """
+    global blobs_size
+    blobs = []
+    with os.scandir(BLOBS_DIR) as entries:
+        for entry in entries:
+            if not entry.name.endswith('.tmp'):
+                stat = entry.stat()
+                blobs.append((stat.st_mtime, stat.st_size, entry.name))
+    total = sum(size for _, size, _ in blobs)
+    deleted = set()
+    for _, size, name in sorted(blobs):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(BLOBS_DIR, name))
+        except FileNotFoundError:
+            pass
+        deleted.add(name)
+        total -= size
+    blobs_size = total
+    if deleted:
+        with os.scandir(REFS_DIR) as entries:
+            for entry in entries:
+                try:
+                    with open(entry.path) as file:
+                        if json.load(file)["blob"] in deleted:
+                            os.remove(entry.path)
+                except (OSError, ValueError, KeyError):
+                    pass
+    return len(deleted)
@@ -1,56 +1,362 @@
 """
 This file is designed to handle long running digiMOPs.
 """
+import hashlib
+import io
 import json
+import math
 import threading
+import time
 import uuid
-from functools import wraps
+import zlib
+from functools import partial, wraps
 
-from flask import current_app, request, url_for, Response
+from flask import current_app, g, request, url_for, Response
 from werkzeug.exceptions import HTTPException, InternalServerError
+from werkzeug.test import EnvironBuilder
 
+from cancellation import (CANCELLED, TIMED_OUT, get_stop_reason,
+                          get_stopped_response, request_cancel)
 from config import DIGIMOP_DELAY, DIGIMOP_TIMEOUT
+from progress import get_progress, get_progress_key
+from scheduler import (TaskScheduler, get_customer, get_queue_depths,
+                       get_queue_key, notify_workers)
 from wsgi import application
-from setting import TASKS
+from setting import (ASYNC_TASK_MODE, ASYNC_TASK_WORKERS,
+                     OPERATION_STATUS_MAX_WAIT, OPERATION_STATUS_MAX_WAITERS,
+                     TASK_CLASS_QUEUE_DEPTH,
+                     TASK_COMPRESS_MIN_SIZE, TASK_DEFAULT_PRIORITY,
+                     TASK_DELIVERED_TTL, TASK_FINGERPRINT_KEY_PREFIX,
+                     TASK_KEY_PREFIX, TASK_NOTIFY_KEY_PREFIX,
+                     TASK_NOTIFY_TTL, TASK_PRIORITY_CLASSES, TASK_RECORD_TTL,
+                     TASKS)
 
 
-def async_task(wrapped_function):
-    """This is a decorator function."""
+# Tasks run on a fixed number of threads instead of one thread per request,
+# their pools are shared, see executor.py. The threads pick the
+# queued tasks by priority class and customer limit, see scheduler.py
+scheduler = TaskScheduler(ASYNC_TASK_WORKERS)
+# {function name: wrapped function} of every @async_task route, used by the
+# worker processes in "queue" mode to find the function of a job
+task_functions = {}
+# /OperationStatus requests of this process blocked in wait_for_task
+status_waiters = threading.BoundedSemaphore(OPERATION_STATUS_MAX_WAITERS)
+# Returns the task id of the fingerprint if that task is queued, running or
+# completed without a server error, timeout or cancel, otherwise points the
+# fingerprint to the new task and creates its record, in one step so that
+# two copies of a request can't both start
+claim_fingerprint = TASKS.register_script("""
+local existing = redis.call('GET', KEYS[1])
+if existing then
+    local task = redis.call('HMGET', ARGV[3] .. existing, 'state', 'status')
+    if task[1] and task[1] ~= ARGV[5] and task[1] ~= ARGV[6] and
+            not (task[2] and tonumber(task[2]) >= 500) then
+        return existing
+    end
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+redis.call('HMSET', ARGV[3] .. ARGV[1], 'state', 'Queued', 'queued_at', ARGV[4])
+redis.call('EXPIRE', ARGV[3] .. ARGV[1], ARGV[2])
+return ARGV[1]
+""")
+
+
+def get_task_key(task_id):
+    """:return: redis key of the task record"""
+    return TASK_KEY_PREFIX + task_id
+
+
+def write_task_record(task_id, fields, pipeline=None):
+    """
+    Writes fields to the task record and renews its TTL in one round trip,
+    or as part of pipeline when given
+    """
+    task_key = get_task_key(task_id)
+    execute = pipeline is None
+    if execute:
+        pipeline = TASKS.pipeline()
+    pipeline.hmset(task_key, fields)
+    pipeline.expire(task_key, TASK_RECORD_TTL)
+    if execute:
+        pipeline.execute()
+
+
+def read_task_record(task_id):
+    """:return: task record with text values, {} if there is no record"""
+    task = TASKS.hgetall(get_task_key(task_id))
+    if task.get(b'encoding') == b'zlib':
+        task[b'return_value'] = zlib.decompress(task[b'return_value'])
+    return {
+        key.decode() if isinstance(key, bytes) else key:
+            val.decode() if isinstance(val, bytes) else val
+        for key, val in task.items()
+    }
+
+
+def store_task_result(task_id, result):
+    """
+    Stores the result in the task record and signals the /OperationStatus
+    requests waiting for it. Big return values are stored compressed.
+    :param task_id: id of the task record
+    :param result: return_value, status and timings of the task
+    """
+    return_value = result['return_value']
+    if len(return_value) >= TASK_COMPRESS_MIN_SIZE:
+        if isinstance(return_value, str):
+            return_value = return_value.encode('utf-8')
+        result['return_value'] = zlib.compress(return_value)
+        result['encoding'] = 'zlib'
+    result['completed_at'] = time.time()
+    notify_key = TASK_NOTIFY_KEY_PREFIX + task_id
+    pipeline = TASKS.pipeline()
+    write_task_record(task_id, result, pipeline)
+    pipeline.lpush(notify_key, 'done')
+    pipeline.expire(notify_key, TASK_NOTIFY_TTL)
+    pipeline.execute()
+
+
+def wait_for_task(task_id, wait):
+    """
+    Blocks until the task result is stored or wait seconds, rounded up to
+    whole seconds, are over. The notification is pushed back to its list, so
+    every waiting request of the same task gets it. Does not wait when
+    OPERATION_STATUS_MAX_WAITERS requests of the process are waiting already
+    :return: True if the task is completed
+    """
+    if not status_waiters.acquire(blocking=False):
+        print(f"Not waiting for task {task_id}, "
+              f"{OPERATION_STATUS_MAX_WAITERS} requests are waiting")
+        return False
+    try:
+        notify_key = TASK_NOTIFY_KEY_PREFIX + task_id
+        return TASKS.brpoplpush(notify_key, notify_key,
+                                timeout=math.ceil(wait)) is not None
+    finally:
+        status_waiters.release()
+
+
+def get_wait_time(json_data):
+    """
+    :param json_data: /OperationStatus input, "Wait": seconds to wait for the
+    task to complete
+    :return: seconds, at most OPERATION_STATUS_MAX_WAIT, 0 to not wait
+    """
+    try:
+        wait = float(json_data.get('Wait', 0))
+    except (TypeError, ValueError):
+        return 0
+    return min(max(wait, 0), OPERATION_STATUS_MAX_WAIT)
+
+
+def get_task_state(response_data):
+    """
+    :param response_data: json returned by the task
+    :return: TIMED_OUT or CANCELLED when the task stopped early, else
+    "Completed"
+    """
+    try:
+        status = json.loads(response_data).get("Operation_Status")
+    except (ValueError, AttributeError):
+        return 'Completed'
+    return status if status in (TIMED_OUT, CANCELLED) else 'Completed'
+
+
+def run_task(flask_app, environ, task_id, queued_at, wrapped_function, *args,
+             **kwargs):
+    """
+    Runs wrapped_function on a scheduler thread, or in a worker process in
+    "queue" mode, and stores its response in the task record. A task which
+    timed out or was cancelled while queued is not run.
+    :param flask_app: app of the original request
+    :param environ: environ of the original request
+    :param task_id: id of the task record
+    :param queued_at: time.time() when the task was queued
+    """
+    started_at = time.time()
+    # Create a request context similar to that of the original request
+    # so that the task can have access to flask.g, flask.request, etc.
+    with flask_app.request_context(environ):
+        error = None
+        # the record is read and written inside the try, a redis error
+        # completes the task with a 500 instead of leaving it "Queued"
+        try:
+            deadline = TASKS.hget(get_task_key(task_id), 'deadline')
+            deadline = float(deadline) if deadline else None
+            stop_reason = get_stop_reason(task_id, deadline)
+            if stop_reason:
+                print(f"Task {task_id} {stop_reason} before it started")
+                store_task_result(task_id, {
+                    'state': stop_reason,
+                    'return_value': json.dumps(
+                        get_stopped_response(stop_reason)),
+                    'status': 200
+                })
+                return
+            queue_wait = round(started_at - queued_at, 3)
+            write_task_record(task_id, {'state': 'Running',
+                                        'queue_wait': queue_wait})
+            print(f"Task {task_id} started after waiting {queue_wait} s in "
+                  f"queue")
+            # lets the task report its progress, see progress.py, and stop
+            # at the deadline, see cancellation.py
+            g.task_id = task_id
+            g.deadline = deadline
+            response = wrapped_function(*args, **kwargs)
+            result = {'return_value': response.data,
+                      'status': response.status_code,
+                      'state': get_task_state(response.data)}
+        except HTTPException as http_exception:
+            result = {'return_value': str(
+                current_app.handle_http_exception(http_exception)),
+                'status': 400, 'state': 'Completed'}
+        except Exception as exception:
+            # The function raised an exception, so we set a 500 error
+            result = {'return_value': str(InternalServerError()),
+                      'status': 500, 'state': 'Completed'}
+            if current_app.debug:
+                error = exception
+        run_time = round(time.time() - started_at, 3)
+        print(f"Task {task_id} ran for {run_time} s")
+        result['run_time'] = run_time
+        store_task_result(task_id, result)
+        print("Updated redis")
+        if error is not None:
+            # We want to find out if something happened so reraise
+            raise error
+
+
+def get_fingerprint_key(function_name):
+    """
+    :param function_name: name of the @async_task function, the stage
+    :return: redis key of the fingerprint of stage + workflow-instance-id +
+    digimop-operation-id, None when the request has no such ids
+    """
+    json_data = request.get_json(silent=True)
+    if not isinstance(json_data, dict):
+        return None
+    workflow_instance_id = json_data.get('workflow-instance-id')
+    operation_id = json_data.get('digimop-operation-id')
+    if not workflow_instance_id or not operation_id:
+        return None
+    fingerprint = hashlib.sha1(json.dumps(
+        [function_name, str(workflow_instance_id), str(operation_id)]
+    ).encode('utf-8')).hexdigest()
+    return TASK_FINGERPRINT_KEY_PREFIX + fingerprint
+
+
+def get_existing_task(fingerprint_key, task_id, queued_at):
+    """
+    :return: id of the task already started for the same request, None if
+    the new task_id got the fingerprint
+    """
+    if fingerprint_key is None:
+        return None
+    claimed_id = claim_fingerprint(
+        keys=[fingerprint_key],
+        args=[task_id, TASK_RECORD_TTL, TASK_KEY_PREFIX, queued_at,
+              TIMED_OUT, CANCELLED]).decode()
+    return None if claimed_id == task_id else claimed_id
+
+
+def release_fingerprint(fingerprint_key, task_id):
+    """Drops the fingerprint of a task which could not be started"""
+    if fingerprint_key is None:
+        return
+    if TASKS.get(fingerprint_key) == task_id.encode():
+        TASKS.delete(fingerprint_key)
+
+
+def get_job(function_name, kwargs):
+    """
+    :param function_name: name of the @async_task function
+    :param kwargs: view arguments of the request
+    :return: json of everything a worker process needs to run the task
+    with the same request
+    """
+    return json.dumps({
+        'function': function_name,
+        'kwargs': kwargs,
+        'path': request.path,
+        'method': request.method,
+        'query_string': request.query_string.decode('utf-8'),
+        'content_type': request.content_type,
+        'data': request.get_data(as_text=True)
+    })
+
+
+def get_job_environ(job):
+    """:return: WSGI environ of the request stored in the job"""
+    return EnvironBuilder(path=job['path'], method=job['method'],
+                          query_string=job['query_string'],
+                          content_type=job['content_type'],
+                          data=job['data']).get_environ()
+
+
+def get_task_environ():
+    """
+    :return: copy of the request environ for the task thread, with the body
+    readable again, it is read already to find the fingerprint and customer
+    """
+    environ = dict(request.environ)
+    environ['wsgi.input'] = io.BytesIO(request.get_data())
+    return environ
+
+
+def get_task_fields(queued_at, priority, customer):
+    """
+    :return: fields of the record of a new task, it has to end
+    DIGIMOP_TIMEOUT seconds after it is queued
+    """
+    fields = {'state': 'Queued', 'queued_at': queued_at,
+              'deadline': queued_at + DIGIMOP_TIMEOUT, 'priority': priority}
+    if customer is not None:
+        fields['customer'] = customer
+    return fields
+
+
+def enqueue_task(task_id, fields, function_name, kwargs):
+    """
+    "queue" mode, stores the job in the task record and pushes the task to
+    the list of its priority class for the worker processes
+    :param fields: record fields from get_task_fields
+    :return: False if the list is full
+    """
+    queue_key = get_queue_key(fields['priority'])
+    if TASKS.llen(queue_key) >= TASK_CLASS_QUEUE_DEPTH[fields['priority']]:
+        return False
+    pipeline = TASKS.pipeline()
+    write_task_record(task_id, dict(fields, attempts=0,
+                                    job=get_job(function_name, kwargs)),
+                      pipeline)
+    pipeline.lpush(queue_key, task_id)
+    notify_workers(pipeline, fields['priority'])
+    pipeline.execute()
+    return True
+
+
+def queue_full_response():
+    print("Task queue is full, rejecting the request")
+    return Response(response=json.dumps({
+        "Operation_Status": "Failed",
+        "Failed_Message": "Too many operations are queued, try again later"
+    }), status=503, mimetype='application/json')
+
+
+def async_task(wrapped_function=None, priority=TASK_DEFAULT_PRIORITY):
+    """
+    This is a decorator function, used as @async_task or
+    @async_task(priority='high') with a class of TASK_PRIORITY_CLASSES.
+    """
+    if wrapped_function is None:
+        return partial(async_task, priority=priority)
+    if priority not in TASK_PRIORITY_CLASSES:
+        raise ValueError(f"Unknown priority {priority} of "
+                         f"{wrapped_function.__name__}, expected one of "
+                         f"{TASK_PRIORITY_CLASSES}")
+    task_functions[wrapped_function.__name__] = wrapped_function
 
     @wraps(wrapped_function)
     def new_function(*args, **kwargs):
-        def task_call(flask_app, environ):
-            # Create a request context similar to that of the original request
-            # so that the task can have access to flask.g, flask.request, etc.
-            with flask_app.request_context(environ):
-                try:
-                    # TASKS[task_id]['return_value'] = wrapped_function(*args, **kwargs)
-                    cached_data = TASKS.hgetall(task_id)
-                    print("Cached data", cached_data)
-                    response = wrapped_function(*args, **kwargs)
-                    cached_data['return_value'] = response.data
-                    cached_data['status'] = response.status_code
-                    TASKS.hmset(task_id, cached_data)
-                    print("Updated redis")
-                except HTTPException as http_exception:
-                    # TASKS[task_id]['return_value'] = current_app.handle_http_exception(
-                    #     http_exception)
-                    cached_data = TASKS.hgetall(task_id)
-                    cached_data['return_value'] = str(current_app.handle_http_exception(
-                        http_exception))
-                    cached_data['status'] = 400
-                    TASKS.hmset(task_id, cached_data)
-                except Exception:
-                    # The function raised an exception, so we set a 500 error
-                    # TASKS[task_id]['return_value'] = InternalServerError()
-                    cached_data = TASKS.hgetall(task_id)
-                    cached_data['return_value'] = str(InternalServerError())
-                    cached_data['status'] = 500
-                    TASKS.hmset(task_id, cached_data)
-                    if current_app.debug:
-                        # We want to find out if something happened so reraise
-                        raise
-
         # If the delay is more than timeout, raise an error and stop execution
         if DIGIMOP_DELAY > DIGIMOP_TIMEOUT:
             return Response(response=json.dumps({
@@ -59,29 +365,52 @@ def async_task(wrapped_function):
 
         # Assign an id to the asynchronous task
         task_id = uuid.uuid4().hex
-        # Create a thread
-        _thered = threading.Thread(target=task_call, args=(
-            current_app._get_current_object(), request.environ))
-
-        # Store task_id in cache
-        TASKS.hmset(task_id, {'task_thread': str(_thered)})
-        print("Set task_id in redis cache", task_id)
-        # Starting a thread
-        _thered.start()
-
-        # Return a 200 response, with a link that the client can use to
-        # obtain task status
-        return Response(response=json.dumps({
-            "Operation_Status": "Accepted",
-            "Delay": str(DIGIMOP_DELAY),
-            "Timeout": str(DIGIMOP_TIMEOUT),
-            "Operation_Id": str(task_id),
-            "status_url": url_for('request_status', task_id=task_id),
-        }), status=200, mimetype='application/json')
+        queued_at = time.time()
+        # a retry of a request which is in flight or recently completed
+        # gets the task id of the first request
+        fingerprint_key = get_fingerprint_key(wrapped_function.__name__)
+        existing_task_id = get_existing_task(fingerprint_key, task_id,
+                                             queued_at)
+        if existing_task_id:
+            print(f"Duplicate request, attaching to task {existing_task_id}")
+            return accepted_response(existing_task_id)
+
+        customer = get_customer(request.get_json(silent=True))
+        fields = get_task_fields(queued_at, priority, customer)
+        if ASYNC_TASK_MODE == 'queue':
+            # the task runs in a worker process, see worker.py
+            queued = enqueue_task(task_id, fields, wrapped_function.__name__,
+                                  kwargs)
+        else:
+            # Store task_id in cache
+            write_task_record(task_id, fields)
+            queued = scheduler.submit(
+                priority, customer, run_task,
+                current_app._get_current_object(), get_task_environ(), task_id,
+                queued_at, wrapped_function, *args, **kwargs)
+        if not queued:
+            release_fingerprint(fingerprint_key, task_id)
+            TASKS.delete(get_task_key(task_id))
+            return queue_full_response()
+        print(f"Queued task_id {task_id} in class {priority} for customer "
+              f"{customer}")
+        return accepted_response(task_id)
 
     return new_function
 
 
+def accepted_response(task_id):
+    # Return a 200 response, with a link that the client can use to
+    # obtain task status
+    return Response(response=json.dumps({
+        "Operation_Status": "Accepted",
+        "Delay": str(DIGIMOP_DELAY),
+        "Timeout": str(DIGIMOP_TIMEOUT),
+        "Operation_Id": str(task_id),
+        "status_url": url_for('request_status', task_id=task_id),
+    }), status=200, mimetype='application/json')
+
+
 # Below rest API would be used to get the status for long running digiMOP
 @application.route('/OperationStatus', methods=['GET', 'POST'])
 def request_status():
@@ -89,35 +418,90 @@ def request_status():
     Return status about an asynchronous task. If this request returns Operation_Status as In-Progress,
     it means that task hasn't finished yet. Else, the response
     from the task is returned.
+    With "Wait": seconds in the input, the request waits up to that long
+    for the task to complete before answering In-Progress.
     """
     print("Calling operation status API")
     json_data = request.json
     task_id = json_data["Operation_Id"]
     print(f"Task id", task_id)
-    task = TASKS.hgetall(task_id)
-    print("task in operation status", task)
+    task = read_task_record(task_id)
+    print("task in operation status", task.get('state'))
     if not task:
         return Response(response=json.dumps({
             "Operation_Status": "Failed",
             "Failed_Message": "Digimop failed to execute. Operation id is null"
         }), status=400, mimetype='application/json')
 
-    task = {
-        key.decode() if isinstance(key, bytes) else key:
-            val.decode() if isinstance(val, bytes) else val
-        for key, val in task.items()
-    }
+    wait = get_wait_time(json_data)
+    if 'return_value' not in task and wait and wait_for_task(task_id, wait):
+        task = read_task_record(task_id)
 
     if 'return_value' not in task:
         print("Status- Inprogress")
-        return Response(response=json.dumps({
+        # "Queued" until a thread or worker process picks the task up
+        status = {
             "Operation_Status": "In-Progress",
+            "Task_State": task.get('state', 'Running'),
             "status_url": url_for('request_status', task_id=task_id),
-        }), status=200, mimetype='application/json')
+        }
+        progress = get_progress(task_id)
+        if progress:
+            status["Progress"] = progress
+        return Response(response=json.dumps(status), status=200,
+                        mimetype='application/json')
 
     else:
-        print("Removing task-id from cache")
-        TASKS.delete(task_id)
+        # kept for a while so that a retry of the same request gets this
+        # result instead of starting the stage again
+        print("Expiring task-id in cache")
+        pipeline = TASKS.pipeline()
+        pipeline.expire(get_task_key(task_id), TASK_DELIVERED_TTL)
+        pipeline.expire(TASK_NOTIFY_KEY_PREFIX + task_id, TASK_DELIVERED_TTL)
+        pipeline.delete(get_progress_key(task_id))
+        pipeline.execute()
         print("Sending response", json.dumps(json.loads(task['return_value'])))
         return Response(response=json.dumps(json.loads(task['return_value'])),
                         status=task['status'], mimetype='application/json')
+
+
+@application.route('/TaskQueueStatus', methods=['GET'])
+def task_queue_status():
+    """
+    Return the queued and running tasks of every priority class and the
+    running tasks per customer. In "thread" mode these are the tasks of the
+    wsgi process answering the request.
+    """
+    return Response(response=json.dumps(get_queue_depths(scheduler)),
+                    status=200, mimetype='application/json')
+
+
+@application.route('/CancelOperation', methods=['POST'])
+def cancel_operation():
+    """
+    Ask an asynchronous task to stop. A queued task is not started, a running
+    update stage stops after its current rows and returns the partial
+    results with Operation_Status Cancelled. A completed task is not changed.
+    """
+    json_data = request.json
+    task_id = json_data["Operation_Id"]
+    print("Cancelling task", task_id)
+    task = read_task_record(task_id)
+    if not task:
+        return Response(response=json.dumps({
+            "Operation_Status": "Failed",
+            "Failed_Message": "Digimop failed to execute. Operation id is null"
+        }), status=400, mimetype='application/json')
+    if 'return_value' in task:
+        status = {"Operation_Status": "Completed",
+                  "Task_State": task.get('state', 'Completed')}
+    else:
+        request_cancel(task_id)
+        status = {"Operation_Status": "Cancelling",
+                  "Task_State": task.get('state', 'Running')}
+    status.update({
+        "Operation_Id": task_id,
+        "status_url": url_for('request_status', task_id=task_id)
+    })
+    return Response(response=json.dumps(status), status=200,
+                    mimetype='application/json')
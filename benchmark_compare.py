@@ -0,0 +1,284 @@
+"""
+Micro-benchmark for the compare stage of /compare-ndpd-st-data.
+
+Generates mappings, NDPD rows and ST rows shaped like the Mapping-Json,
+Ndpd-Data and ST-Data artifacts, then times get_ndpd_st_data,
+get_ndpd_updated_data and get_st_updated_data separately for every scale and
+compare engine. The get_ndpd / get_site_tracker lookups are timed on a sample
+of mappings. Throughput and peak memory (tracemalloc) go to a json file.
+
+usage: python benchmark_compare.py --scales 1000,10000 --engines loop,pandas
+"""
+import argparse
+import gc
+import json
+import logging
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import compare
+import compare_pandas
+from utility import get_ndpd, get_site_tracker
+
+ENGINES = {
+    "loop": (compare.get_ndpd_st_data, compare.get_ndpd_updated_data,
+             compare.get_st_updated_data),
+    "pandas": (compare_pandas.get_ndpd_st_data,
+               compare_pandas.get_ndpd_updated_data,
+               compare_pandas.get_st_updated_data)
+}
+SCALES = [1000, 10000, 100000, 1000000]
+FIELDS = ["Actual End Date", "Forecast Start Date"]
+SYSTEMS = ["NDPD", "SiteTracker"]
+TASKS_PER_SMP = 12
+MILESTONES_PER_PROJECT = 12
+START_DATE = datetime(2020, 1, 1)
+
+logger = logging.getLogger("benchmark_compare")
+
+
+class BenchmarkIBus:
+    """Stands in for IBusPlatformInterface, live logs are not benchmarked"""
+
+    def logInfo(self, message, *args, **kwargs):
+        pass
+
+    def logWarning(self, message, *args, **kwargs):
+        pass
+
+    def logError(self, message, *args, **kwargs):
+        pass
+
+    def logDebug(self, message, *args, **kwargs):
+        pass
+
+
+def get_ndpd_time(rand):
+    """:return: NDPD time string, "null" or "" like the NDPD api sends"""
+    value = rand.random()
+    if value < 0.2:
+        return "null"
+    if value < 0.25:
+        return ""
+    date = START_DATE + timedelta(days=rand.randint(0, 700),
+                                  seconds=rand.randint(0, 86399))
+    return date.strftime("%Y-%m-%d %H:%M:%S.") + str(rand.randint(0, 999))
+
+
+def get_st_date(rand):
+    """:return: Site Tracker date string or None"""
+    if rand.random() < 0.25:
+        return None
+    date = START_DATE + timedelta(days=rand.randint(0, 700))
+    return date.strftime("%Y-%m-%d")
+
+
+def get_modified_time(rand):
+    date = START_DATE + timedelta(days=rand.randint(0, 700),
+                                  seconds=rand.randint(0, 86399))
+    return date.strftime("%Y-%m-%d %H:%M:%S.") + str(rand.randint(0, 999))
+
+
+def generate_data(scale, seed):
+    """
+    :param scale: number of mappings, about as many NDPD and ST rows are
+    generated with some of them missing or duplicated
+    :param seed: random seed, the same seed gives the same data
+    :return: mappings, ndpd rows, st rows
+    """
+    rand = random.Random(seed)
+    mappings = []
+    ndpd_data = []
+    st_data = []
+    for position in range(scale):
+        smp = position // TASKS_PER_SMP
+        task = position % TASKS_PER_SMP
+        mapping = {
+            "ndpd-customerName": "Customer",
+            "ndpd-projectId": f"PRJ-{smp % 50}",
+            "ndpd-smpId": f"SMP-{smp}",
+            "ndpd-moduleId": f"MOD-{task % 3}",
+            "ndpd-taskName": f"Task {task}",
+            "ndpd-task-type": rand.choice(["Task", "Milestone"]),
+            "st-projectId": f"ST-{smp}",
+            "st-milestoneName": f"Milestone {task % MILESTONES_PER_PROJECT}",
+            "source": rand.choice(SYSTEMS),
+            "target": rand.choice(SYSTEMS),
+            "source-fields": rand.choice(FIELDS),
+            "target-fields": rand.choice(FIELDS)
+        }
+        mappings.append(mapping)
+        # about 5% of the tasks are missing in NDPD and 1% are duplicated
+        for _ in range(rand.choices([0, 1, 2], [5, 94, 1])[0]):
+            ndpd_data.append({
+                "ndpd-projectId": mapping["ndpd-projectId"],
+                "ndpd-smpId": mapping["ndpd-smpId"],
+                "ndpd-moduleId": mapping["ndpd-moduleId"],
+                "ndpd-taskName": mapping["ndpd-taskName"].upper()
+                if rand.random() < 0.1 else mapping["ndpd-taskName"],
+                "actualStartTime": get_ndpd_time(rand),
+                "actualEndTime": get_ndpd_time(rand),
+                "plannedStartTime": get_ndpd_time(rand),
+                "lastModifiedTime": get_modified_time(rand)
+            })
+        for _ in range(rand.choices([0, 1, 2], [5, 94, 1])[0]):
+            st_data.append({
+                "st-projectId": mapping["st-projectId"],
+                "st-milestoneName": mapping["st-milestoneName"],
+                "st-milestoneId": f"a0M{position:012d}",
+                "p-number": f"P{smp}",
+                "actualStartTime": get_st_date(rand),
+                "actualEndTime": get_st_date(rand),
+                "plannedStartTime": get_st_date(rand),
+                "lastModifiedTime": get_modified_time(rand)
+            })
+    return mappings, ndpd_data, st_data
+
+
+def measure(func, args, trace_memory):
+    """
+    :return: result of func(*args), seconds taken, peak memory in bytes
+    allocated while running (None when trace_memory is False)
+    """
+    gc.collect()
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = func(*args)
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+    return result, seconds, peak
+
+
+def get_stage_result(rows, seconds, peak):
+    return {"rows": rows, "seconds": round(seconds, 6),
+            "rowsPerSecond": round(rows / seconds, 2) if seconds else None,
+            "peakMemoryBytes": peak}
+
+
+def run_engine(engine, scale, seed, trace_memory):
+    """
+    Times the three compare stages of one engine. The stages change the
+    mapping dicts, so every run gets freshly generated data.
+    :return: {stage name: stage result}
+    """
+    compare_data, compare_ndpd_data, compare_st_data = ENGINES[engine]
+    ibus_obj = BenchmarkIBus()
+    mappings, ndpd_data, st_data = generate_data(scale, seed)
+    (ndpd_update_data, st_update_data), seconds, peak = measure(
+        compare_data, (mappings, ndpd_data, st_data, ibus_obj, logger),
+        trace_memory)
+    stages = {"get_ndpd_st_data": get_stage_result(len(mappings), seconds,
+                                                   peak)}
+    rows = len(ndpd_update_data)
+    final_ndpd_data, seconds, peak = measure(
+        compare_ndpd_data, (ndpd_update_data, logger, ibus_obj),
+        trace_memory)
+    stages["get_ndpd_updated_data"] = get_stage_result(rows, seconds, peak)
+    rows = len(st_update_data)
+    final_st_data, seconds, peak = measure(
+        compare_st_data, (st_update_data, logger, ibus_obj), trace_memory)
+    stages["get_st_updated_data"] = get_stage_result(rows, seconds, peak)
+    stages["output"] = {"ndpdUpdates": len(final_ndpd_data),
+                        "stUpdates": len(final_st_data)}
+    return stages
+
+
+def run_lookups(scale, seed, sample):
+    """
+    Times get_ndpd / get_site_tracker, the full scan lookups compare used
+    before the indexes, on a sample of the mappings
+    :return: {helper name: stage result}
+    """
+    mappings, ndpd_data, st_data = generate_data(scale, seed)
+    sample_mappings = random.Random(seed).sample(mappings,
+                                                 min(sample, len(mappings)))
+    result = {}
+    for name, func, data_list in (("get_ndpd", get_ndpd, ndpd_data),
+                                  ("get_site_tracker", get_site_tracker,
+                                   st_data)):
+        start = time.perf_counter()
+        for mapping in sample_mappings:
+            func(mapping, data_list)
+        result[name] = get_stage_result(len(sample_mappings),
+                                        time.perf_counter() - start, None)
+    return result
+
+
+def parse_scales(value):
+    """:param value: comma separated scales, ex: 1k,10k,1m or 1000,10000"""
+    scales = []
+    for scale in value.split(','):
+        scale = scale.strip().lower()
+        multiplier = 1
+        if scale.endswith('k'):
+            multiplier, scale = 1000, scale[:-1]
+        elif scale.endswith('m'):
+            multiplier, scale = 1000000, scale[:-1]
+        scales.append(int(scale) * multiplier)
+    return scales
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split(
+        '\n')[0])
+    parser.add_argument('--scales', type=parse_scales, default=SCALES,
+                        help="comma separated number of mappings, "
+                             "default 1k,10k,100k,1m")
+    parser.add_argument('--engines', default="loop",
+                        help=f"comma separated engines from "
+                             f"{', '.join(ENGINES)}, default loop")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--lookup-sample', type=int, default=20,
+                        help="mappings used to time get_ndpd / "
+                             "get_site_tracker, 0 to skip")
+    parser.add_argument('--no-memory', action='store_true',
+                        help="skip tracemalloc, it slows the stages down")
+    parser.add_argument('--output', default="benchmark_compare_results.json")
+    parser.add_argument('--verbose', action='store_true',
+                        help="show the compare warnings, ex: duplicate keys")
+    args = parser.parse_args(argv)
+    logger.setLevel(logging.DEBUG if args.verbose else logging.ERROR)
+    engines = [engine.strip() for engine in args.engines.split(',')]
+    unknown = [engine for engine in engines if engine not in ENGINES]
+    if unknown:
+        parser.error(f"unknown engines {unknown}")
+
+    results = {
+        "started": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "seed": args.seed,
+        "traceMemory": not args.no_memory,
+        "runs": []
+    }
+    for scale in args.scales:
+        for engine in engines:
+            print(f"{engine} engine, {scale} mappings ...")
+            stages = run_engine(engine, scale, args.seed, not args.no_memory)
+            results["runs"].append({"engine": engine, "scale": scale,
+                                    "stages": stages})
+            for name, stage in stages.items():
+                print(f"    {name}: {stage}")
+        if args.lookup_sample:
+            print(f"lookups, {scale} rows ...")
+            lookups = run_lookups(scale, args.seed, args.lookup_sample)
+            results["runs"].append({"engine": "lookup", "scale": scale,
+                                    "stages": lookups})
+            for name, stage in lookups.items():
+                print(f"    {name}: {stage}")
+    with open(args.output, 'w') as f:
+        f.write(json.dumps(results, indent=2))
+    print(f"results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
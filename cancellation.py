@@ -0,0 +1,91 @@
+"""
+Deadline and cancel request of a running @async_task task. The deadline is
+DIGIMOP_TIMEOUT seconds after the task was queued, /CancelOperation sets the
+cancel request in the task record. The update stages and their pool workers
+check both between rows, stop taking new rows and return what they have
+done with Operation_Status TIMED_OUT or CANCELLED.
+
+A run of groups in a shared pool has its own cancel flag, the groups still
+queued when the request stops waiting for them don't run.
+
+The cancel request of a task is read at most every CANCEL_CHECK_INTERVAL
+seconds per process, the rows in between use the last answer.
+"""
+import threading
+import time
+
+from setting import (CANCEL_CHECK_INTERVAL, RUN_CANCEL_KEY_PREFIX,
+                     RUN_CANCEL_TTL, TASK_KEY_PREFIX, TASKS)
+
+TIMED_OUT = "TimedOut"
+CANCELLED = "Cancelled"
+
+# {task id: (read at, cancel requested)} of the last read of each task
+cancel_checks = {}
+cancel_checks_lock = threading.Lock()
+
+
+def request_cancel(task_id):
+    TASKS.hset(TASK_KEY_PREFIX + task_id, 'cancel_requested', 1)
+
+
+def is_cancel_requested(task_id):
+    """
+    Reads the cancel request once per CANCEL_CHECK_INTERVAL, a task stays
+    cancelled once it was. Errors are only printed, the check must not fail
+    the update
+    """
+    now = time.time()
+    with cancel_checks_lock:
+        checked = cancel_checks.get(task_id)
+    if checked and (checked[1] or now - checked[0] < CANCEL_CHECK_INTERVAL):
+        return checked[1]
+    try:
+        requested = TASKS.hget(TASK_KEY_PREFIX + task_id,
+                               'cancel_requested') is not None
+    except Exception as error:
+        print(f"Cancel request of task {task_id} not read : {error}")
+        return False
+    with cancel_checks_lock:
+        # the answers of the finished tasks are dropped
+        for other_id, (read_at, _) in list(cancel_checks.items()):
+            if now - read_at >= CANCEL_CHECK_INTERVAL:
+                del cancel_checks[other_id]
+        cancel_checks[task_id] = (now, requested)
+    return requested
+
+
+def cancel_run(run_id):
+    """Errors are only printed, the groups then run as if not cancelled"""
+    try:
+        TASKS.set(RUN_CANCEL_KEY_PREFIX + run_id, 1, ex=RUN_CANCEL_TTL)
+    except Exception as error:
+        print(f"Run {run_id} not cancelled : {error}")
+
+
+def is_run_cancelled(run_id):
+    """Errors are only printed, the check must not fail the update"""
+    try:
+        return TASKS.exists(RUN_CANCEL_KEY_PREFIX + run_id) > 0
+    except Exception as error:
+        print(f"Cancel flag of run {run_id} not read : {error}")
+        return False
+
+
+def get_stop_reason(task_id, deadline):
+    """
+    :param task_id: id of the running task, None outside of @async_task
+    :param deadline: time.time() the task has to stop at, None for no limit
+    :return: TIMED_OUT, CANCELLED or None if the task goes on
+    """
+    if deadline is not None and time.time() >= deadline:
+        return TIMED_OUT
+    if task_id and is_cancel_requested(task_id):
+        return CANCELLED
+    return None
+
+
+def get_stopped_response(stop_reason):
+    """:return: json of a task which stopped before it started"""
+    return {"Operation_Status": stop_reason,
+            "message": f"Operation {stop_reason} before it started"}
@@ -1,6 +1,7 @@
 import datetime
 
-from utility import get_ndpd, get_site_tracker, \
+from date_utils import parse_ndpd_time, parse_st_date
+from utility import build_index, get_ndpd_key, get_site_tracker_key, \
     get_site_tracker_proper_date_format, get_proper_format
 
 
@@ -8,7 +9,7 @@ def add_timestamp_to_date(date_string):
     target_date = ""
     if date_string:
         try:
-            target_date = datetime.datetime.strptime(date_string, '%Y-%m-%d')
+            target_date = parse_st_date(date_string)
             target_date = datetime.datetime.combine(target_date.date(), datetime.time(12))
         except Exception as error:
             print(error)
@@ -34,127 +35,319 @@ def form_update_data(mapping, ndpd, site_tracker):
     return mapping
 
 
+def report_duplicate_keys(name, duplicates, ibus_obj, logger):
+    """
+    :param name: ndpd or st
+    :param duplicates: duplicate keys returned by build_index
+    """
+    if not duplicates:
+        return
+    message = f"{len(duplicates)} duplicate {name} keys found, using first " \
+              f"match for each -- {list(duplicates.items())[:10]}"
+    ibus_obj.logWarning(message)
+    logger.warning(message)
+
+
+NDPD = "NDPD"
+SITE_TRACKER = "SiteTracker"
+ACTUAL_END_DATE = "Actual End Date"
+TASK = "Task"
+# skipped row messages logged per call site and LOG_RATE_WINDOW
+SKIPPED_ROW_LOG_LIMIT = 100
+
+# Mapping fields a sync plan is compiled for
+SYNC_KEY = ('source', 'target', 'source-fields', 'target-fields',
+            'ndpd-task-type')
+
+# Rules deciding which update list a matched mapping goes to. They are checked
+# in order, the first rule whose "when" matches the mapping and whose "row"
+# condition holds for the ndpd / st rows decides. A rule without "row"
+# condition always holds, so the rules after it are never reached.
+# "when" compares SYNC_KEY fields, "same-system" is source == target.
+# "update" lists the actions taken:
+#   ndpd / st: add the mapping to the ndpd / st update list
+#   ndpd-if-older: add to ndpd list when ndpd lastModifiedTime is older
+#   st-if-newer: add to st list when ndpd lastModifiedTime is newer
+SYNC_RULES = [
+    {"name": "same-system-task-actual-end-missing-in-ndpd",
+     "when": {"same-system": True, "source-fields": ACTUAL_END_DATE,
+              "target-fields": ACTUAL_END_DATE, "ndpd-task-type": TASK},
+     "row": "ndpd-actual-end-missing",
+     "update": ["ndpd"]},
+    {"name": "same-system-actual-start-missing-in-st",
+     "when": {"same-system": True, "source-fields": ACTUAL_END_DATE},
+     "row": "st-actual-start-missing",
+     "update": ["st"]},
+    {"name": "same-system-task-actual-end-latest-wins",
+     "when": {"same-system": True, "target-fields": ACTUAL_END_DATE,
+              "ndpd-task-type": TASK},
+     "update": ["st-if-newer"]},
+    {"name": "same-system-latest-wins",
+     "when": {"same-system": True},
+     "update": ["ndpd-if-older", "st-if-newer"]},
+    {"name": "st-to-ndpd-task-actual-end-missing-in-ndpd",
+     "when": {"source": SITE_TRACKER, "target": NDPD,
+              "source-fields": ACTUAL_END_DATE,
+              "target-fields": ACTUAL_END_DATE, "ndpd-task-type": TASK},
+     "row": "ndpd-actual-end-missing",
+     "update": ["ndpd"]},
+    {"name": "st-to-ndpd-task-actual-end",
+     "when": {"source": SITE_TRACKER, "target": NDPD,
+              "target-fields": ACTUAL_END_DATE, "ndpd-task-type": TASK},
+     "update": []},
+    {"name": "st-to-ndpd",
+     "when": {"source": SITE_TRACKER, "target": NDPD},
+     "update": ["ndpd"]},
+    {"name": "ndpd-to-st",
+     "when": {"source": NDPD, "target": SITE_TRACKER},
+     "update": ["st"]},
+]
+
+
+def is_ndpd_actual_end_missing(ndpd, site_tracker):
+    return ndpd["actualEndTime"] == "null" and \
+        site_tracker["actualEndTime"] is not None
+
+
+def is_st_actual_start_missing(ndpd, site_tracker):
+    return site_tracker["actualStartTime"] is None and \
+        bool(ndpd["actualStartTime"])
+
+
+# "row" conditions used in SYNC_RULES
+ROW_CONDITIONS = {
+    "ndpd-actual-end-missing": is_ndpd_actual_end_missing,
+    "st-actual-start-missing": is_st_actual_start_missing,
+}
+
+
+def get_sync_key(mapping):
+    """
+    :return: tuple of SYNC_KEY values, None for the fields missing in the
+    mapping, source and target are always given
+    """
+    return (mapping['source'], mapping['target']) + \
+        tuple(mapping.get(field) for field in SYNC_KEY[2:])
+
+
+def is_rule_matching(rule, sync_key):
+    """
+    :param rule: rule from SYNC_RULES
+    :param sync_key: tuple of SYNC_KEY values
+    :return: True if the "when" part of the rule matches
+    """
+    values = dict(zip(SYNC_KEY, sync_key))
+    for field, expected in rule["when"].items():
+        if field == "same-system":
+            actual = values['source'] == values['target']
+        else:
+            actual = values[field]
+        if actual != expected:
+            return False
+    return True
+
+
+def compile_sync_rules(sync_key, rules=SYNC_RULES):
+    """
+    :param sync_key: tuple of SYNC_KEY values
+    :param rules: rule table, SYNC_RULES by default
+    :return: sync plan, tuple of (rule name, row condition, update actions)
+    for the rules matching sync_key, ending with the first rule which has no
+    row condition
+    """
+    plan = []
+    for rule in rules:
+        if not is_rule_matching(rule, sync_key):
+            continue
+        row_condition = rule.get("row")
+        if row_condition and row_condition not in ROW_CONDITIONS:
+            raise ValueError(f"Unknown row condition {row_condition} in "
+                             f"rule {rule['name']}")
+        plan.append((rule["name"], row_condition, tuple(rule["update"])))
+        if not row_condition:
+            break
+    return tuple(plan)
+
+
+def get_sync_plan(dispatch, mapping, rules=SYNC_RULES):
+    """
+    :param dispatch: dict of {sync key: sync plan}, filled on first use of
+    every sync key
+    :param mapping: mapping json
+    :return: sync plan for the mapping
+    """
+    sync_key = get_sync_key(mapping)
+    plan = dispatch.get(sync_key)
+    if plan is None:
+        plan = dispatch[sync_key] = compile_sync_rules(sync_key, rules)
+    return plan
+
+
+def get_sync_targets(plan, ndpd, site_tracker):
+    """
+    :param plan: sync plan from compile_sync_rules
+    :param ndpd: ndpd values matched with the mapping
+    :param site_tracker: site tracker details matched with the mapping
+    :return: list of update lists ("ndpd" / "st") the mapping goes to
+    """
+    for name, row_condition, updates in plan:
+        if row_condition and \
+                not ROW_CONDITIONS[row_condition](ndpd, site_tracker):
+            continue
+        targets = []
+        if "ndpd-if-older" in updates or "st-if-newer" in updates:
+            ndpd_time = parse_ndpd_time(ndpd['lastModifiedTime'])
+            st_time = parse_ndpd_time(site_tracker['lastModifiedTime'])
+        for update in updates:
+            if update == "ndpd-if-older":
+                if ndpd_time < st_time:
+                    targets.append("ndpd")
+            elif update == "st-if-newer":
+                if ndpd_time > st_time:
+                    targets.append("st")
+            else:
+                targets.append(update)
+        return targets
+    return []
+
+
+def describe_sync_dispatch(dispatch):
+    """
+    :return: {sync key: rule names} of the compiled dispatch, for logging
+    """
+    return {sync_key: [name for name, _, _ in plan]
+            for sync_key, plan in dispatch.items()}
+
+
+def iter_ndpd_st_data(mappings, ndpd_index, st_index, dispatch):
+    """
+    :param mappings: iterable of mapping dicts
+    :param ndpd_index: ndpd rows by get_ndpd_key
+    :param st_index: st rows by get_site_tracker_key
+    :param dispatch: sync plans by sync key, filled while iterating
+    :return: generator of ("ndpd" / "st", update data) for every matched
+    mapping and target
+    """
+    for mapping in mappings:
+        ndpd = ndpd_index.get(get_ndpd_key(mapping), {})
+        site_tracker = st_index.get(get_site_tracker_key(mapping), {})
+        if ndpd and site_tracker:
+            plan = get_sync_plan(dispatch, mapping)
+            for target in get_sync_targets(plan, ndpd, site_tracker):
+                yield target, form_update_data(mapping, ndpd, site_tracker)
+
+
 def get_ndpd_st_data(mappings, ndpd_data, st_data, ibus_obj, logger):
     ndpd_update_data = []
     st_update_data = []
     ibus_obj.logInfo(f"length of total mappings received {len(mappings)}")
     logger.info(f"length of total mappings received {len(mappings)}")
-    for mapping in mappings:
-        ndpd = get_ndpd(mapping, ndpd_data)
-        site_tracker = get_site_tracker(mapping, st_data)
-        if ndpd and site_tracker:
-            if (mapping['source'] == mapping['target']) and (
-                    mapping[
-                        'target-fields'] == "Actual End Date") and (
-                    mapping['ndpd-task-type'] == "Task") and (
-                    ndpd["actualEndTime"] == "null") and (
-                    mapping[
-                        'source-fields'] == "Actual End Date") and (
-                    site_tracker["actualEndTime"] is not None):
-                updated_data = form_update_data(mapping,
-                                                ndpd, site_tracker)
-                ndpd_update_data.append(updated_data)
-            elif (mapping['source'] == mapping['target']) and \
-                    (site_tracker["actualStartTime"] is None and ndpd[
-                        "actualStartTime"]) and \
-                    (mapping['source-fields'] == "Actual End Date"):
-                updated_data = form_update_data(mapping,
-                                                ndpd, site_tracker)
-                st_update_data.append(updated_data)
-            elif mapping['source'] == mapping['target']:
-                if datetime.datetime.strptime(ndpd['lastModifiedTime'],
-                                     "%Y-%m-%d %H:%M:%S.%f") < \
-                        datetime.datetime.strptime(
-                            site_tracker['lastModifiedTime'],
-                            "%Y-%m-%d %H:%M:%S.%f"):
-                    if (mapping['ndpd-task-type'] == "Task") and \
-                            (mapping['target-fields'] == "Actual End Date"):
-                        pass
-                    else:
-                        updated_data = form_update_data(mapping,
-                                                        ndpd, site_tracker)
-                        ndpd_update_data.append(updated_data)
-                if datetime.datetime.strptime(ndpd['lastModifiedTime'],
-                                     "%Y-%m-%d %H:%M:%S.%f") > \
-                        datetime.datetime.strptime(site_tracker['lastModifiedTime'],
-                                          "%Y-%m-%d %H:%M:%S.%f"):
-                    updated_data = form_update_data(mapping,
-                                                    ndpd, site_tracker)
-                    st_update_data.append(updated_data)
-            else:
-                if (mapping['target'] == "NDPD") and (
-                        mapping['source'] == "SiteTracker") and (
-                        mapping['target-fields'] == "Actual End Date") and (
-                        mapping['ndpd-task-type'] == "Task") and (
-                        mapping[
-                            'source-fields'] == "Actual End Date") and (
-                        ndpd["actualEndTime"] == "null") and (
-                        site_tracker["actualEndTime"] is not None):
-                    updated_data = form_update_data(mapping,
-                                                    ndpd, site_tracker)
-                    ndpd_update_data.append(updated_data)
-                else:
-                    if (mapping['target'] == "NDPD") and (
-                            mapping['source'] == "SiteTracker"):
-                        if (mapping['ndpd-task-type'] == "Task") and \
-                                (mapping['target-fields'] == "Actual End Date"):
-                            pass
-                        else:
-                            updated_data = form_update_data(mapping,
-                                                            ndpd, site_tracker)
-                            ndpd_update_data.append(updated_data)
-                    elif (mapping['target'] == "SiteTracker") and (
-                            mapping['source'] == "NDPD"):
-                        updated_data = form_update_data(mapping,
-                                                        ndpd, site_tracker)
-                        st_update_data.append(updated_data)
+    ndpd_index, ndpd_duplicates = build_index(ndpd_data, get_ndpd_key)
+    st_index, st_duplicates = build_index(st_data, get_site_tracker_key)
+    report_duplicate_keys("ndpd", ndpd_duplicates, ibus_obj, logger)
+    report_duplicate_keys("st", st_duplicates, ibus_obj, logger)
+    dispatch = {}
+    for target, updated_data in iter_ndpd_st_data(mappings, ndpd_index,
+                                                  st_index, dispatch):
+        if target == "ndpd":
+            ndpd_update_data.append(updated_data)
+        else:
+            st_update_data.append(updated_data)
+    logger.info(f"sync rules used {describe_sync_dispatch(dispatch)}")
     ibus_obj.logInfo(f"length of ndpd data to update {len(ndpd_update_data)}")
     ibus_obj.logInfo(f"length of st data to update {len(st_update_data)}")
     return ndpd_update_data, st_update_data
 
 
-def get_ndpd_updated_data(ndpd_update_data, logger, ibus_obj):
-    final_ndpd_update_data = []
-    for data in ndpd_update_data:
-        if data['target-fields'] == "Actual End Date":
-            if not data['st-actualEndTime'] or \
-                    data['st-actualEndTime'] == "null" or \
-                    data['st-actualEndTime'] is None or \
-                    data['st-actualEndTime'] == "":
-                ibus_obj.logInfo(
-                    f"sitetracker actual end is null or none so skipping"
-                    f"{data['ndpd-taskName']} - "
-                    f"{data['ndpd-smpId']}")
+def filter_ndpd_update(data, logger, ibus_obj):
+    """
+    :param data: update data from form_update_data
+    :return: data with the dates in site tracker format if ndpd needs the
+    update, otherwise None
+    """
+    if data['target-fields'] == "Actual End Date":
+        if not data['st-actualEndTime'] or \
+                data['st-actualEndTime'] == "null" or \
+                data['st-actualEndTime'] is None or \
+                data['st-actualEndTime'] == "":
+            # one per skipped row, rate limited per LOG_RATE_WINDOW
+            ibus_obj.logInfo(
+                "sitetracker actual end is null or none so skipping"
+                "%s - %s", data['ndpd-taskName'], data['ndpd-smpId'],
+                limit=SKIPPED_ROW_LOG_LIMIT)
+        else:
+            ndpd_date = get_site_tracker_proper_date_format(
+                data['ndpd-actualEndTime'], logger)
+            st_date = get_proper_format(data['st-actualEndTime'], logger)
+            if ndpd_date == st_date and ndpd_date and st_date:
+                pass
+            else:
+                data['ndpd-actualEndTime'] = ndpd_date
+                data['st-actualEndTime'] = st_date
+                return data
+    elif data['target-fields'] == "Forecast Start Date":
+        if not data['st-plannedStartTime'] or \
+                data['st-plannedStartTime'] == "null" or \
+                data['st-plannedStartTime'] is None or \
+                data['st-plannedStartTime'] == "":
+            pass
+        elif data['ndpd-actualEndTime'] == "null" or \
+                data['ndpd-actualEndTime'] == "":
+            ndpd_date = get_site_tracker_proper_date_format(
+                data['ndpd-plannedStartTime'], logger)
+            st_date = get_proper_format(data['st-plannedStartTime'], logger)
+            if ndpd_date == st_date:
                 pass
             else:
-                ndpd_date = get_site_tracker_proper_date_format(
-                    data['ndpd-actualEndTime'], logger)
-                st_date = get_proper_format(data['st-actualEndTime'], logger)
-                if ndpd_date == st_date and ndpd_date and st_date:
-                    pass
-                else:
-                    data['ndpd-actualEndTime'] = ndpd_date
-                    data['st-actualEndTime'] = st_date
-                    final_ndpd_update_data.append(data)
-        elif data['target-fields'] == "Forecast Start Date":
-            if not data['st-plannedStartTime'] or \
-                    data['st-plannedStartTime'] == "null" or \
-                    data['st-plannedStartTime'] is None or \
-                    data['st-plannedStartTime'] == "":
+                data['ndpd-plannedStartTime'] = ndpd_date
+                data['st-plannedStartTime'] = st_date
+                return data
+    return None
+
+
+def filter_st_update(data, logger):
+    """
+    :param data: update data from form_update_data
+    :return: data with the ndpd dates in site tracker format if site tracker
+    needs the update, otherwise None
+    """
+    if data['target-fields'] == "Actual End Date":
+        if not data['ndpd-actualEndTime'] or \
+                data['ndpd-actualEndTime'] == "null" or \
+                data['ndpd-actualEndTime'] is None:
+            pass
+        else:
+            ndpd_date = get_site_tracker_proper_date_format(
+                data['ndpd-actualEndTime'], logger)
+            if ndpd_date == data['st-actualEndTime'] and ndpd_date:
                 pass
-            elif data['ndpd-actualEndTime'] == "null" or \
-                    data['ndpd-actualEndTime'] == "":
-                ndpd_date = get_site_tracker_proper_date_format(
-                    data['ndpd-plannedStartTime'], logger)
-                st_date = get_proper_format(data['st-plannedStartTime'], logger)
-                if ndpd_date == st_date:
-                    pass
-                else:
-                    data['ndpd-plannedStartTime'] = ndpd_date
-                    data['st-plannedStartTime'] = st_date
-                    final_ndpd_update_data.append(data)
             else:
+                data['ndpd-actualEndTime'] = ndpd_date
+                return data
+    elif data['target-fields'] == "Forecast Start Date":
+        if not data['ndpd-plannedStartTime'] or \
+                data['ndpd-plannedStartTime'] == "null" or \
+                data['ndpd-plannedStartTime'] is None:
+            pass
+        elif data['st-actualEndTime'] == "" or \
+                not data['st-actualEndTime'] or \
+                data['st-actualEndTime'] == "null":
+            ndpd_date = get_site_tracker_proper_date_format(
+                data['ndpd-plannedStartTime'], logger)
+            if ndpd_date == data['st-plannedStartTime'] and ndpd_date:
                 pass
+            else:
+                data['ndpd-plannedStartTime'] = ndpd_date
+                return data
+    return None
+
+
+def get_ndpd_updated_data(ndpd_update_data, logger, ibus_obj):
+    final_ndpd_update_data = []
+    for data in ndpd_update_data:
+        data = filter_ndpd_update(data, logger, ibus_obj)
+        if data is not None:
+            final_ndpd_update_data.append(data)
     ibus_obj.logInfo(f"final ndpd data to be updated after all filters "
                      f"{len(final_ndpd_update_data)}")
     return final_ndpd_update_data
@@ -163,35 +356,56 @@ def get_ndpd_updated_data(ndpd_update_data, logger, ibus_obj):
 def get_st_updated_data(st_update_data, logger, ibus_obj):
     final_st_update_data = []
     for data in st_update_data:
-        if data['target-fields'] == "Actual End Date":
-            if not data['ndpd-actualEndTime'] or \
-                    data['ndpd-actualEndTime'] == "null" or \
-                    data['ndpd-actualEndTime'] is None:
-                pass
-            else:
-                ndpd_date = get_site_tracker_proper_date_format(
-                    data['ndpd-actualEndTime'], logger)
-                if ndpd_date == data['st-actualEndTime'] and ndpd_date:
-                    pass
-                else:
-                    data['ndpd-actualEndTime'] = ndpd_date
-                    final_st_update_data.append(data)
-        elif data['target-fields'] == "Forecast Start Date":
-            if not data['ndpd-plannedStartTime'] or \
-                    data['ndpd-plannedStartTime'] == "null" or \
-                    data['ndpd-plannedStartTime'] is None:
-                pass
-            elif data['st-actualEndTime'] == "" or \
-                    not data['st-actualEndTime'] or \
-                    data['st-actualEndTime'] == "null":
-                ndpd_date = get_site_tracker_proper_date_format(
-                    data['ndpd-plannedStartTime'], logger)
-                if ndpd_date == data['st-plannedStartTime'] and ndpd_date:
-                    pass
-                else:
-                    data['ndpd-plannedStartTime'] = ndpd_date
-                    final_st_update_data.append(data)
-            else:
-                pass
+        data = filter_st_update(data, logger)
+        if data is not None:
+            final_st_update_data.append(data)
     ibus_obj.logInfo(f"length of final st data to be updated {len(final_st_update_data)}")
     return final_st_update_data
+
+
+def stream_ndpd_st_data(mappings, ndpd_data, st_data, ibus_obj, logger):
+    """
+    Streaming version of get_ndpd_st_data + get_ndpd_updated_data +
+    get_st_updated_data. Only the ndpd and st indexes are kept in memory,
+    mappings are joined one by one and only the rows left after the filters
+    are collected.
+    :param mappings: iterable of mapping dicts, ex: from iter_json_array
+    :param ndpd_data: iterable of ndpd dicts
+    :param st_data: iterable of st dicts
+    :return: final ndpd update data, final st update data
+    """
+    ndpd_index, ndpd_duplicates = build_index(ndpd_data, get_ndpd_key)
+    st_index, st_duplicates = build_index(st_data, get_site_tracker_key)
+    report_duplicate_keys("ndpd", ndpd_duplicates, ibus_obj, logger)
+    report_duplicate_keys("st", st_duplicates, ibus_obj, logger)
+    final_ndpd_update_data = []
+    final_st_update_data = []
+    counts = {"mappings": 0, "ndpd": 0, "st": 0}
+
+    def count_mappings():
+        for mapping in mappings:
+            counts["mappings"] += 1
+            yield mapping
+
+    dispatch = {}
+    for target, data in iter_ndpd_st_data(count_mappings(), ndpd_index,
+                                          st_index, dispatch):
+        counts[target] += 1
+        if target == "ndpd":
+            data = filter_ndpd_update(data, logger, ibus_obj)
+            if data is not None:
+                final_ndpd_update_data.append(data)
+        else:
+            data = filter_st_update(data, logger)
+            if data is not None:
+                final_st_update_data.append(data)
+    logger.info(f"sync rules used {describe_sync_dispatch(dispatch)}")
+    ibus_obj.logInfo(f"length of total mappings received {counts['mappings']}")
+    logger.info(f"length of total mappings received {counts['mappings']}")
+    ibus_obj.logInfo(f"length of ndpd data to update {counts['ndpd']}")
+    ibus_obj.logInfo(f"length of st data to update {counts['st']}")
+    ibus_obj.logInfo(f"final ndpd data to be updated after all filters "
+                     f"{len(final_ndpd_update_data)}")
+    ibus_obj.logInfo(f"length of final st data to be updated "
+                     f"{len(final_st_update_data)}")
+    return final_ndpd_update_data, final_st_update_data
@@ -0,0 +1,283 @@
+"""
+Vectorized compare engine, selected with "Compare-Engine": "pandas" in the
+/compare-ndpd-st-data input json. It gives the same update lists as the loops
+in compare.py, but joins mappings with NDPD and ST data using DataFrame merges
+and evaluates the branching rules as boolean masks.
+"""
+import pandas as pd
+
+from compare import SYNC_KEY, compile_sync_rules, form_update_data
+from date_utils import parse_ndpd_time, parse_st_date
+
+ACTUAL_END_DATE = "Actual End Date"
+FORECAST_START_DATE = "Forecast Start Date"
+NDPD_TIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+ST_DATE_FORMAT = "%Y-%m-%d"
+# strings pd.to_datetime parses like datetime.strptime, it also takes more
+# than 6 fraction digits and other shapes strptime rejects or reads
+# differently, those values go through the date_utils parsers
+DATE_PATTERNS = {
+    NDPD_TIME_FORMAT: (r"[0-9]{4}-[0-9]{2}-[0-9]{2} [0-9]{2}:[0-9]{2}:"
+                       r"[0-9]{2}\.[0-9]{1,6}", parse_ndpd_time),
+    ST_DATE_FORMAT: (r"[0-9]{4}-[0-9]{2}-[0-9]{2}", parse_st_date)
+}
+
+NDPD_KEYS = ['ndpd-projectId', 'ndpd-smpId', 'ndpd-moduleId', 'ndpd-taskName']
+ST_KEYS = ['st-projectId', 'st-milestoneName']
+MAPPING_COLUMNS = NDPD_KEYS + ST_KEYS + [
+    'source', 'target', 'source-fields', 'target-fields', 'ndpd-task-type']
+TIME_COLUMNS = ['actualStartTime', 'actualEndTime', 'lastModifiedTime']
+
+
+def get_frame(data_list, columns):
+    """
+    :param data_list: list of dicts
+    :param columns: keys to load
+    :return: DataFrame keeping None values as they are, with the position of
+    every dict in data_list in the '_pos' column
+    """
+    rows = [(position, data) for position, data in enumerate(data_list)
+            if data]
+    frame = pd.DataFrame({
+        column: pd.Series([data.get(column) for _, data in rows],
+                          dtype=object)
+        for column in columns})
+    frame['_pos'] = [position for position, _ in rows]
+    return frame
+
+
+def is_truthy(series):
+    return series.map(bool).astype(bool)
+
+
+def is_equal(left, right):
+    """Element wise ==, treating None == None as True like python does"""
+    return (left == right) | (left.isna() & right.isna())
+
+
+def is_text(series):
+    return series.map(lambda value: isinstance(value, str)).astype(bool)
+
+
+def parse_date(value, parser):
+    try:
+        return parser(value)
+    except ValueError:
+        return pd.NaT
+
+
+def parse_dates(series, date_format):
+    """
+    :return: datetime series, NaT where the value is not a date string in
+    date_format, the same values as datetime.strptime
+    """
+    pattern, parser = DATE_PATTERNS[date_format]
+    text = is_text(series)
+    strict = text.copy()
+    strict[text] = series[text].str.match(pattern + r"\Z").astype(bool)
+    dates = pd.to_datetime(series.where(strict), format=date_format,
+                           errors='coerce').astype('datetime64[ns]')
+    other = text & ~strict
+    if other.any():
+        dates[other] = pd.to_datetime(pd.Series(
+            [parse_date(value, parser) for value in series[other]],
+            index=series.index[other], dtype=object)).astype('datetime64[ns]')
+    return dates
+
+
+def format_dates(series, date_format):
+    """
+    Vectorized get_site_tracker_proper_date_format / get_proper_format
+    :return: series of "%Y-%m-%d" strings, NaN where the value is not a date
+    in date_format
+    """
+    return parse_dates(series, date_format).dt.strftime(ST_DATE_FORMAT)
+
+
+def as_value(value):
+    return value if isinstance(value, str) else None
+
+
+def get_first_rows(frame, keys, name, ibus_obj, logger):
+    """
+    Keeps the first row for every key, same as get_ndpd / get_site_tracker
+    and reports the duplicate keys
+    """
+    duplicated = frame.duplicated(subset=keys, keep=False)
+    if duplicated.any():
+        counts = frame[duplicated].groupby(keys, sort=False).size()
+        message = f"{len(counts)} duplicate {name} keys found, using first " \
+                  f"match for each -- {list(counts.items())[:10]}"
+        ibus_obj.logWarning(message)
+        logger.warning(message)
+    return frame[~frame.duplicated(subset=keys, keep='first')]
+
+
+def get_ndpd_st_data(mappings, ndpd_data, st_data, ibus_obj, logger):
+    ibus_obj.logInfo(f"length of total mappings received {len(mappings)}")
+    logger.info(f"length of total mappings received {len(mappings)}")
+    mapping_frame = get_frame(mappings, MAPPING_COLUMNS)
+    ndpd_frame = get_frame(ndpd_data, NDPD_KEYS + TIME_COLUMNS)
+    st_frame = get_frame(st_data, ST_KEYS + TIME_COLUMNS)
+    for frame in (mapping_frame, ndpd_frame):
+        frame['_task'] = frame['ndpd-taskName'].astype(str).str.lower()
+    ndpd_keys = NDPD_KEYS[:-1] + ['_task']
+    ndpd_frame = get_first_rows(ndpd_frame, ndpd_keys, "ndpd",
+                                ibus_obj, logger)
+    st_frame = get_first_rows(st_frame, ST_KEYS, "st", ibus_obj, logger)
+
+    ndpd_frame = ndpd_frame[ndpd_keys + TIME_COLUMNS + ['_pos']].rename(
+        columns={column: 'ndpd:' + column
+                 for column in TIME_COLUMNS + ['_pos']})
+    st_frame = st_frame[ST_KEYS + TIME_COLUMNS + ['_pos']].rename(
+        columns={column: 'st:' + column
+                 for column in TIME_COLUMNS + ['_pos']})
+    merged = mapping_frame.merge(ndpd_frame, how='left', on=ndpd_keys)
+    merged = merged.merge(st_frame, how='left', on=ST_KEYS)
+
+    found = merged['ndpd:_pos'].notna() & merged['st:_pos'].notna()
+    row_conditions = {
+        "ndpd-actual-end-missing":
+            (merged['ndpd:actualEndTime'] == "null") &
+            merged['st:actualEndTime'].notna(),
+        "st-actual-start-missing":
+            merged['st:actualStartTime'].isna() &
+            is_truthy(merged['ndpd:actualStartTime'])
+    }
+    ndpd_time = parse_dates(merged['ndpd:lastModifiedTime'], NDPD_TIME_FORMAT)
+    st_time = parse_dates(merged['st:lastModifiedTime'], NDPD_TIME_FORMAT)
+    ndpd_older = ndpd_time < st_time
+    ndpd_newer = ndpd_time > st_time
+
+    # every sync key gets its compiled sync plan, the plan steps are then
+    # applied to all rows of that key at once
+    sync_keys, plan_keys = pd.factorize(pd.Series(
+        list(zip(*[merged[field] for field in SYNC_KEY])), dtype=object))
+    ndpd_mask = pd.Series(False, index=merged.index)
+    st_mask = pd.Series(False, index=merged.index)
+    time_needed = pd.Series(False, index=merged.index)
+    for code, sync_key in enumerate(plan_keys):
+        remaining = found & (sync_keys == code)
+        for name, row_condition, updates in compile_sync_rules(sync_key):
+            matched = remaining & row_conditions[row_condition] \
+                if row_condition else remaining
+            remaining = remaining & ~matched
+            for update in updates:
+                if update == "ndpd":
+                    ndpd_mask |= matched
+                elif update == "st":
+                    st_mask |= matched
+                elif update == "ndpd-if-older":
+                    ndpd_mask |= matched & ndpd_older
+                    time_needed |= matched
+                elif update == "st-if-newer":
+                    st_mask |= matched & ndpd_newer
+                    time_needed |= matched
+    invalid_time = time_needed & (ndpd_time.isna() | st_time.isna())
+    if invalid_time.any():
+        row = merged[invalid_time].iloc[0]
+        value = row['ndpd:lastModifiedTime'] if pd.isna(
+            ndpd_time[invalid_time].iloc[0]) else row['st:lastModifiedTime']
+        # same error as the loop engine
+        parse_ndpd_time(value)
+        raise ValueError(f"time data {value!r} does not match format "
+                         f"{NDPD_TIME_FORMAT!r}")
+
+    positions = ['_pos', 'ndpd:_pos', 'st:_pos']
+    ndpd_update_data = [
+        form_update_data(mappings[int(m)], ndpd_data[int(n)], st_data[int(s)])
+        for m, n, s in merged.loc[ndpd_mask, positions].itertuples(
+            index=False)]
+    st_update_data = [
+        form_update_data(mappings[int(m)], ndpd_data[int(n)], st_data[int(s)])
+        for m, n, s in merged.loc[st_mask, positions].itertuples(
+            index=False)]
+    ibus_obj.logInfo(f"length of ndpd data to update {len(ndpd_update_data)}")
+    ibus_obj.logInfo(f"length of st data to update {len(st_update_data)}")
+    return ndpd_update_data, st_update_data
+
+
+def get_ndpd_updated_data(ndpd_update_data, logger, ibus_obj):
+    frame = get_frame(ndpd_update_data, [
+        'target-fields', 'ndpd-actualEndTime', 'ndpd-plannedStartTime',
+        'st-actualEndTime', 'st-plannedStartTime'])
+    actual_end = frame['target-fields'] == ACTUAL_END_DATE
+    forecast_start = frame['target-fields'] == FORECAST_START_DATE
+    st_actual_end_empty = ~is_truthy(frame['st-actualEndTime']) | \
+        (frame['st-actualEndTime'] == "null")
+    st_planned_start_empty = ~is_truthy(frame['st-plannedStartTime']) | \
+        (frame['st-plannedStartTime'] == "null")
+    ndpd_actual_end_blank = (frame['ndpd-actualEndTime'] == "null") | \
+        (frame['ndpd-actualEndTime'] == "")
+
+    ndpd_actual_end = format_dates(frame['ndpd-actualEndTime'],
+                                   NDPD_TIME_FORMAT)
+    st_actual_end = format_dates(frame['st-actualEndTime'], ST_DATE_FORMAT)
+    ndpd_planned_start = format_dates(frame['ndpd-plannedStartTime'],
+                                      NDPD_TIME_FORMAT)
+    st_planned_start = format_dates(frame['st-plannedStartTime'],
+                                    ST_DATE_FORMAT)
+
+    update_actual_end = actual_end & ~st_actual_end_empty & ~(
+        (ndpd_actual_end == st_actual_end) & ndpd_actual_end.notna())
+    update_forecast_start = forecast_start & ~st_planned_start_empty & \
+        ndpd_actual_end_blank & ~is_equal(ndpd_planned_start,
+                                          st_planned_start)
+    skipped = int((actual_end & st_actual_end_empty).sum())
+    if skipped:
+        ibus_obj.logInfo(f"sitetracker actual end is null or none so "
+                         f"skipping {skipped} rows")
+
+    final_ndpd_update_data = []
+    for index in frame.index[update_actual_end | update_forecast_start]:
+        data = ndpd_update_data[frame.at[index, '_pos']]
+        if update_actual_end[index]:
+            data['ndpd-actualEndTime'] = as_value(ndpd_actual_end[index])
+            data['st-actualEndTime'] = as_value(st_actual_end[index])
+        else:
+            data['ndpd-plannedStartTime'] = as_value(
+                ndpd_planned_start[index])
+            data['st-plannedStartTime'] = as_value(st_planned_start[index])
+        final_ndpd_update_data.append(data)
+    ibus_obj.logInfo(f"final ndpd data to be updated after all filters "
+                     f"{len(final_ndpd_update_data)}")
+    return final_ndpd_update_data
+
+
+def get_st_updated_data(st_update_data, logger, ibus_obj):
+    frame = get_frame(st_update_data, [
+        'target-fields', 'ndpd-actualEndTime', 'ndpd-plannedStartTime',
+        'st-actualEndTime', 'st-plannedStartTime'])
+    actual_end = frame['target-fields'] == ACTUAL_END_DATE
+    forecast_start = frame['target-fields'] == FORECAST_START_DATE
+    ndpd_actual_end_empty = ~is_truthy(frame['ndpd-actualEndTime']) | \
+        (frame['ndpd-actualEndTime'] == "null")
+    ndpd_planned_start_empty = ~is_truthy(frame['ndpd-plannedStartTime']) | \
+        (frame['ndpd-plannedStartTime'] == "null")
+    st_actual_end_blank = ~is_truthy(frame['st-actualEndTime']) | \
+        (frame['st-actualEndTime'] == "null")
+
+    ndpd_actual_end = format_dates(frame['ndpd-actualEndTime'],
+                                   NDPD_TIME_FORMAT)
+    ndpd_planned_start = format_dates(frame['ndpd-plannedStartTime'],
+                                      NDPD_TIME_FORMAT)
+
+    update_actual_end = actual_end & ~ndpd_actual_end_empty & ~(
+        (ndpd_actual_end == frame['st-actualEndTime']) &
+        ndpd_actual_end.notna())
+    update_forecast_start = forecast_start & ~ndpd_planned_start_empty & \
+        st_actual_end_blank & ~(
+            (ndpd_planned_start == frame['st-plannedStartTime']) &
+            ndpd_planned_start.notna())
+
+    final_st_update_data = []
+    for index in frame.index[update_actual_end | update_forecast_start]:
+        data = st_update_data[frame.at[index, '_pos']]
+        if update_actual_end[index]:
+            data['ndpd-actualEndTime'] = as_value(ndpd_actual_end[index])
+        else:
+            data['ndpd-plannedStartTime'] = as_value(
+                ndpd_planned_start[index])
+        final_st_update_data.append(data)
+    ibus_obj.logInfo(f"length of final st data to be updated {len(final_st_update_data)}")
+    return final_st_update_data
@@ -0,0 +1,56 @@
+"""
+Parsing of the fixed date formats used by NDPD and Site Tracker.
+
+NDPD times look like "2020-05-01 10:20:30.123" and Site Tracker dates like
+"2020-05-01". Values in that exact shape are sliced instead of going through
+datetime.strptime, anything else falls back to strptime so the result (or the
+error raised) stays the same. Parsed values are kept in a bounded LRU cache,
+the same dates are seen many times by compare, the filters and the update
+stages.
+"""
+from datetime import datetime
+from functools import lru_cache
+
+NDPD_TIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+ST_DATE_FORMAT = "%Y-%m-%d"
+DATE_CACHE_SIZE = 65536
+
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def parse_ndpd_time(value):
+    """
+    :param value: NDPD time string ex: "2020-05-01 10:20:30.123"
+    :return: datetime, same as datetime.strptime(value, NDPD_TIME_FORMAT)
+    """
+    if isinstance(value, str) and 21 <= len(value) <= 26 and \
+            value[4] == '-' and value[7] == '-' and value[10] == ' ' and \
+            value[13] == ':' and value[16] == ':' and value[19] == '.':
+        digits = value[:4] + value[5:7] + value[8:10] + value[11:13] + \
+            value[14:16] + value[17:19] + value[20:]
+        if digits.isdigit():
+            try:
+                return datetime(int(value[:4]), int(value[5:7]),
+                                int(value[8:10]), int(value[11:13]),
+                                int(value[14:16]), int(value[17:19]),
+                                int(value[20:].ljust(6, '0')))
+            except ValueError:
+                pass
+    return datetime.strptime(value, NDPD_TIME_FORMAT)
+
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def parse_st_date(value):
+    """
+    :param value: Site Tracker date string ex: "2020-05-01"
+    :return: datetime, same as datetime.strptime(value, ST_DATE_FORMAT)
+    """
+    if isinstance(value, str) and len(value) == 10 and \
+            value[4] == '-' and value[7] == '-':
+        digits = value[:4] + value[5:7] + value[8:]
+        if digits.isdigit():
+            try:
+                return datetime(int(value[:4]), int(value[5:7]),
+                                int(value[8:]))
+            except ValueError:
+                pass
+    return datetime.strptime(value, ST_DATE_FORMAT)
@@ -0,0 +1,68 @@
+"""
+Worker pools of the process, created on first use in each gunicorn worker
+and shared by all its requests instead of a multiprocessing.Pool per
+request. EXECUTOR_THREADS and EXECUTOR_PROCESSES are the concurrency budget
+of the whole worker, the items of concurrent requests wait in the same pool.
+
+THREAD is for I/O-bound work, api calls and queries, PROCESS for CPU-bound
+work. Both pools have the multiprocessing.Pool api.
+
+The processes are started by a forkserver, a fork of the threaded wsgi
+worker could copy a lock held by another thread and deadlock, so the
+functions and their arguments must be picklable module level objects.
+"""
+import multiprocessing
+import os
+import threading
+from multiprocessing.pool import ThreadPool
+
+from setting import EXECUTOR_PROCESSES, EXECUTOR_THREADS
+
+THREAD = 'thread'
+PROCESS = 'process'
+START_METHOD = 'forkserver' \
+    if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+pools = {}
+pools_lock = threading.Lock()
+
+
+def get_pool(backend):
+    """
+    :param backend: THREAD or PROCESS
+    :return: shared pool of the backend, do not close or terminate it
+    """
+    if backend not in (THREAD, PROCESS):
+        raise ValueError(f"Unknown executor backend {backend}")
+    with pools_lock:
+        pool = pools.get(backend)
+        if pool is None:
+            pool = pools[backend] = ThreadPool(EXECUTOR_THREADS) \
+                if backend == THREAD else multiprocessing.get_context(
+                    START_METHOD).Pool(EXECUTOR_PROCESSES)
+        return pool
+
+
+def get_pool_size(backend):
+    """:return: number of workers of the backend's pool"""
+    if backend == THREAD:
+        return EXECUTOR_THREADS
+    return EXECUTOR_PROCESSES or os.cpu_count() or 1
+
+
+def map_items(backend, func, items):
+    """:return: pool.map(func, items) on the shared pool of backend"""
+    if not items:
+        return []
+    return get_pool(backend).map(func, items)
+
+
+def reset_pools():
+    """Forked children don't get the pool threads, they create new pools"""
+    global pools, pools_lock
+    pools = {}
+    pools_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_pools)
@@ -0,0 +1,138 @@
+"""
+Connection pooled requests session for the iBus workflow-manager and
+digimop-logger calls. It is shared by all the threads of the process, so
+uploads, downloads and live logs reuse keep-alive connections instead of
+opening a new TCP + TLS connection per call. Failed connection attempts are
+retried with backoff; nothing was sent yet, so POSTs are retried too.
+
+MultipartFileBody streams a file upload, requests would build the whole
+multipart body in memory.
+"""
+import gzip
+import os
+import shutil
+import tempfile
+import uuid
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from setting import (IBUS_CONNECT_RETRIES, IBUS_GZIP_LEVEL,
+                     IBUS_POOL_CONNECTIONS, IBUS_POOL_MAXSIZE,
+                     IBUS_RETRY_BACKOFF, IBUS_TRANSFER_CHUNK_SIZE)
+
+session = None
+
+
+def create_session():
+    """:return: requests session with the pooled, retrying adapters"""
+    new_session = requests.Session()
+    retries = Retry(total=IBUS_CONNECT_RETRIES, connect=IBUS_CONNECT_RETRIES,
+                    read=0, status=0, backoff_factor=IBUS_RETRY_BACKOFF)
+    adapter = HTTPAdapter(pool_connections=IBUS_POOL_CONNECTIONS,
+                          pool_maxsize=IBUS_POOL_MAXSIZE,
+                          max_retries=retries)
+    new_session.mount('http://', adapter)
+    new_session.mount('https://', adapter)
+    return new_session
+
+
+def reset_session():
+    """Forked children open their own connections"""
+    global session
+    session = create_session()
+
+
+def get_session():
+    return session
+
+
+class MultipartFileBody:
+    """
+    multipart/form-data body with one file part, read from the file in
+    IBUS_TRANSFER_CHUNK_SIZE chunks while it is sent. Its length is known,
+    so the request has a Content-Length and no chunked encoding.
+
+    With compress the whole body is gzipped into a temporary file first and
+    has to be sent with the headers of get_headers (Content-Encoding: gzip).
+    Use it as a context manager, the files are closed on exit.
+    """
+
+    def __init__(self, field, file_path, compress=False):
+        self.boundary = uuid.uuid4().hex
+        self.compress = compress
+        filename = os.path.basename(file_path)
+        self.head = (f'--{self.boundary}\r\nContent-Disposition: form-data; '
+                     f'name="{field}"; filename="{filename}"\r\n\r\n'
+                     ).encode()
+        self.tail = f'\r\n--{self.boundary}--\r\n'.encode()
+        self.file = open(file_path, 'rb')
+        if compress:
+            self.file = self.gzip_body(self.file)
+            self.head = self.tail = b''
+        self.length = len(self.head) + os.fstat(self.file.fileno()).st_size \
+            + len(self.tail)
+        self.parts = [self.head, self.file, self.tail]
+
+    def gzip_body(self, file):
+        """:return: temporary file with the gzipped body, file is closed"""
+        compressed = tempfile.TemporaryFile()
+        try:
+            with file, gzip.GzipFile(fileobj=compressed, mode='wb',
+                                     compresslevel=IBUS_GZIP_LEVEL) as body:
+                body.write(self.head)
+                shutil.copyfileobj(file, body, IBUS_TRANSFER_CHUNK_SIZE)
+                body.write(self.tail)
+        except Exception:
+            compressed.close()
+            raise
+        compressed.seek(0)
+        return compressed
+
+    def get_headers(self):
+        """:return: headers to send the body with"""
+        headers = {"content-type":
+                   f"multipart/form-data; boundary={self.boundary}"}
+        if self.compress:
+            headers["content-encoding"] = "gzip"
+        return headers
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.length
+        data = b''
+        while self.parts and len(data) < size:
+            part = self.parts[0]
+            if isinstance(part, bytes):
+                chunk, self.parts[0] = part[:size - len(data)], \
+                    part[size - len(data):]
+            else:
+                chunk = part.read(size - len(data))
+            if not chunk:
+                self.parts.pop(0)
+            data += chunk
+        return data
+
+    def __iter__(self):
+        chunk = self.read(IBUS_TRANSFER_CHUNK_SIZE)
+        while chunk:
+            yield chunk
+            chunk = self.read(IBUS_TRANSFER_CHUNK_SIZE)
+
+    def __len__(self):
+        return self.length
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+reset_session()
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_session)
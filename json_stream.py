@@ -0,0 +1,130 @@
+"""
+Incremental reading of the large json artifacts passed between stages
+(Mapping-Json, Ndpd-Data, ST-Data). These files are one json object holding
+big arrays, ex: {"mappings": [...], "invalidsmps": [...]}. iter_json_array
+yields the items of one of those arrays while reading the file in chunks, so
+the whole file is never held in memory.
+"""
+import json
+
+CHUNK_SIZE = 1024 * 1024
+WHITESPACE = ' \t\n\r'
+NUMBER_CHARS = '0123456789+-.eE'
+
+decoder = json.JSONDecoder()
+
+
+class JsonStreamReader:
+    """Reads json values one by one from a file opened in text mode"""
+
+    def __init__(self, fp, chunk_size=CHUNK_SIZE):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """
+        :return: False at the end of the file, otherwise reads one more chunk
+        and drops the part of the buffer which is already consumed
+        """
+        chunk = self.fp.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """:return: next character which is not whitespace"""
+        while True:
+            while self.pos < len(self.buffer) and \
+                    self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                raise ValueError("Unexpected end of json data")
+
+    def next_char(self):
+        char = self.peek()
+        self.pos += 1
+        return char
+
+    def expect(self, expected):
+        char = self.next_char()
+        if char != expected:
+            raise ValueError(f"Expecting {expected!r} but found {char!r} in "
+                             f"json data")
+
+    def decode(self):
+        """:return: next json value"""
+        self.peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                # value is cut at the end of the buffer
+                if self.fill():
+                    continue
+                raise
+            # a number at the end of the buffer may go on in the next chunk
+            if isinstance(value, (int, float)) and not self.eof and \
+                    not self.buffer[end:].lstrip(NUMBER_CHARS) and \
+                    self.fill():
+                continue
+            self.pos = end
+            return value
+
+    def iter_array(self):
+        """Yields the items of the json array starting at the current position"""
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.decode()
+            char = self.next_char()
+            if char == ']':
+                return
+            if char != ',':
+                raise ValueError(f"Expecting ',' or ']' but found {char!r} "
+                                 f"in json data")
+
+    def skip_value(self):
+        """Skips the next json value without building big arrays in memory"""
+        if self.peek() == '[':
+            for _ in self.iter_array():
+                pass
+        else:
+            self.decode()
+
+
+def iter_json_array(file_path, key, chunk_size=CHUNK_SIZE):
+    """
+    :param file_path: json file holding one object
+    :param key: key of the array in the top level object
+    :param chunk_size: number of characters read at once
+    :return: generator of the array items, raises KeyError if the key is not
+    in the file
+    """
+    with open(file_path, 'r') as fp:
+        reader = JsonStreamReader(fp, chunk_size)
+        reader.expect('{')
+        if reader.peek() == '}':
+            raise KeyError(key)
+        while True:
+            name = reader.decode()
+            reader.expect(':')
+            if name == key:
+                yield from reader.iter_array()
+                return
+            reader.skip_value()
+            char = reader.next_char()
+            if char == '}':
+                raise KeyError(key)
+            if char != ',':
+                raise ValueError(f"Expecting ',' or '}}' but found {char!r} "
+                                 f"in json data")
@@ -0,0 +1,159 @@
+"""
+Background shipping of the IBusPlatformInterface live logs. logInfo and the
+other log calls only queue the record, a thread of the process posts the
+queued records to the digimop-logger service in batches of
+LIVE_LOG_BATCH_SIZE, or of what is queued after LIVE_LOG_FLUSH_INTERVAL
+seconds. The logger api takes one record per request, a batch is posted
+record by record on the pooled session of http_session.py.
+
+A record repeating the last queued one, but for its timestamp, is counted
+on it instead of queued. With LIVE_LOG_QUEUE_SIZE records waiting any other
+record is dropped, the number of dropped records is sent as a warning with
+the next batch.
+"""
+import atexit
+import json
+import os
+import threading
+import time
+from collections import deque
+
+from http_session import get_session
+from setting import (LIVE_LOG_BATCH_SIZE, LIVE_LOG_FLUSH_INTERVAL,
+                     LIVE_LOG_FLUSH_TIMEOUT, LIVE_LOG_QUEUE_SIZE,
+                     LIVE_LOG_REQUEST_TIMEOUT)
+
+
+class LiveLogShipper:
+
+    def __init__(self, queue_size=LIVE_LOG_QUEUE_SIZE,
+                 batch_size=LIVE_LOG_BATCH_SIZE,
+                 flush_interval=LIVE_LOG_FLUSH_INTERVAL):
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.reset()
+
+    def reset(self):
+        """Fresh state, also for forked children, they have no thread"""
+        self.condition = threading.Condition()
+        self.records = deque()
+        # queued records + records of the batch being sent
+        self.pending = 0
+        self.dropped = 0
+        self.flush_requests = 0
+        self.thread = None
+
+    def put(self, url, get_token, record):
+        """
+        Queues a live log record
+        :param url: digimop-logger url to post the record to
+        :param get_token: returns the bearer token when the record is sent
+        :param record: live log json
+        :return: False if the record was dropped
+        """
+        with self.condition:
+            if self.records:
+                last = self.records[-1]
+                if last['url'] == url and \
+                        dict(last['record'], timestamp=None) == \
+                        dict(record, timestamp=None):
+                    last['count'] += 1
+                    return True
+            if len(self.records) >= self.queue_size:
+                self.dropped += 1
+                return False
+            self.records.append({'url': url, 'get_token': get_token,
+                                 'record': record, 'count': 1})
+            self.pending += 1
+            self.start()
+            if len(self.records) >= self.batch_size:
+                self.condition.notify_all()
+        return True
+
+    def start(self):
+        """Starts the thread, called with the condition held"""
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.run, daemon=True,
+                                           name='live_log_shipper')
+            self.thread.start()
+
+    def next_batch(self):
+        """
+        Waits for LIVE_LOG_BATCH_SIZE records, the flush interval or a flush
+        :return: records to send, number of records dropped since the last
+        batch
+        """
+        with self.condition:
+            while not self.records:
+                self.condition.wait()
+            flush_at = time.time() + self.flush_interval
+            while len(self.records) < self.batch_size and \
+                    not self.flush_requests:
+                remaining = flush_at - time.time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            batch = [self.records.popleft() for _ in
+                     range(min(self.batch_size, len(self.records)))]
+            dropped, self.dropped = self.dropped, 0
+        return batch, dropped
+
+    def run(self):
+        while True:
+            batch, dropped = self.next_batch()
+            if dropped:
+                batch.append(dict(batch[0], count=1, record=dict(
+                    batch[0]['record'], severity="WARN",
+                    message=f"{dropped} live log records were dropped, the "
+                            f"live log queue was full")))
+            try:
+                for item in batch:
+                    self.send(item)
+            finally:
+                with self.condition:
+                    self.pending -= len(batch) - (1 if dropped else 0)
+                    self.condition.notify_all()
+
+    def send(self, item):
+        record = item['record']
+        if item['count'] > 1:
+            record = dict(record, message=f"{record['message']} (repeated "
+                                          f"{item['count']} times)")
+        try:
+            response = get_session().post(
+                url=item['url'], data=json.dumps(record),
+                headers={"authorization": "Bearer " + item['get_token'](),
+                         "content-type": "application/json"},
+                timeout=LIVE_LOG_REQUEST_TIMEOUT)
+            if response.status_code != 200:
+                print("UPLOAD_LIVE_LOG : Status Code ={}".format(
+                    response.status_code))
+        except Exception as e:
+            print("UPLOAD_LIVE_LOG : Error in uploading live log: " + str(e))
+
+    def flush(self, timeout=LIVE_LOG_FLUSH_TIMEOUT):
+        """
+        Sends the queued records now and waits until they are sent
+        :return: False if they were not all sent within timeout seconds
+        """
+        end = time.time() + timeout
+        with self.condition:
+            self.flush_requests += 1
+            self.condition.notify_all()
+            try:
+                while self.pending:
+                    remaining = end - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.condition.wait(remaining)
+            finally:
+                self.flush_requests -= 1
+        return True
+
+
+shipper = LiveLogShipper()
+atexit.register(shipper.flush)
+if hasattr(os, 'register_at_fork'):
+    # pool workers don't get the thread, nor a lock held at fork time
+    os.register_at_fork(after_in_child=shipper.reset)
@@ -0,0 +1,125 @@
+"""
+Progress of long running @async_task tasks, kept in Redis next to the task
+record so that the pool workers of the update stages can report the rows
+they finish and /OperationStatus can return the counts while the task runs.
+
+The counts are added up in the process and sent every
+PROGRESS_FLUSH_INTERVAL seconds or PROGRESS_FLUSH_ROWS rows, the stage sends
+the rest with flush_progress when its rows are done.
+"""
+import threading
+import time
+
+from setting import (PROGRESS_FLUSH_INTERVAL, PROGRESS_FLUSH_ROWS,
+                     TASK_PROGRESS_KEY_PREFIX, TASK_RECORD_TTL, TASKS)
+
+# {task id: [processed, succeeded, failed, warnings, sent at]} of the counts
+# not sent yet, shared by the pool threads of the process
+pending_progress = {}
+pending_lock = threading.Lock()
+
+
+def get_progress_key(task_id):
+    return TASK_PROGRESS_KEY_PREFIX + task_id
+
+
+def start_progress(task_id, total):
+    """
+    :param task_id: id of the running task, None outside of @async_task
+    :param total: number of rows the task is going to process
+    """
+    if not task_id:
+        return
+    progress_key = get_progress_key(task_id)
+    now = time.time()
+    pipeline = TASKS.pipeline()
+    pipeline.delete(progress_key)
+    pipeline.hmset(progress_key, {'total': total, 'processed': 0,
+                                  'succeeded': 0, 'failed': 0, 'warnings': 0,
+                                  'started_at': now, 'updated_at': now})
+    pipeline.expire(progress_key, TASK_RECORD_TTL)
+    pipeline.execute()
+
+
+def report_progress(task_id, processed, succeeded=0, failed=0, warnings=0):
+    """
+    Adds the counts of finished rows, called from the pool workers, they
+    are sent with the counts of the other rows of the task once
+    PROGRESS_FLUSH_ROWS rows are done or PROGRESS_FLUSH_INTERVAL seconds
+    have passed
+    """
+    if not task_id:
+        return
+    now = time.time()
+    with pending_lock:
+        pending = pending_progress.setdefault(task_id, [0, 0, 0, 0, now])
+        for position, count in enumerate((processed, succeeded, failed,
+                                          warnings)):
+            pending[position] += count
+        if pending[0] < PROGRESS_FLUSH_ROWS and \
+                now - pending[4] < PROGRESS_FLUSH_INTERVAL:
+            return
+        pending_progress[task_id] = [0, 0, 0, 0, now]
+    send_progress(task_id, *pending[:4])
+
+
+def flush_progress(task_id):
+    """
+    Sends the counts of the task not sent yet, and those of other tasks
+    waiting longer than PROGRESS_FLUSH_INTERVAL, e.g. of rows which finished
+    after their stage stopped waiting
+    """
+    now = time.time()
+    with pending_lock:
+        flushed = [(pending_task_id, pending_progress.pop(pending_task_id))
+                   for pending_task_id, pending in list(
+                       pending_progress.items())
+                   if pending_task_id == task_id or
+                   now - pending[4] >= PROGRESS_FLUSH_INTERVAL]
+    for pending_task_id, pending in flushed:
+        if pending[0]:
+            send_progress(pending_task_id, *pending[:4])
+
+
+def send_progress(task_id, processed, succeeded, failed, warnings):
+    """
+    Adds the counts to the progress of the task. Errors are only printed,
+    progress must not fail the update.
+    """
+    progress_key = get_progress_key(task_id)
+    try:
+        pipeline = TASKS.pipeline()
+        pipeline.hincrby(progress_key, 'processed', processed)
+        pipeline.hincrby(progress_key, 'succeeded', succeeded)
+        pipeline.hincrby(progress_key, 'failed', failed)
+        pipeline.hincrby(progress_key, 'warnings', warnings)
+        pipeline.hset(progress_key, 'updated_at', time.time())
+        pipeline.execute()
+    except Exception as error:
+        print(f"Progress of task {task_id} not updated : {error}")
+
+
+def get_progress(task_id):
+    """
+    :return: {"Total", "Processed", "Succeeded", "Failed", "Warnings",
+    "Elapsed_Seconds", "Rows_Per_Second", "Last_Update_Seconds_Ago"}, None if
+    the task did not report progress
+    """
+    progress = {key.decode(): float(value) for key, value in
+                TASKS.hgetall(get_progress_key(task_id)).items()}
+    if not progress:
+        return None
+    now = time.time()
+    elapsed = now - progress['started_at']
+    return {
+        "Total": int(progress['total']),
+        "Processed": int(progress['processed']),
+        "Succeeded": int(progress['succeeded']),
+        "Failed": int(progress['failed']),
+        "Warnings": int(progress['warnings']),
+        "Elapsed_Seconds": round(elapsed, 1),
+        "Rows_Per_Second": round(progress['processed'] / elapsed, 2)
+        if elapsed > 0 else 0,
+        # a growing value while Processed < Total points to a stalled run
+        "Last_Update_Seconds_Ago": round(now - progress['updated_at'], 1)
+    }
@@ -1,20 +1,28 @@
 import json
-import multiprocessing
 import sys
 import shutil
 from functools import partial
-from flask import request, Response
+from flask import g, request, Response
 from async_execution import async_task
 
+import compare_pandas
 from compare import get_ndpd_st_data, get_ndpd_updated_data, get_st_updated_data
+from compare import stream_ndpd_st_data
+from json_stream import iter_json_array
 from update_nd_st import update_ndpd_side, update_site_tracker_side
+from progress import flush_progress, start_progress
+from cancellation import get_stop_reason
+import executor
 from wsgi import application
 from IBusPlatformInterface import IBusPlatformInterface
 from config import VERSION1
 import utility
 from datetime import datetime
 from utility import (get_mapped_task_milestone_data_from_db,
+                     get_group_stats,
+                     get_pool_chunksize,
                      get_time_execution,
+                     group_update_data,
                      site_tracker_token_generator,
                      update_siteTracker_fields,
                      write_to_excel
@@ -26,6 +34,16 @@ from zipfile import ZipFile
 log_file_name1 = "Task-Milestone-Alignment.log"
 logger, log_file_name2 = get_logger(log_file_name1)
 
+# "Compare-Engine" in the /compare-ndpd-st-data input json selects one of these
+COMPARE_ENGINES = {
+    "loop": (get_ndpd_st_data, get_ndpd_updated_data, get_st_updated_data),
+    "pandas": (compare_pandas.get_ndpd_st_data,
+               compare_pandas.get_ndpd_updated_data,
+               compare_pandas.get_st_updated_data)
+}
+# reads the input files incrementally instead of loading them whole
+STREAMING_COMPARE_ENGINE = "streaming"
+
 
 @application.route('/get-mapped-task-milestone', methods=['POST'])
 @async_task
@@ -158,21 +176,16 @@ def get_mapped_task_milestone():
                             range(0, len(missing_st_project_smps), n)]
                 else:
                     smps = [tuple(missing_st_project_smps)]
-                pool = multiprocessing.Pool()
+                # site tracker queries, I/O-bound
                 func = partial(utility.get_st_filtered_projects_dict_missing,
                                token, st_instance,
                                st_instance_version, st_project)
-                map_object = pool.map_async(func, smps)
-                result = map_object.get()
+                result = executor.map_items(executor.THREAD, func, smps)
                 for data in result:
                     if data['totalSize'] != 0:
                         for each in data['records']:
                             missing_smp_project_dict[each["NDPd_SMP_ID__c"]] = \
                             each["Id"]
-                ibus_obj.logInfo("Pool is closing")
-                pool.close()
-                ibus_obj.logInfo("Pool is joining")
-                pool.join()
 
             ibus_obj.logInfo("from site tracker smpids for manual created smps")
             # ibus_obj.logInfo(f"{missing_smp_project_dict}")
@@ -432,6 +445,8 @@ def get_ndpd_data_for_mapping_fields():
                                                           Ndpd_PASSWORD,
                                                           mappings,
                                                           ibus_obj, logger,
+                                                          # NDPd api calls, I/O-bound
+                                                          backend=executor.THREAD,
                                                           SF_INSTANCE_NAME=NDPD_SF_INSTANCE,
                                                           url=Ndpd_URL,
                                                           end_point=api_query_task_details)
@@ -604,18 +619,14 @@ def get_site_tracker_data_for_mapping_fields():
                                    range(0, len(project_id_list), n)]
                 else:
                     project_ids = [tuple(project_id_list)]
-                pool = multiprocessing.Pool()
+                # site tracker queries, I/O-bound
                 func = partial(utility.site_tracker_api_call_latest,
                                st_instance,
                                st_instance_version,
                                token,
                                milestone_names)
-                map_object = pool.map_async(func, project_ids)
-                result = map_object.get()
-                ibus_obj.logInfo("Pool is closing")
-                pool.close()
-                ibus_obj.logInfo("Pool is joining")
-                pool.join()
+                result = executor.map_items(executor.THREAD, func,
+                                            project_ids)
                 for data in result:
                     if isinstance(data, dict) and data['totalSize'] != 0:
                         for each in data['records']:
@@ -717,7 +728,7 @@ def get_site_tracker_data_for_mapping_fields():
 
 
 @application.route('/compare-ndpd-st-data', methods=['POST'])
-@async_task
+@async_task(priority='high')
 def compare_ndpd_st_data():
     updated_ndpd_json, updated_st_json = '', ''
     start_time = datetime.now()
@@ -729,85 +740,94 @@ def compare_ndpd_st_data():
         datetime.now().strftime("%d%m%Y%H%M%S%f"))
     st_json_file = "ST-Data_{}.json".format(
         datetime.now().strftime("%d%m%Y%H%M%S%f"))
-    if not (ibus_obj.getInputParameterFile("Mapping-Json", mapping_json_file)):
-        return Response(response="Mapping-Json.json File not found",
-                        status=404)
-    if not (ibus_obj.getInputParameterFile("NDPd-Data", ndpd_json_file)):
-        return Response(response="Ndpd-Data.json File not found",
-                        status=404)
-    if not (ibus_obj.getInputParameterFile("ST-Data", st_json_file)):
-        return Response(response="ST-Data.json File not found",
+    failed_parameter = ibus_obj.getInputParameterFiles({
+        "Mapping-Json": mapping_json_file,
+        "NDPd-Data": ndpd_json_file,
+        "ST-Data": st_json_file})
+    if failed_parameter:
+        return Response(response=f"{failed_parameter}.json File not found",
                         status=404)
     ndpd_dict = {"ndpdData": []}
     st_dict = {"stData": []}
 
     try:
-        with open(mapping_json_file, 'r') as fp:
-            mapping_json_data = json.load(fp)
-        with open(ndpd_json_file, 'r') as fp:
-            ndpd_json_data = json.load(fp)
-        with open(st_json_file, 'r') as fp:
-            st_json_data = json.load(fp)
-        mappings = mapping_json_data['mappings']
-        ndpd_data = ndpd_json_data['ndpdData']
-        st_data = st_json_data['stData']
-        invalidsmps = mapping_json_data['invalidsmps']
-        ibus_obj.logInfo("Comparing of NDPD and ST data")
-        logger.info("Comparing of NDPD and ST data")
-        ndpd_update_data, st_update_data = get_ndpd_st_data(mappings,
+        compare_engine = json_data.get('Compare-Engine', 'loop')
+        if compare_engine not in COMPARE_ENGINES and \
+                compare_engine != STREAMING_COMPARE_ENGINE:
+            ibus_obj.logWarning(f"Unknown compare engine {compare_engine}, "
+                                f"using loop")
+            compare_engine = 'loop'
+        ibus_obj.logInfo(f"Comparing of NDPD and ST data using "
+                         f"{compare_engine} engine")
+        logger.info(f"Comparing of NDPD and ST data using "
+                    f"{compare_engine} engine")
+        if compare_engine == STREAMING_COMPARE_ENGINE:
+            invalidsmps = list(iter_json_array(mapping_json_file,
+                                               'invalidsmps'))
+            final_ndpd_data, final_st_data = stream_ndpd_st_data(
+                iter_json_array(mapping_json_file, 'mappings'),
+                iter_json_array(ndpd_json_file, 'ndpdData'),
+                iter_json_array(st_json_file, 'stData'),
+                ibus_obj,
+                logger)
+            ibus_obj.logInfo("Comparision completed")
+            logger.info("Comparision completed")
+        else:
+            with open(mapping_json_file, 'r') as fp:
+                mapping_json_data = json.load(fp)
+            with open(ndpd_json_file, 'r') as fp:
+                ndpd_json_data = json.load(fp)
+            with open(st_json_file, 'r') as fp:
+                st_json_data = json.load(fp)
+            mappings = mapping_json_data['mappings']
+            ndpd_data = ndpd_json_data['ndpdData']
+            st_data = st_json_data['stData']
+            invalidsmps = mapping_json_data['invalidsmps']
+            compare_data, compare_ndpd_data, compare_st_data = \
+                COMPARE_ENGINES[compare_engine]
+            ndpd_update_data, st_update_data = compare_data(mappings,
                                                             ndpd_data,
                                                             st_data,
                                                             ibus_obj,
                                                             logger)
-        ibus_obj.logInfo("Comparision completed")
-        logger.info("Comparision completed")
-        ibus_obj.logInfo("Preparing NDPD Data")
-        logger.info("Preparing NDPD Data")
-        final_ndpd_data = get_ndpd_updated_data(ndpd_update_data,
+            ibus_obj.logInfo("Comparision completed")
+            logger.info("Comparision completed")
+            ibus_obj.logInfo("Preparing NDPD Data")
+            logger.info("Preparing NDPD Data")
+            final_ndpd_data = compare_ndpd_data(ndpd_update_data,
                                                 logger,
                                                 ibus_obj)
-        ibus_obj.logInfo("Preparing ST data")
-        logger.info("Preparing ST data")
-        final_st_data = get_st_updated_data(st_update_data, logger, ibus_obj)
-        st_project_list = [data['st-projectId'] for data in
-                           final_st_data]
-        st_project_list = list(set(st_project_list))
-        ndpd_smp_list = [data['ndpd-smpId'] for data in final_ndpd_data]
-        ndpd_smp_list = list(set(ndpd_smp_list))
-
-        st_main_list = []
-        ndpd_main_list = []
+            ibus_obj.logInfo("Preparing ST data")
+            logger.info("Preparing ST data")
+            final_st_data = compare_st_data(st_update_data, logger,
+                                            ibus_obj)
         ibus_obj.logInfo("Preparing order of ST")
         logger.info("Preparing order of ST")
-        for st_project in st_project_list:
-            update_list = []
-            for data in final_st_data:
-                if st_project == data['st-projectId']:
-                    update_list.append(data)
-            st_main_list.append(update_list)
+        st_main_list = group_update_data(final_st_data, 'st-projectId')
+        st_group_stats = get_group_stats(st_main_list)
+        ibus_obj.logInfo(f"ST groups by project {st_group_stats}")
+        logger.info(f"ST groups by project {st_group_stats}")
         ibus_obj.logInfo("Preparing order of NDPD")
         logger.info("Preparing order of NDPD")
-        for ndpd_smp in ndpd_smp_list:
-            update_list = []
-            for data in final_ndpd_data:
-                if ndpd_smp == data['ndpd-smpId']:
-                    update_list.append(data)
-            ndpd_main_list.append(update_list)
+        ndpd_main_list = group_update_data(final_ndpd_data, 'ndpd-smpId')
+        ndpd_group_stats = get_group_stats(ndpd_main_list)
+        ibus_obj.logInfo(f"NDPD groups by smp {ndpd_group_stats}")
+        logger.info(f"NDPD groups by smp {ndpd_group_stats}")
         ndpd_dict['ndpdData'] = ndpd_main_list
+        ndpd_dict['groupStats'] = ndpd_group_stats
         st_dict['stData'] = st_main_list
+        st_dict['groupStats'] = st_group_stats
         ndpd_dict['invalidsmps'] = invalidsmps
         updated_ndpd_json = "Updated_Ndpd_{}.json".format(
             datetime.now().strftime("%d%m%Y%H%M%S%f"))
         with open(updated_ndpd_json, 'w') as f:
             f.write(json.dumps(ndpd_dict))
-        ibus_obj.uploadOutputParameterFile('NDPd-Data',
-                                           updated_ndpd_json)
         updated_st_json = "Updated_ST_{}.json".format(
             datetime.now().strftime("%d%m%Y%H%M%S%f"))
         with open(updated_st_json, 'w') as f:
             f.write(json.dumps(st_dict))
-        ibus_obj.uploadOutputParameterFile('ST-Data',
-                                           updated_st_json)
+        ibus_obj.uploadOutputParameterFiles({'NDPd-Data': updated_ndpd_json,
+                                             'ST-Data': updated_st_json})
         end_time = datetime.now()
         time_taken = get_time_execution(start_time, end_time)
         return Response(response=json.dumps(
@@ -840,7 +860,7 @@ def compare_ndpd_st_data():
 
 
 @application.route('/update-ndpd-fields', methods=['POST'])
-@async_task
+@async_task(priority='low')
 def update_ndpd_fields():
     """
     this function accepts mapping json file, ndpd json file and st_json file
@@ -897,23 +917,60 @@ def update_ndpd_fields():
         # getting session object
         # session = utility.get_session(username=ndpd_username,
         #                               password=ndpd_password)
-        pool = multiprocessing.Pool()
+        # progress of the rows is reported by the pool workers, they stop
+        # taking rows at the deadline or when the task is cancelled
+        task_id = g.get('task_id')
+        deadline = g.get('deadline')
+        start_progress(task_id, sum(len(group) for group in ndpd_data))
+        # rows are updated with pyodbc queries and NDPd api calls, both wait
+        # on I/O with the GIL released, so they run in the shared thread pool
+        pool = executor.get_pool(executor.THREAD)
         func = partial(update_ndpd_side,
                        #db_name, db_username, db_password, session,
                        db_name, db_username, db_password, ndpd_username, ndpd_password,
                        ndpd_url, instance, forecast_endpoint,
-                       actual_endpoint, execute_endpoint)
-        map_object = pool.map_async(func, ndpd_data)
-        result = map_object.get()
+                       actual_endpoint, execute_endpoint, task_id=task_id,
+                       deadline=deadline)
+        # files written before groupStats was added have no stats
+        group_stats = ndpd_json_data.get('groupStats') or \
+            get_group_stats(ndpd_data)
+        chunksize = get_pool_chunksize(group_stats)
+        ibus_obj.logInfo(f"Updating {group_stats} ndpd groups with "
+                         f"chunksize {chunksize}")
+        result, errors = utility.map_until_deadline(pool, func, ndpd_data,
+                                                    chunksize, deadline)
+        flush_progress(task_id)
         ndpd_success_data = []
         ndpd_failure_data = []
         ndpd_warning_data = []
-        for success, failure, warning in result:
+        skipped_rows = 0
+        error_rows = 0
+        for index, (group, group_result) in enumerate(zip(ndpd_data,
+                                                          result)):
+            if index in errors:
+                # the rows of the group before the error are not reported
+                ibus_obj.logError(f"Update of ndpd group {index} failed : "
+                                  f"{errors[index]}")
+                logger.error(f"Update of ndpd group {index} failed : "
+                             f"{errors[index]}")
+                error_rows += len(group)
+                continue
+            if group_result is None:
+                # the group did not finish before the deadline
+                skipped_rows += len(group)
+                continue
+            success, failure, warning, skipped = group_result
             ndpd_success_data.extend(success)
             ndpd_failure_data.extend(failure)
             ndpd_warning_data.extend(warning)
-        pool.close()
-        pool.join()
+            skipped_rows += skipped
+        stop_reason = get_stop_reason(task_id, deadline) \
+            if skipped_rows else None
+        if stop_reason:
+            ibus_obj.logWarning(f"Update ndpd side {stop_reason}, "
+                                f"{skipped_rows} rows not updated")
+            logger.warning(f"Update ndpd side {stop_reason}, "
+                           f"{skipped_rows} rows not updated")
         ndpd_warning_data.extend(invalidsmps)
         data_dict['NDPD Success'].extend(ndpd_success_data)
         data_dict['NDPD Failure'].extend(ndpd_failure_data)
@@ -932,7 +989,9 @@ def update_ndpd_fields():
                 "Start-Time": start_time.strftime("%H:%M:%S:%f")[:-3],
                 "End-Time": end_time.strftime("%H:%M:%S:%f")[:-3],
                 "Time-Taken": time_taken.strftime("%H:%M:%S:%f")[:-3],
-                "Operation_Status": "Completed"
+                "Skipped-Rows": skipped_rows,
+                "Error-Rows": error_rows,
+                "Operation_Status": stop_reason or "Completed"
             }),
             status=200, mimetype='application/json')
     except Exception as e:
@@ -955,7 +1014,7 @@ def update_ndpd_fields():
 
 
 @application.route('/update-site-tracker-fields', methods=['POST'])
-@async_task
+@async_task(priority='low')
 def update_site_tracker_fields():
     """
     :param Mapping-Info : Mapping json data
@@ -986,11 +1045,11 @@ def update_site_tracker_fields():
         datetime.now().strftime("%d%m%Y%H%M%S%f"))
     ndpd_report_file = "Updated_Ndpd_{}.json".format(
         datetime.now().strftime("%d%m%Y%H%M%S%f"))
-    if not (ibus_obj.getInputParameterFile("ST-Data", st_json_file)):
-        return Response(response="ST-Data.json File not found",
-                        status=404)
-    if not (ibus_obj.getInputParameterFile("NDPd-Report", ndpd_report_file)):
-        return Response(response="NDPd-Report.json File not found",
+    failed_parameter = ibus_obj.getInputParameterFiles({
+        "ST-Data": st_json_file,
+        "NDPd-Report": ndpd_report_file})
+    if failed_parameter:
+        return Response(response=f"{failed_parameter}.json File not found",
                         status=404)
     token = site_tracker_token_generator(st_authentication_url, st_client_id,
                                          st_client_secrete_key,
@@ -1012,16 +1071,48 @@ def update_site_tracker_fields():
         st_data = st_json_data['stData']
         st_success_data = []
         st_failure_data = []
-        pool1 = multiprocessing.Pool()
+        task_id = g.get('task_id')
+        deadline = g.get('deadline')
+        start_progress(task_id, sum(len(group) for group in st_data))
+        # same thread pool as the ndpd side, see update_ndpd_fields
+        pool1 = executor.get_pool(executor.THREAD)
         func1 = partial(update_site_tracker_side,
-                        token, st_instance, st_instance_version)
-        map_object = pool1.map_async(func1, st_data)
-        result1 = map_object.get()
-        for success, failure in result1:
+                        token, st_instance, st_instance_version,
+                        task_id=task_id, deadline=deadline)
+        group_stats = st_json_data.get('groupStats') or \
+            get_group_stats(st_data)
+        chunksize = get_pool_chunksize(group_stats)
+        ibus_obj.logInfo(f"Updating {group_stats} st groups with "
+                         f"chunksize {chunksize}")
+        result1, errors = utility.map_until_deadline(pool1, func1, st_data,
+                                                     chunksize, deadline)
+        flush_progress(task_id)
+        skipped_rows = 0
+        error_rows = 0
+        for index, (group, group_result) in enumerate(zip(st_data, result1)):
+            if index in errors:
+                # the rows of the group before the error are not reported
+                ibus_obj.logError(f"Update of st group {index} failed : "
+                                  f"{errors[index]}")
+                logger.error(f"Update of st group {index} failed : "
+                             f"{errors[index]}")
+                error_rows += len(group)
+                continue
+            if group_result is None:
+                # the group did not finish before the deadline
+                skipped_rows += len(group)
+                continue
+            success, failure, skipped = group_result
             st_success_data.extend(success)
             st_failure_data.extend(failure)
-        pool1.close()
-        pool1.join()
+            skipped_rows += skipped
+        stop_reason = get_stop_reason(task_id, deadline) \
+            if skipped_rows else None
+        if stop_reason:
+            ibus_obj.logWarning(f"Update site tracker side {stop_reason}, "
+                                f"{skipped_rows} rows not updated")
+            logger.warning(f"Update site tracker side {stop_reason}, "
+                           f"{skipped_rows} rows not updated")
         report_data['SiteTracker Success'].extend(st_success_data)
         report_data['SiteTracker Failure'].extend(st_failure_data)
         report_name = reports.split(".")
@@ -1044,9 +1135,9 @@ def update_site_tracker_fields():
             with open(log_file_name2, 'w'):
                 ibus_obj.logInfo("Emptying the file")
                 pass
-        ibus_obj.uploadOutputParameterFile('Reports', path_of_excel_file)
-        ibus_obj.uploadOutputParameterFile(
-            'Reports-And-Logs', zip_file_name)
+        ibus_obj.uploadOutputParameterFiles({
+            'Reports': path_of_excel_file,
+            'Reports-And-Logs': zip_file_name})
         return Response(response=json.dumps(
             {
                 "Reports-And-Logs": zip_file_name,
@@ -1055,7 +1146,9 @@ def update_site_tracker_fields():
                 "End-Time": end_time.strftime("%H:%M:%S:%f")[:-3],
                 "Time-Taken": time_taken.
                                   strftime("%H:%M:%S:%f")[:-3],
-                "Operation_Status": "Completed"
+                "Skipped-Rows": skipped_rows,
+                "Error-Rows": error_rows,
+                "Operation_Status": stop_reason or "Completed"
             }),
             status=200, mimetype='application/json')
     except Exception as error:
@@ -0,0 +1,272 @@
+"""
+Priority classes and per-customer limits of the @async_task tasks.
+
+Queued tasks are picked by priority class, in the order of
+TASK_PRIORITY_CLASSES, and oldest first within a class. A task is skipped
+while its customer already runs TASK_CUSTOMER_MAX_RUNNING tasks, when it is
+set, so the long update runs of one customer can't take all the threads.
+TASK_RESERVED_WORKERS threads are started on top of the others and left
+idle for the short stages in the "high" class, they don't wait behind the
+running update stages. A task waiting TASK_AGING_SECONDS goes before the
+younger tasks of the higher classes, so the lower classes are not starved.
+
+TaskScheduler runs the tasks on threads of the wsgi process ("thread" mode),
+pick_queued_task does the same for the worker processes of "queue" mode
+with one list per class in Redis.
+"""
+import threading
+import time
+from collections import deque
+
+from setting import (ASYNC_TASK_MODE, TASK_AGING_SECONDS,
+                     TASK_CLASS_QUEUE_DEPTH,
+                     TASK_CUSTOMER_KEYS, TASK_CUSTOMER_MAX_RUNNING,
+                     TASK_KEY_PREFIX, TASK_PRIORITY_CLASSES, TASK_QUEUE_KEY,
+                     TASK_RESERVED_WORKERS, TASK_RUNNING_KEY,
+                     TASK_WAKEUP_KEY, TASKS)
+
+# tokens kept in TASK_WAKEUP_KEY when no worker is waiting
+MAX_WAKEUPS = 100
+# tasks looked at per class list by pick_queued_task
+MAX_SCANNED_TASKS = 100
+
+# Moves the oldest task whose customer is below the limit from the class
+# lists, in priority order, to the processing list of the worker and counts
+# it as running for its customer. The tasks queued before the aging time
+# are looked at first, in the same order.
+# KEYS: processing list, running hash, class lists in priority order
+# ARGV: task key prefix, running limit per customer (-1 for no limit), tasks
+# scanned per list, time.time() of the oldest queued_at of a task which is
+# not aged
+# returns {task id, customer or ""}, nil if no task can run
+pick_task = TASKS.register_script("""
+for pass = 1, 2 do
+    for i = 3, #KEYS do
+        local task_ids = redis.call('LRANGE', KEYS[i], -tonumber(ARGV[3]),
+                                    -1)
+        for j = #task_ids, 1, -1 do
+            local task_id = task_ids[j]
+            local task = redis.call('HMGET', ARGV[1] .. task_id, 'customer',
+                                    'queued_at')
+            local customer = task[1]
+            -- the list is oldest first from its end
+            if pass == 1 and tonumber(task[2] or ARGV[4]) >=
+                    tonumber(ARGV[4]) then
+                break
+            end
+            if not customer or tonumber(ARGV[2]) < 0 or tonumber(redis.call(
+                    'HGET', KEYS[2], customer) or 0) < tonumber(ARGV[2]) then
+                redis.call('LREM', KEYS[i], -1, task_id)
+                redis.call('LPUSH', KEYS[1], task_id)
+                if customer then
+                    redis.call('HINCRBY', KEYS[2], customer, 1)
+                end
+                return {task_id, customer or ''}
+            end
+        end
+    end
+end
+return nil
+""")
+
+
+def get_customer(json_data):
+    """
+    :param json_data: input json of the request
+    :return: customer the task is limited for, None if not limited
+    """
+    if not isinstance(json_data, dict):
+        return None
+    for key in TASK_CUSTOMER_KEYS:
+        if json_data.get(key):
+            return str(json_data[key])
+    return None
+
+
+def get_queue_key(priority):
+    """:return: redis list of the queued tasks of the priority class"""
+    return f"{TASK_QUEUE_KEY}:{priority}"
+
+
+class TaskScheduler:
+    """
+    Runs submitted functions on a fixed number of threads, which are started
+    with the first task. Tasks wait in one queue per priority class.
+    """
+
+    def __init__(self, workers):
+        """:param workers: threads, TASK_RESERVED_WORKERS are added"""
+        self.workers = workers + sum(TASK_RESERVED_WORKERS.values())
+        self.threads = []
+        self.condition = threading.Condition()
+        self.queued = {priority: deque()
+                       for priority in TASK_PRIORITY_CLASSES}
+        self.running = {priority: 0 for priority in TASK_PRIORITY_CLASSES}
+        self.customer_running = {}
+
+    def submit(self, priority, customer, function, *args, **kwargs):
+        """
+        Queues function(*args, **kwargs)
+        :return: False if the queue of the priority class is full
+        """
+        with self.condition:
+            if len(self.queued[priority]) >= TASK_CLASS_QUEUE_DEPTH[priority]:
+                return False
+            self.queued[priority].append((customer, function, args, kwargs,
+                                          time.monotonic()))
+            self.start_threads()
+            self.condition.notify()
+        return True
+
+    def start_threads(self):
+        while len(self.threads) < self.workers:
+            thread = threading.Thread(target=self.run_tasks, daemon=True,
+                                      name=f'async_task_{len(self.threads)}')
+            thread.start()
+            self.threads.append(thread)
+
+    def is_allowed(self, customer):
+        return customer is None or TASK_CUSTOMER_MAX_RUNNING is None or \
+            self.customer_running.get(customer, 0) < TASK_CUSTOMER_MAX_RUNNING
+
+    def get_reserved(self, priority):
+        """:return: idle threads kept for the classes before priority"""
+        index = TASK_PRIORITY_CLASSES.index(priority)
+        return sum(max(TASK_RESERVED_WORKERS.get(other, 0) -
+                       self.running[other], 0)
+                   for other in TASK_PRIORITY_CLASSES[:index])
+
+    def next_task(self):
+        """
+        Called with the condition held
+        :return: (priority, customer, function, args, kwargs) of the task to
+        run next, None if every queued task is blocked by its customer or
+        the threads reserved for a higher class
+        """
+        running = sum(self.running.values())
+        priorities = [priority for priority in TASK_PRIORITY_CLASSES
+                      if running + self.get_reserved(priority) < self.workers]
+        aged_before = time.monotonic() - TASK_AGING_SECONDS
+        # the aged tasks first, then all of them
+        for aged in (True, False):
+            for priority in priorities:
+                for task in self.queued[priority]:
+                    if aged and task[-1] > aged_before:
+                        # the queue is oldest first
+                        break
+                    if self.is_allowed(task[0]):
+                        self.queued[priority].remove(task)
+                        return (priority,) + task[:-1]
+        return None
+
+    def run_tasks(self):
+        while True:
+            with self.condition:
+                task = self.next_task()
+                while task is None:
+                    self.condition.wait()
+                    task = self.next_task()
+                priority, customer, function, args, kwargs = task
+                self.running[priority] += 1
+                if customer is not None:
+                    self.customer_running[customer] = \
+                        self.customer_running.get(customer, 0) + 1
+            try:
+                function(*args, **kwargs)
+            except Exception as e:
+                print(f"Exception in async task thread : {e}")
+            finally:
+                with self.condition:
+                    self.running[priority] -= 1
+                    if customer is not None:
+                        self.customer_running[customer] -= 1
+                        if not self.customer_running[customer]:
+                            del self.customer_running[customer]
+                    # a task of this customer may be allowed now
+                    self.condition.notify_all()
+
+    def get_queue_depths(self):
+        """:return: {class: {"Queued": count, "Running": count}}"""
+        with self.condition:
+            return {priority: {"Queued": len(self.queued[priority]),
+                               "Running": self.running[priority]}
+                    for priority in TASK_PRIORITY_CLASSES}
+
+    def get_customer_running(self):
+        """:return: {customer: running tasks}"""
+        with self.condition:
+            return dict(self.customer_running)
+
+
+def get_wakeup_key(priority):
+    """:return: list the workers running only some classes wait on"""
+    return f"{TASK_WAKEUP_KEY}:{priority}"
+
+
+def notify_workers(pipeline, priority=None):
+    """
+    Wakes up one waiting worker process, as part of pipeline
+    :param priority: class of the queued task, also wakes up a worker
+    running only that class
+    """
+    for wakeup_key in [TASK_WAKEUP_KEY] + (
+            [get_wakeup_key(priority)] if priority else []):
+        pipeline.lpush(wakeup_key, 1)
+        pipeline.ltrim(wakeup_key, 0, MAX_WAKEUPS - 1)
+
+
+def pick_queued_task(processing_key, priorities=TASK_PRIORITY_CLASSES):
+    """
+    "queue" mode, moves the next task which may run to processing_key
+    :param priorities: classes the worker runs, in priority order
+    :return: task id, customer (None if not limited), None if there is no
+    task to run
+    """
+    max_running = -1 if TASK_CUSTOMER_MAX_RUNNING is None \
+        else TASK_CUSTOMER_MAX_RUNNING
+    picked = pick_task(keys=[processing_key, TASK_RUNNING_KEY] +
+                       [get_queue_key(priority) for priority in priorities],
+                       args=[TASK_KEY_PREFIX, max_running, MAX_SCANNED_TASKS,
+                             time.time() - TASK_AGING_SECONDS])
+    if not picked:
+        return None
+    task_id, customer = (value.decode() for value in picked)
+    return task_id, customer or None
+
+
+def finish_queued_task(customer):
+    """
+    "queue" mode, counts the task of the customer as no longer running and
+    wakes up a worker in case a task was waiting for it
+    """
+    pipeline = TASKS.pipeline()
+    if customer is not None:
+        pipeline.hincrby(TASK_RUNNING_KEY, customer, -1)
+    notify_workers(pipeline)
+    pipeline.execute()
+    if customer is not None and int(TASKS.hget(TASK_RUNNING_KEY, customer)
+                                    or 0) <= 0:
+        TASKS.hdel(TASK_RUNNING_KEY, customer)
+
+
+def get_queue_depths(scheduler):
+    """
+    :param scheduler: TaskScheduler of this process, used in "thread" mode
+    :return: {"Classes": {class: {"Queued", "Running"}},
+    "Customers": {customer: running tasks}}
+    """
+    if ASYNC_TASK_MODE != 'queue':
+        return {"Classes": scheduler.get_queue_depths(),
+                "Customers": scheduler.get_customer_running()}
+    pipeline = TASKS.pipeline()
+    for priority in TASK_PRIORITY_CLASSES:
+        pipeline.llen(get_queue_key(priority))
+    pipeline.hgetall(TASK_RUNNING_KEY)
+    values = pipeline.execute()
+    # the running count of a class is not kept for the worker processes
+    return {
+        "Classes": {priority: {"Queued": queued} for priority, queued in
+                    zip(TASK_PRIORITY_CLASSES, values)},
+        "Customers": {customer.decode(): int(running)
+                      for customer, running in values[-1].items()}
+    }
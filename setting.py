@@ -2,3 +2,159 @@ import redis
 REDIS_IP = '127.0.0.1'
 REDIS_PORT = '6379'
 TASKS = redis.StrictRedis(host=REDIS_IP, port=REDIS_PORT)
+
+# pools shared by the requests of a gunicorn worker, see executor.py.
+# EXECUTOR_THREADS api calls and row updates and EXECUTOR_PROCESSES
+# cpu-bound processes (None for the cpu count) run at once, whatever the
+# number of requests
+EXECUTOR_THREADS = 32
+EXECUTOR_PROCESSES = None
+
+# @async_task threads, per wsgi worker process. Tasks above
+# ASYNC_TASK_WORKERS wait as "Queued", a priority class with
+# TASK_CLASS_QUEUE_DEPTH tasks waiting rejects the new ones. A task thread
+# mostly waits for its api calls and row updates in the shared executor,
+# more running tasks only split the same EXECUTOR_THREADS into smaller
+# shares, so every running task gets about 4 of them
+ASYNC_TASK_WORKERS = max(EXECUTOR_THREADS // 4, 2)
+ASYNC_TASK_QUEUE_DEPTH = 20
+# {class: threads} started on top of ASYNC_TASK_WORKERS and kept idle for
+# the tasks of a class while it runs fewer tasks, the classes after it don't
+# take them. In "queue" mode start worker.py with --priority high instead
+TASK_RESERVED_WORKERS = {'high': 1}
+
+# queued tasks are picked by class in this order, oldest first within a
+# class, @async_task(priority=...) sets the class of a route
+TASK_PRIORITY_CLASSES = ['high', 'normal', 'low']
+# a task queued TASK_AGING_SECONDS ago is picked before the younger tasks of
+# the classes before its own, a steady flow of normal tasks can't hold the
+# low update stages back until their deadline
+TASK_AGING_SECONDS = 60
+TASK_DEFAULT_PRIORITY = 'normal'
+TASK_CLASS_QUEUE_DEPTH = {'high': ASYNC_TASK_QUEUE_DEPTH,
+                          'normal': ASYNC_TASK_QUEUE_DEPTH,
+                          'low': ASYNC_TASK_QUEUE_DEPTH}
+# running tasks per customer, the customer of a request is the value of the
+# first of TASK_CUSTOMER_KEYS in its input json, requests without any of them
+# are not limited. Per wsgi worker process in "thread" mode, for all the
+# workers in "queue" mode. None does not limit them, set it to 1 to run
+# the stages of a customer one after the other
+TASK_CUSTOMER_KEYS = ['Customer', 'St-Instance']
+TASK_CUSTOMER_MAX_RUNNING = None
+
+# "thread" runs @async_task functions on the threads above, "queue" only
+# pushes them to the TASK_QUEUE_KEY:<class> lists and worker.py processes run
+# them, then TASK_CLASS_QUEUE_DEPTH is the length limit of those lists
+ASYNC_TASK_MODE = 'thread'
+TASK_QUEUE_KEY = 'async_task:queue'
+# {customer: running tasks} of the worker processes
+TASK_RUNNING_KEY = 'async_task:running'
+# idle workers wait on this list for new or unblocked tasks
+TASK_WAKEUP_KEY = 'async_task:wakeup'
+# every worker moves the task it runs to its own processing list
+TASK_PROCESSING_KEY_PREFIX = 'async_task:processing:'
+WORKER_HEARTBEAT_KEY_PREFIX = 'async_task:worker:'
+WORKER_HEARTBEAT_TTL = 60
+# a task which was running when its worker died is queued again this many
+# times before it is failed
+ASYNC_TASK_MAX_ATTEMPTS = 2
+
+# /OperationStatus with "Wait" blocks on the notify list of the task, the
+# wait is capped below the gunicorn worker timeout. A waiting request holds
+# a gunicorn thread (wsgi-config.py), at most OPERATION_STATUS_MAX_WAITERS
+# of them wait per wsgi worker process, the others answer In-Progress at
+# once, so threads are left for the other requests
+OPERATION_STATUS_MAX_WAIT = 20
+OPERATION_STATUS_MAX_WAITERS = 4
+TASK_NOTIFY_KEY_PREFIX = 'async_task:done:'
+TASK_NOTIFY_TTL = 3600
+
+# task records are kept at most TASK_RECORD_TTL seconds after their last
+# update, return values from TASK_COMPRESS_MIN_SIZE bytes are zlib compressed
+TASK_KEY_PREFIX = 'async_task:task:'
+TASK_RECORD_TTL = 86400
+TASK_COMPRESS_MIN_SIZE = 1024
+# a request with the same stage, workflow-instance-id and
+# digimop-operation-id as a queued, running or completed task gets that task
+# id, completed tasks are kept TASK_DELIVERED_TTL seconds after delivery
+TASK_FINGERPRINT_KEY_PREFIX = 'async_task:fingerprint:'
+TASK_DELIVERED_TTL = 600
+# rows processed / succeeded / failed reported by the update stages
+TASK_PROGRESS_KEY_PREFIX = 'async_task:progress:'
+# the rows of an update stage send their counts together, at most every
+# PROGRESS_FLUSH_INTERVAL seconds or PROGRESS_FLUSH_ROWS rows, and read the
+# cancel request at most every CANCEL_CHECK_INTERVAL seconds, instead of two
+# redis calls per row
+PROGRESS_FLUSH_INTERVAL = 2
+PROGRESS_FLUSH_ROWS = 100
+CANCEL_CHECK_INTERVAL = 2
+
+# timeout (connect, read) in seconds of the NDPD and Site Tracker calls of
+# the update stages. Once DIGIMOP_TIMEOUT is over the pool workers finish
+# their current row, the stage stops waiting for them TASK_STOP_GRACE
+# seconds later and its groups still queued in the shared pool are cancelled
+REQUEST_TIMEOUT = (10, 60)
+TASK_STOP_GRACE = REQUEST_TIMEOUT[1] + 30
+# cancel flag of the groups of one map_until_deadline call, see utility.py
+RUN_CANCEL_KEY_PREFIX = 'async_task:run_cancel:'
+RUN_CANCEL_TTL = 3600
+
+# with KEYCLOAK_TOKEN_SHARED the Keycloak tokens of IBusPlatformInterface are
+# shared by the gunicorn workers through Redis, stored in plain text
+KEYCLOAK_TOKEN_SHARED = False
+KEYCLOAK_TOKEN_KEY_PREFIX = 'keycloak:token:'
+# seconds of a Keycloak token request, also the longest time a thread waits
+# for the token another thread is renewing
+KEYCLOAK_REQUEST_TIMEOUT = 10
+
+# live logs of IBusPlatformInterface are posted by a background thread in
+# batches of LIVE_LOG_BATCH_SIZE records or every LIVE_LOG_FLUSH_INTERVAL
+# seconds, at most LIVE_LOG_QUEUE_SIZE records wait, see live_log.py.
+# uploadLogFile waits up to LIVE_LOG_FLUSH_TIMEOUT seconds for the queue
+LIVE_LOG_ASYNC = True
+LIVE_LOG_QUEUE_SIZE = 10000
+LIVE_LOG_BATCH_SIZE = 100
+LIVE_LOG_FLUSH_INTERVAL = 1
+LIVE_LOG_FLUSH_TIMEOUT = 30
+LIVE_LOG_REQUEST_TIMEOUT = (5, 15)
+
+# IBusPlatformInterface log messages below this level (DEBUG, INFO, WARN,
+# ERROR) are dropped, "log-level" in the input json overrides it. limit=N of
+# a log call counts the messages per LOG_RATE_WINDOW seconds
+LOG_MIN_LEVEL = 'DEBUG'
+LOG_RATE_WINDOW = 60
+
+# pooled keep-alive session of the iBus workflow-manager and digimop-logger
+# calls, see http_session.py. IBUS_POOL_MAXSIZE connections are kept per
+# host, failed connection attempts are retried IBUS_CONNECT_RETRIES times
+IBUS_POOL_CONNECTIONS = 10
+IBUS_POOL_MAXSIZE = 20
+IBUS_CONNECT_RETRIES = 3
+IBUS_RETRY_BACKOFF = 0.5
+# (connect, read) seconds
+IBUS_REQUEST_TIMEOUT = (10, 120)
+
+# iBus parameter files are downloaded and uploaded in chunks of
+# IBUS_TRANSFER_CHUNK_SIZE bytes. The upload of the parameters listed in
+# IBUS_GZIP_PARAMETERS, e.g. ['Mapping-Json', 'NDPd-Data', 'ST-Data'], is
+# sent with Content-Encoding: gzip, only for a workflow-manager which
+# accepts gzipped requests. Downloads are gzipped if the server does it
+IBUS_TRANSFER_CHUNK_SIZE = 1024 * 1024
+IBUS_GZIP_PARAMETERS = []
+IBUS_GZIP_LEVEL = 6
+# parameter files of a batch transferred at the same time
+IBUS_TRANSFER_WORKERS = 4
+
+# local log file of IBusPlatformInterface, written in blocks of
+# LOG_FILE_BUFFER_SIZE bytes and flushed at least every
+# LOG_FILE_FLUSH_INTERVAL seconds and before uploadLogFile
+LOG_FILE_BUFFER_SIZE = 64 * 1024
+LOG_FILE_FLUSH_INTERVAL = 5
+
+# local copies of the uploaded parameter files, read by the next stage of
+# the workflow instance instead of downloading them, see artifact_cache.py.
+# Off by default, the stages of an instance have to run on the same host
+# to benefit
+ARTIFACT_CACHE_ENABLED = False
+ARTIFACT_CACHE_DIR = 'artifact_cache'
+ARTIFACT_CACHE_MAX_BYTES = 2 * 1024 ** 3
@@ -0,0 +1,167 @@
+"""
+Stats and cleanup of the @async_task keys in Redis.
+
+stats: key count and bytes used (MEMORY USAGE) for task records, notify
+lists, request fingerprints, the job queues, processing lists and worker
+heartbeats, plus task records by state and records without TTL.
+cleanup: gives task records without TTL the TASK_RECORD_TTL, deletes
+completed records older than --completed-older-than seconds and, with
+--legacy, records written before the task key prefix (bare uuid keys).
+
+usage: python task_admin.py stats
+       python task_admin.py cleanup --completed-older-than 3600 [--dry-run]
+"""
+import argparse
+import json
+import re
+import time
+
+from scheduler import get_queue_key
+from setting import (TASK_FINGERPRINT_KEY_PREFIX, TASK_KEY_PREFIX,
+                     TASK_NOTIFY_KEY_PREFIX, TASK_PROCESSING_KEY_PREFIX,
+                     TASK_PRIORITY_CLASSES, TASK_PROGRESS_KEY_PREFIX,
+                     TASK_QUEUE_KEY, TASK_RECORD_TTL, TASKS,
+                     WORKER_HEARTBEAT_KEY_PREFIX)
+
+KEY_GROUPS = {
+    "tasks": TASK_KEY_PREFIX + '*',
+    "notify": TASK_NOTIFY_KEY_PREFIX + '*',
+    "progress": TASK_PROGRESS_KEY_PREFIX + '*',
+    "fingerprints": TASK_FINGERPRINT_KEY_PREFIX + '*',
+    "queue": TASK_QUEUE_KEY + ':*',
+    "processing": TASK_PROCESSING_KEY_PREFIX + '*',
+    "heartbeats": WORKER_HEARTBEAT_KEY_PREFIX + '*'
+}
+LEGACY_TASK_KEY = re.compile(rb'^[0-9a-f]{32}$')
+SCAN_COUNT = 1000
+
+
+def iter_key_batches(pattern):
+    """Yields the keys matching pattern in lists of up to SCAN_COUNT keys"""
+    batch = []
+    for key in TASKS.scan_iter(match=pattern, count=SCAN_COUNT):
+        batch.append(key)
+        if len(batch) == SCAN_COUNT:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def get_memory_usage(keys):
+    """:return: bytes used by keys, None if the server has no MEMORY USAGE"""
+    pipeline = TASKS.pipeline(transaction=False)
+    for key in keys:
+        pipeline.memory_usage(key)
+    try:
+        return sum(size or 0 for size in pipeline.execute())
+    except Exception:
+        return None
+
+
+def get_stats():
+    """:return: {group: {"keys": count, "bytes": bytes used}, ...}"""
+    stats = {}
+    for group, pattern in KEY_GROUPS.items():
+        count = 0
+        size = 0
+        for keys in iter_key_batches(pattern):
+            count += len(keys)
+            batch_size = get_memory_usage(keys)
+            size = None if size is None or batch_size is None \
+                else size + batch_size
+        stats[group] = {"keys": count, "bytes": size}
+    states = {}
+    without_ttl = 0
+    for keys in iter_key_batches(KEY_GROUPS["tasks"]):
+        pipeline = TASKS.pipeline(transaction=False)
+        for key in keys:
+            pipeline.hget(key, 'state')
+            pipeline.ttl(key)
+        values = pipeline.execute()
+        for state, ttl in zip(values[::2], values[1::2]):
+            state = state.decode() if state else "Unknown"
+            states[state] = states.get(state, 0) + 1
+            if ttl == -1:
+                without_ttl += 1
+    stats["tasks"]["states"] = states
+    stats["tasks"]["withoutTtl"] = without_ttl
+    stats["queue"]["length"] = {
+        priority: TASKS.llen(get_queue_key(priority))
+        for priority in TASK_PRIORITY_CLASSES}
+    return stats
+
+
+def cleanup(completed_older_than, legacy, dry_run):
+    """
+    :param completed_older_than: seconds, completed records older than this
+    are deleted, None to keep them until their TTL
+    :param legacy: also delete completed bare uuid records, the ones not
+    completed get a TTL
+    :param dry_run: only count
+    :return: {"ttlSet": count, "deleted": count}
+    """
+    result = {"ttlSet": 0, "deleted": 0}
+    now = time.time()
+    patterns = [KEY_GROUPS["tasks"]]
+    if legacy:
+        patterns.append('?' * 32)
+    for pattern in patterns:
+        for keys in iter_key_batches(pattern):
+            if pattern != KEY_GROUPS["tasks"]:
+                keys = [key for key in keys if LEGACY_TASK_KEY.match(key)]
+            pipeline = TASKS.pipeline(transaction=False)
+            for key in keys:
+                pipeline.type(key)
+                pipeline.ttl(key)
+                pipeline.hmget(key, 'completed_at', 'return_value')
+            # hmget fails on keys which are not hashes, they are skipped
+            values = pipeline.execute(raise_on_error=False)
+            pipeline = TASKS.pipeline(transaction=False)
+            for index, key in enumerate(keys):
+                key_type, ttl, fields = values[index * 3:index * 3 + 3]
+                if key_type != b'hash':
+                    continue
+                completed_at, return_value = fields
+                if pattern == KEY_GROUPS["tasks"]:
+                    completed = completed_older_than is not None and \
+                        completed_at and \
+                        now - float(completed_at) > completed_older_than
+                else:
+                    # legacy records have no completed_at
+                    completed = return_value is not None
+                if completed:
+                    result["deleted"] += 1
+                    pipeline.delete(key)
+                    if pattern == KEY_GROUPS["tasks"]:
+                        task_id = key.decode()[len(TASK_KEY_PREFIX):]
+                        pipeline.delete(TASK_NOTIFY_KEY_PREFIX + task_id,
+                                        TASK_PROGRESS_KEY_PREFIX + task_id)
+                elif ttl == -1:
+                    result["ttlSet"] += 1
+                    pipeline.expire(key, TASK_RECORD_TTL)
+            if not dry_run:
+                pipeline.execute()
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stats and cleanup of the "
+                                                 "async task keys in Redis")
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    commands.add_parser('stats')
+    cleanup_parser = commands.add_parser('cleanup')
+    cleanup_parser.add_argument('--completed-older-than', type=float,
+                                help="seconds, delete completed task records "
+                                     "older than this")
+    cleanup_parser.add_argument('--legacy', action='store_true',
+                                help="also clean task records without the "
+                                     "key prefix")
+    cleanup_parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+    if args.command == 'stats':
+        print(json.dumps(get_stats(), indent=2))
+    else:
+        print(json.dumps(cleanup(args.completed_older_than, args.legacy,
+                                 args.dry_run), indent=2))
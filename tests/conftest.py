@@ -0,0 +1,55 @@
+"""
+The modules of the service are top level files of the repository, the tests
+import them from there. The test dependencies are in
+requirements-dev.txt: pip install -r requirements-dev.txt
+"""
+import logging
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeIBus:
+    """Stands in for IBusPlatformInterface, keeps the logged messages"""
+
+    def __init__(self):
+        self.messages = []
+
+    def logInfo(self, message, *args, **kwargs):
+        self.messages.append(("INFO", message))
+
+    def logWarning(self, message, *args, **kwargs):
+        self.messages.append(("WARN", message))
+
+    def logError(self, message, *args, **kwargs):
+        self.messages.append(("ERROR", message))
+
+    def logDebug(self, message, *args, **kwargs):
+        self.messages.append(("DEBUG", message))
+
+
+@pytest.fixture
+def ibus_obj():
+    return FakeIBus()
+
+
+@pytest.fixture
+def logger():
+    return logging.getLogger("tests")
+
+
+@pytest.fixture
+def tasks():
+    """
+    Points the shared TASKS client to a new fakeredis server, the modules
+    and the registered lua scripts keep using the same client object
+    """
+    import fakeredis
+    import setting
+    connection_pool = setting.TASKS.connection_pool
+    setting.TASKS.connection_pool = fakeredis.FakeStrictRedis().connection_pool
+    yield setting.TASKS
+    setting.TASKS.connection_pool = connection_pool
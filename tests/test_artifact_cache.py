@@ -0,0 +1,58 @@
+"""
+Local cache of the uploaded parameter files
+"""
+import os
+
+import pytest
+
+import artifact_cache
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(artifact_cache, 'ARTIFACT_CACHE_ENABLED', True)
+    monkeypatch.setattr(artifact_cache, 'ARTIFACT_CACHE_MAX_BYTES', 25)
+    monkeypatch.setattr(artifact_cache, 'BLOBS_DIR', str(tmp_path / 'blobs'))
+    monkeypatch.setattr(artifact_cache, 'REFS_DIR', str(tmp_path / 'refs'))
+    monkeypatch.setattr(artifact_cache, 'blobs_size', None)
+    return tmp_path
+
+
+def write_file(path, content):
+    with open(path, 'w') as file:
+        file.write(content)
+    return str(path)
+
+
+def test_parameter_name_is_not_case_sensitive(cache_dir):
+    source = write_file(cache_dir / 'data.json', '{"rows": []}')
+    assert artifact_cache.store_artifact('wf-1', 'NDPd-Data', source)
+    target = str(cache_dir / 'copy.json')
+    assert artifact_cache.fetch_artifact('wf-1', 'Ndpd-Data', target) == \
+        target
+    with open(target) as file:
+        assert file.read() == '{"rows": []}'
+
+
+def test_evicts_only_above_max_bytes(cache_dir, monkeypatch):
+    evictions = []
+    evict_artifacts = artifact_cache.evict_artifacts
+    monkeypatch.setattr(artifact_cache, 'evict_artifacts',
+                        lambda max_bytes: evictions.append(max_bytes) or
+                        evict_artifacts(max_bytes))
+    first = write_file(cache_dir / 'first.json', 'a' * 10)
+    assert artifact_cache.store_artifact('wf-1', 'first', first)
+    # the first new blob counts the cache
+    assert len(evictions) == 1
+    # the same content is not a new blob
+    assert artifact_cache.store_artifact('wf-2', 'first', first)
+    second = write_file(cache_dir / 'second.json', 'b' * 10)
+    assert artifact_cache.store_artifact('wf-1', 'second', second)
+    assert len(evictions) == 1
+    os.utime(os.path.join(artifact_cache.BLOBS_DIR,
+                          os.listdir(artifact_cache.BLOBS_DIR)[0]), (0, 0))
+    third = write_file(cache_dir / 'third.json', 'c' * 10)
+    assert artifact_cache.store_artifact('wf-1', 'third', third)
+    assert len(evictions) == 2
+    assert len(os.listdir(artifact_cache.BLOBS_DIR)) == 2
+    assert artifact_cache.blobs_size == 20
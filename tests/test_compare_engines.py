@@ -0,0 +1,215 @@
+"""
+The pandas engine has to give the same update lists as the loop engine of
+compare.py, for the same mappings, NDPD rows and ST rows.
+"""
+import copy
+
+import pytest
+
+import compare
+import compare_pandas
+from benchmark_compare import generate_data
+
+
+def get_mapping(smp, task, source, target, source_fields, target_fields,
+                task_type="Task"):
+    return {
+        "ndpd-customerName": "Customer",
+        "ndpd-projectId": "PRJ-1",
+        "ndpd-smpId": f"SMP-{smp}",
+        "ndpd-moduleId": "MOD-1",
+        "ndpd-taskName": f"Task {task}",
+        "ndpd-task-type": task_type,
+        "st-projectId": f"ST-{smp}",
+        "st-milestoneName": f"Milestone {task}",
+        "source": source,
+        "target": target,
+        "source-fields": source_fields,
+        "target-fields": target_fields
+    }
+
+
+def get_ndpd(mapping, actual_end="null", actual_start="2020-02-01 10:00:00.1",
+             planned_start="2020-03-01 10:00:00.1",
+             modified="2020-05-01 10:00:00.1", task_name=None):
+    return {
+        "ndpd-projectId": mapping["ndpd-projectId"],
+        "ndpd-smpId": mapping["ndpd-smpId"],
+        "ndpd-moduleId": mapping["ndpd-moduleId"],
+        "ndpd-taskName": task_name or mapping["ndpd-taskName"],
+        "actualStartTime": actual_start,
+        "actualEndTime": actual_end,
+        "plannedStartTime": planned_start,
+        "lastModifiedTime": modified
+    }
+
+
+def get_st(mapping, milestone_id, actual_end="2020-04-01",
+           actual_start="2020-02-01", planned_start="2020-03-02",
+           modified="2020-04-01 10:00:00.1"):
+    return {
+        "st-projectId": mapping["st-projectId"],
+        "st-milestoneName": mapping["st-milestoneName"],
+        "st-milestoneId": milestone_id,
+        "p-number": "P1",
+        "actualStartTime": actual_start,
+        "actualEndTime": actual_end,
+        "plannedStartTime": planned_start,
+        "lastModifiedTime": modified
+    }
+
+
+def get_fixture():
+    """One mapping for every branch of the sync rules"""
+    aed, fsd = "Actual End Date", "Forecast Start Date"
+    mappings = [
+        get_mapping(1, 1, "NDPD", "NDPD", aed, aed),
+        get_mapping(1, 2, "NDPD", "NDPD", aed, fsd, "Milestone"),
+        get_mapping(1, 3, "SiteTracker", "SiteTracker", fsd, aed),
+        get_mapping(1, 4, "NDPD", "NDPD", fsd, fsd, "Milestone"),
+        get_mapping(2, 1, "SiteTracker", "NDPD", aed, aed),
+        get_mapping(2, 2, "SiteTracker", "NDPD", fsd, aed),
+        get_mapping(2, 3, "SiteTracker", "NDPD", fsd, fsd),
+        get_mapping(2, 4, "NDPD", "SiteTracker", aed, aed),
+        get_mapping(2, 5, "NDPD", "SiteTracker", fsd, fsd),
+        # no NDPD row and no ST row
+        get_mapping(3, 1, "NDPD", "SiteTracker", aed, aed),
+        get_mapping(3, 2, "NDPD", "SiteTracker", aed, aed),
+    ]
+    ndpd_data = [
+        get_ndpd(mappings[0]),
+        get_ndpd(mappings[1], actual_end="2020-04-01 09:00:00.5"),
+        get_ndpd(mappings[2], modified="2020-01-01 10:00:00.1"),
+        get_ndpd(mappings[3], actual_end="",
+                 modified="2020-01-01 10:00:00.1"),
+        get_ndpd(mappings[4], task_name="TASK 1"),
+        get_ndpd(mappings[5], actual_end="2020-03-01 09:00:00.5"),
+        get_ndpd(mappings[6], actual_end=""),
+        get_ndpd(mappings[7], actual_end="2020-04-02 09:00:00.5"),
+        get_ndpd(mappings[8]),
+        get_ndpd(mappings[10]),
+    ]
+    st_data = [
+        get_st(mappings[0], "a1"),
+        get_st(mappings[1], "a2", actual_start=None),
+        get_st(mappings[2], "a3", actual_end=None),
+        get_st(mappings[3], "a4"),
+        get_st(mappings[4], "a5"),
+        get_st(mappings[5], "a6", actual_end=None),
+        get_st(mappings[6], "a7"),
+        get_st(mappings[7], "a8"),
+        get_st(mappings[8], "a9", actual_end=None),
+        get_st(mappings[9], "a10"),
+    ]
+    return mappings, ndpd_data, st_data
+
+
+def get_duplicate_fixture():
+    """NDPD and ST rows with the same key, the first one is used"""
+    mappings, ndpd_data, st_data = get_fixture()
+    ndpd_data = ndpd_data + [
+        get_ndpd(mappings[0], actual_end="2020-06-01 09:00:00.5"),
+        get_ndpd(mappings[7], task_name="task 4",
+                 actual_end="2020-04-01 09:00:00.5")]
+    st_data = st_data + [get_st(mappings[7], "b8", actual_end="2020-06-01"),
+                         get_st(mappings[4], "b5", actual_end=None)]
+    return mappings, ndpd_data, st_data
+
+
+def run_engine(engine, data, ibus_obj, logger):
+    """
+    :return: ndpd and st update lists, before and after the filters
+    """
+    mappings, ndpd_data, st_data = copy.deepcopy(data)
+    ndpd_update_data, st_update_data = engine.get_ndpd_st_data(
+        mappings, ndpd_data, st_data, ibus_obj, logger)
+    # the filters change the dicts, compare the update lists as they were
+    result = copy.deepcopy((ndpd_update_data, st_update_data))
+    return result + (
+        engine.get_ndpd_updated_data(ndpd_update_data, logger, ibus_obj),
+        engine.get_st_updated_data(st_update_data, logger, ibus_obj))
+
+
+@pytest.mark.parametrize("data", [
+    get_fixture(),
+    get_duplicate_fixture(),
+    ([], [], []),
+    (get_fixture()[0], [], []),
+    ([], get_fixture()[1], get_fixture()[2]),
+], ids=["all-rules", "duplicate-keys", "empty", "no-rows", "no-mappings"])
+def test_pandas_engine_equals_loop_engine(data, ibus_obj, logger):
+    expected = run_engine(compare, data, ibus_obj, logger)
+    assert run_engine(compare_pandas, data, ibus_obj, logger) == expected
+
+
+def test_fixture_reaches_every_update_list(ibus_obj, logger):
+    ndpd_update_data, st_update_data, final_ndpd, final_st = run_engine(
+        compare, get_fixture(), ibus_obj, logger)
+    assert ndpd_update_data and st_update_data
+    assert final_ndpd and final_st
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_pandas_engine_equals_loop_engine_on_generated_data(seed, ibus_obj,
+                                                            logger):
+    data = generate_data(500, seed)
+    expected = run_engine(compare, data, ibus_obj, logger)
+    assert run_engine(compare_pandas, data, ibus_obj, logger) == expected
+
+
+def get_date_fixture(ndpd_value, st_value):
+    """
+    get_fixture with every NDPD time set to ndpd_value and every ST date to
+    st_value, the empty ones are kept
+    """
+    mappings, ndpd_data, st_data = get_fixture()
+    for row in ndpd_data:
+        row["plannedStartTime"] = ndpd_value
+        if row["actualEndTime"] not in ("null", ""):
+            row["actualEndTime"] = ndpd_value
+    for row in st_data:
+        row["plannedStartTime"] = st_value
+        if row["actualEndTime"] is not None:
+            row["actualEndTime"] = st_value
+    return mappings, ndpd_data, st_data
+
+
+def run_or_raise(engine, data, ibus_obj, logger):
+    """:return: result of run_engine, or the type and text of its error"""
+    try:
+        return run_engine(engine, data, ibus_obj, logger)
+    except Exception as error:
+        return type(error), str(error)
+
+
+# pd.to_datetime takes more than 6 fraction digits, strptime does not,
+# strptime takes single digit months and days
+@pytest.mark.parametrize("ndpd_value, st_value", [
+    ("2020-04-01 09:00:00.1234567", "2020-04-01"),
+    ("2020-4-1 9:00:00.5", "2020-4-1"),
+    ("2020-04-01 09:00:00", "2020-04-01 "),
+    ("2020-04-01T09:00:00.5", "2020-04-01T00:00"),
+    ("2020-04-01 09:00:00.5\n", "2020-04-01\n"),
+    ("2020-02-30 09:00:00.5", "2020-02-30"),
+])
+def test_engines_parse_dates_alike(ndpd_value, st_value, ibus_obj, logger):
+    data = get_date_fixture(ndpd_value, st_value)
+    expected = run_engine(compare, data, ibus_obj, logger)
+    # the values reach the filters
+    assert expected[0] and expected[1]
+    assert run_engine(compare_pandas, data, ibus_obj, logger) == expected
+
+
+@pytest.mark.parametrize("modified", [
+    "2020-01-01 10:00:00.1234567",
+    "2020-1-1 10:00:00.1",
+    "2020-01-01 10:00:00",
+    None,
+])
+def test_engines_compare_last_modified_alike(modified, ibus_obj, logger):
+    mappings, ndpd_data, st_data = get_fixture()
+    for row in ndpd_data:
+        row["lastModifiedTime"] = modified
+    data = mappings, ndpd_data, st_data
+    expected = run_or_raise(compare, data, ibus_obj, logger)
+    assert run_or_raise(compare_pandas, data, ibus_obj, logger) == expected
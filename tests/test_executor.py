@@ -0,0 +1,30 @@
+"""
+Pools shared by the requests of a wsgi worker
+"""
+import pytest
+
+import executor
+
+
+@pytest.fixture(autouse=True, scope='module')
+def pools():
+    yield
+    for pool in executor.pools.values():
+        pool.terminate()
+        pool.join()
+    executor.reset_pools()
+
+
+@pytest.mark.parametrize('backend', [executor.THREAD, executor.PROCESS])
+def test_map_items(backend):
+    assert executor.map_items(backend, abs, [-1, 2, -3]) == [1, 2, 3]
+    assert executor.get_pool(backend) is executor.get_pool(backend)
+
+
+def test_process_pool_is_not_forked():
+    assert executor.START_METHOD in ('forkserver', 'spawn')
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        executor.get_pool('gpu')
@@ -0,0 +1,91 @@
+"""
+Keycloak token cache of IBusPlatformInterface, shared by the request threads
+"""
+import threading
+import time
+
+from IBusPlatformInterface import IBusPlatformInterface
+
+
+def make_ibus(monkeypatch, request_token):
+    monkeypatch.setattr(IBusPlatformInterface, 'keycloakTokenCache', {})
+    monkeypatch.setattr(IBusPlatformInterface, 'keycloakTokenRenewals', {})
+    monkeypatch.setattr(IBusPlatformInterface,
+                        '_IBusPlatformInterface__requestKeycloakToken',
+                        lambda self, expiredToken: request_token(expiredToken))
+    ibus = IBusPlatformInterface.__new__(IBusPlatformInterface)
+    ibus.keycloakServiceUrl = 'http://keycloak'
+    ibus.keycloakRealm = 'realm'
+    ibus.keycloakClient = 'client'
+    ibus.keycloakClientUser = 'user'
+    return ibus
+
+
+def get_token(ibus):
+    return ibus._IBusPlatformInterface__getKeycloakToken()
+
+
+def cached_token(access_token, expires_in):
+    return {"access_token": access_token, "expires_at": time.time() + expires_in,
+            "refresh_token": None, "refresh_expires_at": 0}
+
+
+def test_token_is_requested_once(monkeypatch):
+    requests = []
+    ibus = make_ibus(monkeypatch, lambda expiredToken: requests.append(
+        expiredToken) or cached_token('token-1', 300))
+    assert get_token(ibus) == 'token-1'
+    assert get_token(ibus) == 'token-1'
+    assert requests == [None]
+
+
+def test_still_valid_token_is_used_during_a_slow_renewal(monkeypatch):
+    started = threading.Event()
+    release = threading.Event()
+
+    def request_token(expiredToken):
+        started.set()
+        release.wait(5)
+        return cached_token('token-2', 300)
+
+    ibus = make_ibus(monkeypatch, request_token)
+    # inside the margin, renewed but not expired yet
+    IBusPlatformInterface.keycloakTokenCache['http://keycloak|realm|client|user'] = \
+        cached_token('token-1', 10)
+    renewed = []
+    thread = threading.Thread(target=lambda: renewed.append(get_token(ibus)))
+    thread.start()
+    try:
+        assert started.wait(5)
+        # the other threads neither block on the lock nor request a token
+        begin = time.monotonic()
+        assert get_token(ibus) == 'token-1'
+        assert time.monotonic() - begin < 1
+    finally:
+        release.set()
+        thread.join()
+    assert renewed == ['token-2']
+    assert get_token(ibus) == 'token-2'
+
+
+def test_expired_token_waits_for_the_renewal(monkeypatch):
+    started = threading.Event()
+    requests = []
+
+    def request_token(expiredToken):
+        requests.append(expiredToken)
+        started.set()
+        time.sleep(0.2)
+        return cached_token('token-1', 300)
+
+    ibus = make_ibus(monkeypatch, request_token)
+    renewed = []
+    thread = threading.Thread(target=lambda: renewed.append(get_token(ibus)))
+    thread.start()
+    try:
+        assert started.wait(5)
+        assert get_token(ibus) == 'token-1'
+    finally:
+        thread.join()
+    assert renewed == ['token-1']
+    assert len(requests) == 1
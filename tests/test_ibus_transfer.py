@@ -0,0 +1,46 @@
+"""
+Concurrent transfer of a batch of iBus parameter files
+"""
+import threading
+import time
+
+import IBusPlatformInterface as ibus_module
+from IBusPlatformInterface import IBusPlatformInterface
+
+
+def transfer_concurrently(transfer, parameter_files):
+    ibus = IBusPlatformInterface.__new__(IBusPlatformInterface)
+    return ibus._IBusPlatformInterface__transferConcurrently(transfer,
+                                                             parameter_files)
+
+
+def test_all_transferred():
+    done = []
+    assert transfer_concurrently(lambda parameter, filename: done.append(
+        parameter) or True, {'A': 'a', 'B': 'b'}) is None
+    assert sorted(done) == ['A', 'B']
+
+
+def test_failure_cancels_pending_and_waits_for_running(monkeypatch):
+    monkeypatch.setattr(ibus_module, 'IBUS_TRANSFER_WORKERS', 2)
+    slow_started = threading.Event()
+    finished = []
+
+    def transfer(parameter, filename):
+        if parameter == 'Slow':
+            slow_started.set()
+            time.sleep(0.2)
+        elif parameter == 'Failed':
+            slow_started.wait(5)
+            return False
+        finished.append(parameter)
+        return True
+
+    failed = transfer_concurrently(transfer, {'Slow': 's', 'Failed': 'f',
+                                              'Pending': 'p'})
+    assert failed == 'Failed'
+    # the running transfer finished before the return, the pending one never
+    # started
+    assert finished == ['Slow']
+    time.sleep(0.3)
+    assert finished == ['Slow']
@@ -0,0 +1,37 @@
+"""
+/OperationStatus long polling, Redis is replaced by fakeredis
+"""
+import threading
+
+# the app imports async_execution through routes, as wsgi.py does
+import wsgi  # noqa: F401
+import async_execution
+from async_execution import store_task_result, wait_for_task
+from setting import OPERATION_STATUS_MAX_WAITERS
+
+
+def test_wait_returns_when_task_completes(tasks):
+    store_task_result('task-1', {'state': 'Completed',
+                                 'return_value': '{}', 'status': 200})
+    assert wait_for_task('task-1', 1)
+    # every waiting request gets the notification
+    assert wait_for_task('task-1', 1)
+
+
+def test_wait_times_out(tasks):
+    assert not wait_for_task('task-1', 0.1)
+
+
+def test_no_wait_above_max_waiters(tasks, monkeypatch):
+    monkeypatch.setattr(async_execution, 'status_waiters',
+                        threading.BoundedSemaphore(
+                            OPERATION_STATUS_MAX_WAITERS))
+    for _ in range(OPERATION_STATUS_MAX_WAITERS):
+        async_execution.status_waiters.acquire()
+    store_task_result('task-1', {'state': 'Completed',
+                                 'return_value': '{}', 'status': 200})
+    # answers at once although the task is completed, the caller reads the
+    # task record anyway
+    assert not wait_for_task('task-1', 1)
+    async_execution.status_waiters.release()
+    assert wait_for_task('task-1', 1)
@@ -0,0 +1,68 @@
+"""
+Progress and cancel checks of the update stages, sent to and read from
+Redis in batches, Redis is replaced by fakeredis
+"""
+import pytest
+
+import cancellation
+import progress
+from cancellation import is_cancel_requested, request_cancel
+from progress import (flush_progress, get_progress, report_progress,
+                      start_progress)
+from setting import PROGRESS_FLUSH_ROWS
+
+
+@pytest.fixture(autouse=True)
+def clear_state(monkeypatch):
+    monkeypatch.setattr(progress, 'pending_progress', {})
+    monkeypatch.setattr(cancellation, 'cancel_checks', {})
+
+
+def test_progress_is_sent_every_flush_rows(tasks):
+    start_progress('task-1', 1000)
+    for _ in range(PROGRESS_FLUSH_ROWS - 1):
+        report_progress('task-1', 1, 1)
+    assert get_progress('task-1')["Processed"] == 0
+    report_progress('task-1', 1, 0, 1)
+    assert get_progress('task-1')["Processed"] == PROGRESS_FLUSH_ROWS
+    report_progress('task-1', 1, 0, 0, 1)
+    assert get_progress('task-1')["Processed"] == PROGRESS_FLUSH_ROWS
+    flush_progress('task-1')
+    counts = get_progress('task-1')
+    assert (counts["Processed"], counts["Succeeded"], counts["Failed"],
+            counts["Warnings"]) == (PROGRESS_FLUSH_ROWS + 1,
+                                    PROGRESS_FLUSH_ROWS - 1, 1, 1)
+
+
+def test_progress_is_sent_after_flush_interval(tasks, monkeypatch):
+    monkeypatch.setattr(progress, 'PROGRESS_FLUSH_INTERVAL', 0)
+    start_progress('task-1', 10)
+    report_progress('task-1', 1, 1)
+    assert get_progress('task-1')["Processed"] == 1
+
+
+def test_flush_sends_counts_left_by_other_tasks(tasks, monkeypatch):
+    start_progress('task-1', 10)
+    report_progress('task-1', 1, 1)
+    monkeypatch.setattr(progress, 'PROGRESS_FLUSH_INTERVAL', 0)
+    flush_progress('task-2')
+    assert get_progress('task-1')["Processed"] == 1
+    assert progress.pending_progress == {}
+
+
+def test_cancel_request_is_read_once_per_interval(tasks, monkeypatch):
+    reads = []
+    hget = tasks.hget
+    monkeypatch.setattr(tasks, 'hget',
+                        lambda *args: reads.append(args) or hget(*args))
+    assert not is_cancel_requested('task-1')
+    request_cancel('task-1')
+    # the last answer is used within CANCEL_CHECK_INTERVAL
+    assert not is_cancel_requested('task-1')
+    assert len(reads) == 1
+    monkeypatch.setattr(cancellation, 'CANCEL_CHECK_INTERVAL', 0)
+    assert is_cancel_requested('task-1')
+    monkeypatch.setattr(cancellation, 'CANCEL_CHECK_INTERVAL', 60)
+    # a cancelled task is not read again
+    assert is_cancel_requested('task-1')
+    assert len(reads) == 2
@@ -0,0 +1,78 @@
+"""
+TaskScheduler threads of "thread" mode
+"""
+import threading
+import time
+
+import scheduler
+from scheduler import TaskScheduler
+
+
+def submit_blocked(task_scheduler, priority, customer, started, release):
+    """Submits a task which runs until release is set"""
+    def task():
+        started.set()
+        release.wait(5)
+    assert task_scheduler.submit(priority, customer, task)
+
+
+def test_normal_tasks_leave_a_thread_for_high():
+    # one thread and the one reserved for the high class
+    task_scheduler = TaskScheduler(1)
+    release = threading.Event()
+    first, second, high = (threading.Event() for _ in range(3))
+    try:
+        submit_blocked(task_scheduler, 'normal', None, first, release)
+        submit_blocked(task_scheduler, 'normal', None, second, release)
+        assert first.wait(5)
+        # the second thread is reserved for the high class
+        assert not second.wait(0.2)
+        submit_blocked(task_scheduler, 'high', None, high, release)
+        assert high.wait(5)
+        assert task_scheduler.get_queue_depths()['normal'] == \
+            {"Queued": 1, "Running": 1}
+    finally:
+        release.set()
+    assert second.wait(5)
+
+
+def test_customer_limit(monkeypatch):
+    task_scheduler = TaskScheduler(3)
+    release = threading.Event()
+    first, second = threading.Event(), threading.Event()
+    try:
+        monkeypatch.setattr(scheduler, 'TASK_CUSTOMER_MAX_RUNNING', None)
+        submit_blocked(task_scheduler, 'high', 'customer-1', first, release)
+        submit_blocked(task_scheduler, 'high', 'customer-1', second, release)
+        assert first.wait(5) and second.wait(5)
+        assert task_scheduler.get_customer_running() == {'customer-1': 2}
+
+        monkeypatch.setattr(scheduler, 'TASK_CUSTOMER_MAX_RUNNING', 2)
+        third = threading.Event()
+        submit_blocked(task_scheduler, 'high', 'customer-1', third, release)
+        assert not third.wait(0.2)
+    finally:
+        release.set()
+    assert third.wait(5)
+
+
+def test_low_task_runs_under_continuous_normal_load(monkeypatch):
+    monkeypatch.setattr(scheduler, 'TASK_AGING_SECONDS', 0.3)
+    task_scheduler = TaskScheduler(1)
+    low_started = threading.Event()
+    normal_runs = []
+
+    def normal():
+        # every normal task queues the next one, the normal queue is never
+        # empty while the low task waits
+        normal_runs.append(time.monotonic())
+        time.sleep(0.02)
+        if not low_started.is_set():
+            task_scheduler.submit('normal', None, normal)
+
+    task_scheduler.submit('normal', None, normal)
+    task_scheduler.submit('normal', None, normal)
+    assert task_scheduler.submit('low', None, low_started.set)
+    assert low_started.wait(5)
+    # normal tasks ran in between, the low task waited for its aging
+    assert len(normal_runs) > 5
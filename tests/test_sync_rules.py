@@ -0,0 +1,156 @@
+"""
+SYNC_RULES has to send every mapping to the same update lists as the
+if / elif chain it replaced, kept here as legacy_get_targets.
+"""
+import datetime
+import itertools
+import random
+
+import pytest
+
+import compare
+from benchmark_compare import generate_data
+from utility import build_index, get_ndpd_key, get_site_tracker_key
+
+FIELDS = ["Actual End Date", "Forecast Start Date"]
+SYSTEMS = ["NDPD", "SiteTracker"]
+TASK_TYPES = ["Task", "Milestone"]
+
+
+def parse(value):
+    return datetime.datetime.strptime(value, "%Y-%m-%d %H:%M:%S.%f")
+
+
+def legacy_get_targets(mapping, ndpd, site_tracker):
+    """The sync direction chain of get_ndpd_st_data before SYNC_RULES"""
+    targets = []
+    if (mapping['source'] == mapping['target']) and (
+            mapping['target-fields'] == "Actual End Date") and (
+            mapping['ndpd-task-type'] == "Task") and (
+            ndpd["actualEndTime"] == "null") and (
+            mapping['source-fields'] == "Actual End Date") and (
+            site_tracker["actualEndTime"] is not None):
+        targets.append("ndpd")
+    elif (mapping['source'] == mapping['target']) and \
+            (site_tracker["actualStartTime"] is None and
+             ndpd["actualStartTime"]) and \
+            (mapping['source-fields'] == "Actual End Date"):
+        targets.append("st")
+    elif mapping['source'] == mapping['target']:
+        if parse(ndpd['lastModifiedTime']) < \
+                parse(site_tracker['lastModifiedTime']):
+            if (mapping['ndpd-task-type'] == "Task") and \
+                    (mapping['target-fields'] == "Actual End Date"):
+                pass
+            else:
+                targets.append("ndpd")
+        if parse(ndpd['lastModifiedTime']) > \
+                parse(site_tracker['lastModifiedTime']):
+            targets.append("st")
+    else:
+        if (mapping['target'] == "NDPD") and (
+                mapping['source'] == "SiteTracker") and (
+                mapping['target-fields'] == "Actual End Date") and (
+                mapping['ndpd-task-type'] == "Task") and (
+                mapping['source-fields'] == "Actual End Date") and (
+                ndpd["actualEndTime"] == "null") and (
+                site_tracker["actualEndTime"] is not None):
+            targets.append("ndpd")
+        elif (mapping['target'] == "NDPD") and (
+                mapping['source'] == "SiteTracker"):
+            if (mapping['ndpd-task-type'] == "Task") and \
+                    (mapping['target-fields'] == "Actual End Date"):
+                pass
+            else:
+                targets.append("ndpd")
+        elif (mapping['target'] == "SiteTracker") and (
+                mapping['source'] == "NDPD"):
+            targets.append("st")
+    return targets
+
+
+def get_rule_targets(mapping, ndpd, site_tracker):
+    plan = compare.get_sync_plan({}, mapping)
+    return compare.get_sync_targets(plan, ndpd, site_tracker)
+
+
+def get_row_pairs(mappings, ndpd_data, st_data):
+    """:return: list of (mapping, ndpd, st) for the mappings with rows"""
+    ndpd_index, _ = build_index(ndpd_data, get_ndpd_key)
+    st_index, _ = build_index(st_data, get_site_tracker_key)
+    pairs = []
+    for mapping in mappings:
+        ndpd = ndpd_index.get(get_ndpd_key(mapping))
+        site_tracker = st_index.get(get_site_tracker_key(mapping))
+        if ndpd and site_tracker:
+            pairs.append((mapping, ndpd, site_tracker))
+    return pairs
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_rules_equal_legacy_chain_on_generated_data(seed):
+    pairs = get_row_pairs(*generate_data(2000, seed))
+    assert pairs
+    for mapping, ndpd, site_tracker in pairs:
+        assert get_rule_targets(mapping, ndpd, site_tracker) == \
+            legacy_get_targets(mapping, ndpd, site_tracker), mapping
+
+
+def test_rules_equal_legacy_chain_on_every_sync_key():
+    rand = random.Random(0)
+    _, ndpd, site_tracker = get_row_pairs(*generate_data(10, 0))[0]
+    row_values = {
+        "ndpd-actualEndTime": ["null", "", "2020-01-01 10:00:00.1"],
+        "ndpd-actualStartTime": ["", "2020-01-01 10:00:00.1"],
+        "st-actualEndTime": [None, "2020-01-01"],
+        "st-actualStartTime": [None, "2020-01-01"],
+    }
+    for source, target, source_fields, target_fields, task_type in \
+            itertools.product(SYSTEMS, SYSTEMS, FIELDS, FIELDS, TASK_TYPES):
+        mapping = {"source": source, "target": target,
+                   "source-fields": source_fields,
+                   "target-fields": target_fields,
+                   "ndpd-task-type": task_type}
+        for values in itertools.product(*row_values.values()):
+            ndpd = dict(ndpd, actualEndTime=values[0],
+                        actualStartTime=values[1],
+                        lastModifiedTime=rand.choice(
+                            ["2020-01-01 10:00:00.1", "2020-02-01 10:00:00.1"]))
+            site_tracker = dict(site_tracker, actualEndTime=values[2],
+                                actualStartTime=values[3],
+                                lastModifiedTime="2020-01-01 10:00:00.1")
+            assert get_rule_targets(mapping, ndpd, site_tracker) == \
+                legacy_get_targets(mapping, ndpd, site_tracker), \
+                (mapping, values)
+
+
+def test_compiled_plan_is_inspectable():
+    plan = compare.compile_sync_rules(
+        ("NDPD", "NDPD", "Actual End Date", "Actual End Date", "Task"))
+    assert [name for name, _, _ in plan] == [
+        "same-system-task-actual-end-missing-in-ndpd",
+        "same-system-actual-start-missing-in-st",
+        "same-system-task-actual-end-latest-wins"]
+    assert compare.compile_sync_rules(
+        ("NDPD", "SiteTracker", "Actual End Date", "Actual End Date",
+         "Task")) == (("ndpd-to-st", None, ("st",)),)
+
+
+def test_unknown_row_condition_is_rejected():
+    rules = [{"name": "broken", "when": {"same-system": True},
+              "row": "no-such-condition", "update": ["st"]}]
+    with pytest.raises(ValueError):
+        compare.compile_sync_rules(("NDPD", "NDPD", None, None, None), rules)
+
+
+def test_ndpd_to_st_mapping_without_target_fields(ibus_obj, logger):
+    mappings, ndpd_data, st_data = generate_data(50, 1)
+    for mapping in mappings:
+        mapping.update(source="NDPD", target="SiteTracker")
+        del mapping["target-fields"]
+        del mapping["ndpd-task-type"]
+    ndpd_update_data, st_update_data = compare.get_ndpd_st_data(
+        mappings, ndpd_data, st_data, ibus_obj, logger)
+    assert ndpd_update_data == []
+    assert len(st_update_data) == len(get_row_pairs(mappings, ndpd_data,
+                                                    st_data))
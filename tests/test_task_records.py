@@ -0,0 +1,125 @@
+"""
+Task records in Redis, their compression and expiry, and the task_admin
+stats and cleanup, Redis is replaced by fakeredis
+"""
+import json
+import time
+import zlib
+
+# the app imports async_execution through routes, as wsgi.py does
+import wsgi
+import task_admin
+from async_execution import (get_task_key, read_task_record,
+                             store_task_result, write_task_record)
+from setting import (TASK_COMPRESS_MIN_SIZE, TASK_DELIVERED_TTL,
+                     TASK_KEY_PREFIX, TASK_NOTIFY_KEY_PREFIX,
+                     TASK_PROGRESS_KEY_PREFIX, TASK_RECORD_TTL)
+
+
+def store_result(task_id, return_value):
+    store_task_result(task_id, {'state': 'Completed',
+                                'return_value': return_value,
+                                'status': 200})
+
+
+def test_big_return_value_is_compressed(tasks):
+    return_value = json.dumps({"rows": ["row"] * TASK_COMPRESS_MIN_SIZE})
+    store_result('task-1', return_value)
+    stored = tasks.hgetall(get_task_key('task-1'))
+    assert stored[b'encoding'] == b'zlib'
+    assert zlib.decompress(stored[b'return_value']) == return_value.encode()
+    record = read_task_record('task-1')
+    assert record['return_value'] == return_value
+    assert record['state'] == 'Completed'
+
+
+def test_small_return_value_is_not_compressed(tasks):
+    store_result('task-1', '{"message": "done"}')
+    assert b'encoding' not in tasks.hgetall(get_task_key('task-1'))
+    assert read_task_record('task-1')['return_value'] == \
+        '{"message": "done"}'
+
+
+def test_read_uncompressed_record_of_older_version(tasks):
+    tasks.hset(get_task_key('task-1'), mapping={
+        'state': 'Completed', 'status': 200,
+        'return_value': json.dumps({"rows": ["row"] * 1000})})
+    record = read_task_record('task-1')
+    assert json.loads(record['return_value']) == {"rows": ["row"] * 1000}
+    assert read_task_record('missing') == {}
+
+
+def test_ttl_set_on_write_and_store(tasks):
+    write_task_record('task-1', {'state': 'Running'})
+    assert 0 < tasks.ttl(get_task_key('task-1')) <= TASK_RECORD_TTL
+    tasks.persist(get_task_key('task-1'))
+    store_result('task-1', '{}')
+    assert 0 < tasks.ttl(get_task_key('task-1')) <= TASK_RECORD_TTL
+    assert tasks.ttl(TASK_NOTIFY_KEY_PREFIX + 'task-1') > 0
+
+
+def test_ttl_shortened_on_delivery(tasks):
+    store_result('task-1', '{"message": "done"}')
+    tasks.hset(TASK_PROGRESS_KEY_PREFIX + 'task-1', 'processed', 1)
+    response = wsgi.application.test_client().post(
+        '/OperationStatus', json={"Operation_Id": 'task-1'})
+    assert response.status_code == 200
+    assert response.get_json() == {"message": "done"}
+    assert 0 < tasks.ttl(get_task_key('task-1')) <= TASK_DELIVERED_TTL
+    assert 0 < tasks.ttl(TASK_NOTIFY_KEY_PREFIX + 'task-1') <= \
+        TASK_DELIVERED_TTL
+    assert not tasks.exists(TASK_PROGRESS_KEY_PREFIX + 'task-1')
+
+
+def write_completed(task_id, completed_at):
+    write_task_record(task_id, {'state': 'Completed', 'return_value': '{}',
+                                'completed_at': completed_at})
+
+
+def test_cleanup_deletes_only_old_completed_records(tasks):
+    write_completed('old', time.time() - 7200)
+    write_completed('recent', time.time())
+    tasks.lpush(TASK_NOTIFY_KEY_PREFIX + 'old', 'done')
+    tasks.hset(TASK_PROGRESS_KEY_PREFIX + 'old', 'processed', 1)
+    write_task_record('running', {'state': 'Running'})
+    # a record left without TTL by an older version
+    tasks.hset(get_task_key('orphan'), 'state', 'Running')
+    # not a task record, skipped
+    tasks.set(TASK_KEY_PREFIX + 'not-a-hash', 1)
+
+    assert task_admin.cleanup(3600, False, True) == \
+        {"ttlSet": 1, "deleted": 1}
+    assert tasks.exists(get_task_key('old'))
+    assert tasks.ttl(get_task_key('orphan')) == -1
+
+    assert task_admin.cleanup(3600, False, False) == \
+        {"ttlSet": 1, "deleted": 1}
+    assert not tasks.exists(get_task_key('old'),
+                            TASK_NOTIFY_KEY_PREFIX + 'old',
+                            TASK_PROGRESS_KEY_PREFIX + 'old')
+    assert tasks.exists(get_task_key('recent'), get_task_key('running'),
+                        TASK_KEY_PREFIX + 'not-a-hash') == 3
+    assert 0 < tasks.ttl(get_task_key('orphan')) <= TASK_RECORD_TTL
+
+
+def test_cleanup_legacy_records(tasks):
+    tasks.hset('a' * 32, mapping={'state': 'Completed',
+                                  'return_value': '{}'})
+    tasks.hset('b' * 32, 'state', 'Running')
+    tasks.hset('not-a-uuid-key-of-32-characters!', 'return_value', '{}')
+    assert task_admin.cleanup(None, True, False) == \
+        {"ttlSet": 1, "deleted": 1}
+    assert not tasks.exists('a' * 32)
+    assert 0 < tasks.ttl('b' * 32) <= TASK_RECORD_TTL
+    assert tasks.exists('not-a-uuid-key-of-32-characters!')
+
+
+def test_stats(tasks):
+    write_completed('done', time.time())
+    write_task_record('running', {'state': 'Running'})
+    tasks.hset(get_task_key('orphan'), 'state', 'Running')
+    stats = task_admin.get_stats()
+    assert stats["tasks"]["keys"] == 3
+    assert stats["tasks"]["states"] == {"Completed": 1, "Running": 2}
+    assert stats["tasks"]["withoutTtl"] == 1
+    assert stats["queue"]["length"] == {"high": 0, "normal": 0, "low": 0}
@@ -0,0 +1,114 @@
+"""
+Request errors of the update stages fail their row, not the whole stage
+"""
+import json
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import pytest
+import requests
+
+import update_nd_st
+import utility
+
+
+class FakeResponse:
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.reason = "OK"
+        self.text = json.dumps(body)
+
+
+def get_row(task_name, field="Forecast Start Date"):
+    return {'ndpd-customerName': 'customer', 'ndpd-projectId': 'p1',
+            'ndpd-smpName': 'smp', 'ndpd-smpId': 's1', 'ndpd-moduleId': 'm1',
+            'ndpd-taskName': task_name, 'ndpd-task-type': 'Milestone',
+            'ndpd-plannedStartTime': '2020-01-01',
+            'ndpd-actualEndTime': '2020-01-02', 'target-fields': field,
+            'st-projectId': 'sp1', 'st-milestoneId': 'a1',
+            'st-milestoneName': 'milestone', 'p-number': 'P-1',
+            'st-project-template-id': 't1',
+            'st-project-template-name': 'template',
+            'st-plannedStartTime': '2020-02-01',
+            'st-actualEndTime': '2020-02-02'}
+
+
+def update_ndpd(rows):
+    return update_nd_st.update_ndpd_side(
+        'db', 'user', 'password', 'ndpd_user', 'ndpd_password', 'http://ndpd',
+        'instance', '/forecast', '/actual', '/execute', rows)
+
+
+def test_ndpd_timeout_fails_the_row(monkeypatch):
+    def post(url, data, **kwargs):
+        if json.loads(data)['taskName'] == 'slow':
+            raise requests.Timeout("read timed out")
+        return FakeResponse(200, {"status": "success"})
+
+    monkeypatch.setattr(update_nd_st.requests, 'post', post)
+    success, failure, warning, skipped = update_ndpd(
+        [get_row('slow'), get_row('fast')])
+    assert [row[5] for row in success] == ['fast']
+    assert len(failure) == 1
+    assert failure[0][5] == 'slow'
+    assert failure[0][-2:] == ['Timeout', 'read timed out']
+    assert skipped == 0
+
+
+def test_site_tracker_connection_error_fails_the_row(monkeypatch):
+    def patch(url, **kwargs):
+        if url.endswith('/broken'):
+            raise requests.ConnectionError("connection refused")
+        return FakeResponse(204, {})
+
+    monkeypatch.setattr(update_nd_st.requests, 'patch', patch)
+    broken = dict(get_row('broken'), **{'st-milestoneId': 'broken'})
+    success, failure, skipped = update_nd_st.update_site_tracker_side(
+        'token', 'http://st', 'v48.0/', [broken, get_row('fine')])
+    assert [row[10] for row in success] == ['fine']
+    assert len(failure) == 1
+    assert failure[0][10] == 'broken'
+    assert failure[0][-1] == 'ConnectionError: connection refused'
+
+
+def fail_odd(group):
+    if group[0] % 2:
+        raise ValueError(f"group {group[0]}")
+    return sum(group)
+
+
+@pytest.mark.parametrize('timeout', [None, 60])
+def test_map_until_deadline_collects_group_errors(tasks, timeout):
+    deadline = None if timeout is None else time.time() + timeout
+    groups = [[index, 1] for index in range(6)]
+    with ThreadPool(2) as pool:
+        results, errors = utility.map_until_deadline(pool, fail_odd, groups,
+                                                     1, deadline)
+    assert results == [1, None, 3, None, 5, None]
+    assert errors == {1: "ValueError: group 1", 3: "ValueError: group 3",
+                      5: "ValueError: group 5"}
+
+
+def test_map_until_deadline_cancels_queued_groups(tasks, monkeypatch):
+    monkeypatch.setattr(utility, 'TASK_STOP_GRACE', 0)
+    release = threading.Event()
+    started = []
+
+    def update(group):
+        started.append(group[0])
+        release.wait(5)
+        return group[0]
+
+    pool = ThreadPool(1)
+    try:
+        results, errors = utility.map_until_deadline(
+            pool, update, [[0], [1], [2]], 1, time.time() + 0.2)
+        assert results == [None, None, None]
+        assert errors == {}
+    finally:
+        release.set()
+        pool.close()
+        pool.join()
+    # the groups queued behind the first one did not run
+    assert started == [0]
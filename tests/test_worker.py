@@ -0,0 +1,182 @@
+"""
+"queue" mode worker tests, Redis is replaced by fakeredis
+"""
+import json
+import threading
+import time
+
+from flask import jsonify
+
+from setting import (ASYNC_TASK_MAX_ATTEMPTS, TASK_RUNNING_KEY,
+                     TASK_WAKEUP_KEY, WORKER_HEARTBEAT_TTL)
+
+import worker
+from async_execution import (enqueue_task, get_task_fields, get_task_key,
+                             read_task_record, task_functions)
+import scheduler
+from scheduler import get_queue_key, get_wakeup_key
+
+CUSTOMER = 'customer-1'
+
+
+def queue_task(task_id, function_name='test_function', priority='normal',
+               customer=CUSTOMER, queued_at=None):
+    fields = get_task_fields(queued_at or time.time(), priority, customer)
+    with worker.application.test_request_context(
+            '/Test', method='POST', json={'Customer': customer}):
+        assert enqueue_task(task_id, fields, function_name, {})
+
+
+def start_task(tasks, worker_id, task_id):
+    """Queues task_id and lets worker_id pick it, as run_worker does"""
+    queue_task(task_id)
+    assert worker.pick_queued_task(worker.get_processing_key(worker_id)) == \
+        (task_id, CUSTOMER)
+    tasks.hincrby(get_task_key(task_id), 'attempts', 1)
+    worker.write_task_record(task_id, {'state': 'Running'})
+
+
+def get_list(tasks, key):
+    return [value.decode() for value in tasks.lrange(key, 0, -1)]
+
+
+def test_claim_moves_task_to_processing_list(tasks):
+    queue_task('task-1')
+    processing_key = worker.get_processing_key('worker-1')
+    assert worker.pick_queued_task(processing_key) == ('task-1', CUSTOMER)
+    assert get_list(tasks, get_queue_key('normal')) == []
+    assert get_list(tasks, processing_key) == ['task-1']
+    assert tasks.hget(TASK_RUNNING_KEY, CUSTOMER) == b'1'
+    # a second worker gets nothing, the task is claimed once
+    assert worker.pick_queued_task(
+        worker.get_processing_key('worker-2')) is None
+
+
+def test_claim_picks_high_class_first(tasks):
+    queue_task('task-normal', customer='customer-1')
+    queue_task('task-high', priority='high', customer='customer-2')
+    processing_key = worker.get_processing_key('worker-1')
+    assert worker.pick_queued_task(processing_key)[0] == 'task-high'
+    assert worker.pick_queued_task(processing_key)[0] == 'task-normal'
+
+
+def test_heartbeat_is_sent_with_ttl(tasks):
+    stop_event = threading.Event()
+    heartbeat_key = worker.get_heartbeat_key('worker-1')
+    thread = threading.Thread(target=worker.send_heartbeats,
+                              args=('worker-1', stop_event))
+    thread.start()
+    try:
+        for _ in range(100):
+            if tasks.exists(heartbeat_key):
+                break
+            stop_event.wait(0.01)
+        assert 0 < tasks.ttl(heartbeat_key) <= WORKER_HEARTBEAT_TTL
+    finally:
+        stop_event.set()
+        thread.join()
+
+
+def test_tasks_are_kept_while_heartbeat_lives(tasks):
+    start_task(tasks, 'worker-1', 'task-1')
+    tasks.set(worker.get_heartbeat_key('worker-1'), 1,
+              ex=WORKER_HEARTBEAT_TTL)
+    worker.requeue_orphaned_tasks()
+    assert get_list(tasks, worker.get_processing_key('worker-1')) == \
+        ['task-1']
+    assert read_task_record('task-1')['state'] == 'Running'
+
+
+def test_expired_heartbeat_requeues_task(tasks):
+    start_task(tasks, 'worker-1', 'task-1')
+    tasks.set(worker.get_heartbeat_key('worker-1'), 1, px=1)
+    threading.Event().wait(0.05)
+    worker.requeue_orphaned_tasks()
+    assert get_list(tasks, worker.get_processing_key('worker-1')) == []
+    assert get_list(tasks, get_queue_key('normal')) == ['task-1']
+    assert read_task_record('task-1')['state'] == 'Queued'
+    # the customer's slot is given back and a worker is woken up
+    assert tasks.hget(TASK_RUNNING_KEY, CUSTOMER) is None
+    assert tasks.llen(TASK_WAKEUP_KEY) > 0
+    # another worker picks it up again
+    assert worker.pick_queued_task(worker.get_processing_key('worker-2')) == \
+        ('task-1', CUSTOMER)
+
+
+def test_crashed_task_is_picked_before_waiting_tasks(tasks):
+    start_task(tasks, 'worker-1', 'task-1')
+    queue_task('task-2')
+    # worker-1 restarts with the same id
+    worker.requeue_tasks(worker.get_processing_key('worker-1'))
+    processing_key = worker.get_processing_key('worker-1')
+    assert worker.pick_queued_task(processing_key)[0] == 'task-1'
+
+
+def test_crashed_task_fails_after_max_attempts(tasks):
+    start_task(tasks, 'worker-1', 'task-1')
+    tasks.hset(get_task_key('task-1'), 'attempts', ASYNC_TASK_MAX_ATTEMPTS)
+    worker.requeue_orphaned_tasks()
+    assert get_list(tasks, get_queue_key('normal')) == []
+    record = read_task_record('task-1')
+    assert record['state'] == 'Completed'
+    assert int(record['status']) == 500
+    assert 'interrupted' in json.loads(record['return_value'])['message']
+    assert tasks.hget(TASK_RUNNING_KEY, CUSTOMER) is None
+
+
+def test_run_job_counts_attempts_and_stores_result(tasks, monkeypatch):
+    monkeypatch.setitem(task_functions, 'test_function',
+                        lambda: jsonify({"message": "done"}))
+    start_task(tasks, 'worker-1', 'task-1')
+    worker.run_job('task-1')
+    record = read_task_record('task-1')
+    assert int(record['attempts']) == 2
+    assert record['state'] == 'Completed'
+    assert int(record['status']) == 200
+
+
+def test_run_job_fails_unknown_function(tasks):
+    queue_task('task-1', function_name='missing_function')
+    worker.run_job('task-1')
+    record = read_task_record('task-1')
+    assert int(record['status']) == 500
+    assert 'missing_function' in json.loads(record['return_value'])['message']
+
+
+def test_claim_only_the_classes_of_the_worker(tasks):
+    queue_task('task-normal')
+    processing_key = worker.get_processing_key('worker-high')
+    assert worker.pick_queued_task(processing_key, ['high']) is None
+    queue_task('task-high', priority='high')
+    assert tasks.llen(get_wakeup_key('high')) == 1
+    assert worker.pick_queued_task(processing_key, ['high']) == \
+        ('task-high', CUSTOMER)
+
+
+def test_claim_without_customer_limit(tasks, monkeypatch):
+    monkeypatch.setattr(scheduler, 'TASK_CUSTOMER_MAX_RUNNING', None)
+    queue_task('task-1')
+    queue_task('task-2')
+    assert worker.pick_queued_task(worker.get_processing_key('worker-1'))
+    assert worker.pick_queued_task(worker.get_processing_key('worker-2'))
+    assert tasks.hget(TASK_RUNNING_KEY, CUSTOMER) == b'2'
+
+
+def test_claim_with_customer_limit(tasks, monkeypatch):
+    monkeypatch.setattr(scheduler, 'TASK_CUSTOMER_MAX_RUNNING', 1)
+    queue_task('task-1')
+    queue_task('task-2')
+    assert worker.pick_queued_task(worker.get_processing_key('worker-1'))
+    assert worker.pick_queued_task(
+        worker.get_processing_key('worker-2')) is None
+
+
+def test_claim_aged_low_task_before_normal_tasks(tasks):
+    queue_task('task-normal-old', queued_at=time.time() - 30)
+    queue_task('task-low', priority='low',
+               queued_at=time.time() - scheduler.TASK_AGING_SECONDS - 1)
+    queue_task('task-normal')
+    processing_key = worker.get_processing_key('worker-1')
+    assert [worker.pick_queued_task(processing_key)[0]
+            for _ in range(3)] == ['task-low', 'task-normal-old',
+                                   'task-normal']
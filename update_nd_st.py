@@ -5,8 +5,20 @@ import pyodbc
 import requests
 from requests.auth import HTTPBasicAuth
 
+from cancellation import get_stop_reason
 from compare import add_timestamp_to_date
 from config import NDPD_DB_SERVER
+from progress import report_progress
+from setting import REQUEST_TIMEOUT
+
+
+def get_request_error(error):
+    """
+    :param error: requests exception of a timed out or failed api call
+    :return: error code and message of the failure row
+    """
+    print(f"Request failed : {error}")
+    return type(error).__name__, str(error)
 
 
 def db_connection(db_name, username, password):
@@ -89,10 +101,32 @@ def task_actualization(instance, db_name, username, password, ndpd_user,
     '''
     # Code for NDPd API revision
     header_content = {'Content-Type': "application/json"}
-    response = requests.post(url=execute_task_endpoint,
-                             data=json.dumps(post_params),
-                             headers=header_content,
-                             auth=HTTPBasicAuth(ndpd_user, ndpd_password))
+    try:
+        response = requests.post(url=execute_task_endpoint,
+                                 data=json.dumps(post_params),
+                                 headers=header_content,
+                                 auth=HTTPBasicAuth(ndpd_user, ndpd_password),
+                                 timeout=REQUEST_TIMEOUT)
+    except requests.RequestException as error:
+        # the row fails, the other rows of the group are still updated
+        row_data = [data['ndpd-customerName'],
+                    data['ndpd-projectId'],
+                    data['ndpd-smpName'],
+                    data['ndpd-smpId'],
+                    data['ndpd-moduleId'],
+                    data['ndpd-taskName'],
+                    field,
+                    data['st-projectId'],
+                    data['p-number'],
+                    data['st-project-template-id'],
+                    data['st-project-template-name'],
+                    data['st-milestoneName'],
+                    action_name,
+                    action_value,
+                    "",
+                    *get_request_error(error)]
+        failure_data.append(row_data)
+        return success_data, failure_data, warning_data
     if response.status_code != 200:
         row_data = [data['ndpd-customerName'],
                     data['ndpd-projectId'],
@@ -167,11 +201,24 @@ def update_ndpd_side(db_name,
                      forecast_endpoint,
                      actual_endpoint,
                      execute_task_endpoint,
-                     ndpd_update_data):
+                     ndpd_update_data,
+                     task_id=None,
+                     deadline=None):
+    """
+    :param ndpd_update_data: group of ndpd rows, updated in order
+    :param task_id: id of the @async_task task to report progress to
+    :param deadline: time.time() after which no new row is started
+    :return: success_data, failure_data, warning_data, number of rows
+    skipped because the task timed out or was cancelled
+    """
     update_field = ''
     success_data, failure_data, warning_data = [], [], []
     url = ''
-    for data in ndpd_update_data:
+    for position, data in enumerate(ndpd_update_data):
+        if get_stop_reason(task_id, deadline):
+            return (success_data, failure_data, warning_data,
+                    len(ndpd_update_data) - position)
+        counts = len(success_data), len(failure_data), len(warning_data)
         print("checking order------------------")
         print(data['ndpd-smpId'], data['ndpd-taskName'])
         field = data['target-fields']
@@ -223,12 +270,35 @@ def update_ndpd_side(db_name,
             '''
             # Code for NDPd API revision
             header_content = {'Content-Type': "application/json"}
-            response = requests.post(url=url,
-                                     data=json.dumps(post_params),
-                                     headers=header_content,
-                                     auth=HTTPBasicAuth(ndpd_user,
-                                                        ndpd_password))
-            if response.status_code != 200:
+            try:
+                response = requests.post(url=url,
+                                         data=json.dumps(post_params),
+                                         headers=header_content,
+                                         auth=HTTPBasicAuth(ndpd_user,
+                                                            ndpd_password),
+                                         timeout=REQUEST_TIMEOUT)
+            except requests.RequestException as error:
+                response = None
+                row_data = [data['ndpd-customerName'],
+                            data['ndpd-projectId'],
+                            data['ndpd-smpName'],
+                            data['ndpd-smpId'],
+                            data['ndpd-moduleId'],
+                            data['ndpd-taskName'],
+                            field,
+                            data['st-projectId'],
+                            data['p-number'],
+                            data['st-project-template-id'],
+                            data['st-project-template-name'],
+                            data['st-milestoneName'],
+                            "",
+                            "",
+                            target_value,
+                            *get_request_error(error)]
+                failure_data.append(row_data)
+            if response is None:
+                pass
+            elif response.status_code != 200:
                 row_data = [data['ndpd-customerName'],
                             data['ndpd-projectId'],
                             data['ndpd-smpName'],
@@ -288,7 +358,10 @@ def update_ndpd_side(db_name,
                 failure_data.append(row_data)
             else:
                 pass
-    return success_data, failure_data, warning_data
+        report_progress(task_id, 1, len(success_data) - counts[0],
+                        len(failure_data) - counts[1],
+                        len(warning_data) - counts[2])
+    return success_data, failure_data, warning_data, 0
 
 
 def site_tracker_update_api_call(instance,
@@ -301,27 +374,37 @@ def site_tracker_update_api_call(instance,
     try:
         response = requests.patch(url, data=json.dumps(update_data),
                                   headers={"Authorization": "Bearer " + token,
-                                           "Content-Type": "application/json"})
+                                           "Content-Type": "application/json"},
+                                  timeout=REQUEST_TIMEOUT)
         return response
     except Exception as error:
         print(error)
-        raise Exception(error)
+        raise
 
 
 def update_site_tracker_side(token,
                              st_instance,
                              st_instance_version,
-                             site_tracker_data):
+                             site_tracker_data,
+                             task_id=None,
+                             deadline=None):
     """
     :param site_tracker_data: list of st data
     :param st_instance_version: st url
     :param st_instance: 48.0/
     :param token: token
-    :return: success_data, failure_data in the form of list
+    :param task_id: id of the @async_task task to report progress to
+    :param deadline: time.time() after which no new row is started
+    :return: success_data, failure_data in the form of list, number of rows
+    skipped because the task timed out or was cancelled
     """
     success_data, failure_data = [], []
     old_value, target_value = '', ''
-    for data in site_tracker_data:
+    for position, data in enumerate(site_tracker_data):
+        if get_stop_reason(task_id, deadline):
+            return (success_data, failure_data,
+                    len(site_tracker_data) - position)
+        counts = len(success_data), len(failure_data)
         url = "sobjects/strk__Activity__c/"+str(data['st-milestoneId'])
         update_data = {}
         field = data['target-fields']
@@ -333,10 +416,30 @@ def update_site_tracker_side(token,
             update_data = {"strk__ActualDate__c": data['ndpd-actualEndTime']}
             target_value = data['ndpd-actualEndTime']
             old_value = data['st-actualEndTime']
-        response = site_tracker_update_api_call(st_instance,
-                                                st_instance_version,
-                                                url, update_data, token)
-        if response.status_code == 204 or response.status_code == "204":
+        try:
+            response = site_tracker_update_api_call(st_instance,
+                                                    st_instance_version,
+                                                    url, update_data, token)
+        except requests.RequestException as error:
+            # the row fails, the other rows of the group are still updated
+            response = None
+            row_data = [data['ndpd-customerName'],
+                        data['st-projectId'],
+                        data['p-number'],
+                        data['st-project-template-name'],
+                        data['st-milestoneName'],
+                        field,
+                        data['ndpd-projectId'],
+                        data['ndpd-smpName'],
+                        data['ndpd-smpId'],
+                        data['ndpd-moduleId'],
+                        data['ndpd-taskName'],
+                        target_value,
+                        ": ".join(get_request_error(error))]
+            failure_data.append(row_data)
+        if response is None:
+            pass
+        elif response.status_code == 204 or response.status_code == "204":
             row_data = [data['ndpd-customerName'],
                         data['st-projectId'],
                         data['p-number'],
@@ -367,5 +470,7 @@ def update_site_tracker_side(token,
                         target_value,
                         json.loads(response.text)[0]['message']]
             failure_data.append(row_data)
+        report_progress(task_id, 1, len(success_data) - counts[0],
+                        len(failure_data) - counts[1])
 
-    return success_data, failure_data
+    return success_data, failure_data, 0
@@ -1,5 +1,7 @@
 import multiprocessing
 import os
+import time
+import uuid
 from datetime import datetime, timedelta
 import json
 from functools import partial
@@ -15,7 +17,13 @@ from constants import (ndpd_success_header, ndpd_failure_header,
                        st_success_header, st_warning_header)
 from xml.etree.ElementTree import Element, SubElement, Comment, tostring
 from xml.etree import ElementTree
+from date_utils import parse_ndpd_time, parse_st_date
+from setting import TASK_STOP_GRACE
+from cancellation import cancel_run, is_run_cancelled
+import executor
 
+# groups bigger than this many times the average are scheduled one by one
+GROUP_SKEW_THRESHOLD = 2
 
 
 def get_time_execution(start_time, end_time):
@@ -113,34 +121,27 @@ def get_task_details_async(
 
 
 #def get_mapped_data_list(session, mappings, ibus_obj, logger, **kwargs):
-def get_mapped_data_list(user, password, mappings, ibus_obj, logger, **kwargs):
+def get_mapped_data_list(user, password, mappings, ibus_obj, logger,
+                         backend=executor.THREAD, **kwargs):
     """
     :param ibus_obj: ibus obj
     :param logger: logger
     :param session: session object
     :param mappings: list of mappings received from input
+    :param backend: executor backend the api calls run on
     :return: formatted data as per requirement
     """
-    # Using multiprocessing pool method, async calling rest api
+    # Using the shared executor pool, async calling rest api
     ndpd_instance = kwargs.get('SF_INSTANCE_NAME')
     ndpd_url = kwargs.get('url')
     get_task_details = kwargs.get('end_point')
     ibus_obj.logInfo("NumberOfAPICallsForGetTaskDetails: {}".format(len(mappings)))
     ibus_obj.logInfo("Start multiprocessing")
-    results = []
-    if mappings:
-        pool = multiprocessing.Pool()
-        func = partial(get_task_details_async, ndpd_instance, ndpd_url,
-                       get_task_details, user, password)
-                       #get_task_details, session)
-        outputs_async = pool.map_async(func, mappings)
-        results = outputs_async.get()
-        # ibus_obj.logInfo("Multiprocessing result {}".format(results))
-        ibus_obj.logInfo("Pool is closing")
-        pool.close()
-        ibus_obj.logInfo("Pool is joining")
-        pool.join()
-
+    func = partial(get_task_details_async, ndpd_instance, ndpd_url,
+                   get_task_details, user, password)
+                   #get_task_details, session)
+    results = executor.map_items(backend, func, mappings)
+    # ibus_obj.logInfo("Multiprocessing result {}".format(results))
     return results
 
 
@@ -469,7 +470,7 @@ def get_smp_filtered_data(
 def get_proper_format(target_value, logger):
     target_date = ''
     try:
-        target_date = datetime.strptime(target_value, '%Y-%m-%d')
+        target_date = parse_st_date(target_value)
     except Exception as error:
         logger.error(error)
     if target_date:
@@ -481,7 +482,7 @@ def get_proper_format(target_value, logger):
 def get_site_tracker_proper_date_format(target_value, logger):
     target_date = ''
     try:
-        target_date = datetime.strptime(target_value, '%Y-%m-%d %H:%M:%S.%f')
+        target_date = parse_ndpd_time(target_value)
     except Exception as error:
         logger.error(error)
     if target_date:
@@ -504,16 +505,17 @@ def get_site_tracker_proper_date_format(target_value, logger):
 
 def update_ndpd_fields(customer, ndpd, site_tracker, fields, ibus_obj, logger, task_type, **kwargs):
     success_data, failure_data, warning_data = [], [], []
-    ibus_obj.logInfo("Fields received {}".format(fields))
-    logger.info("Fields received {}".format(fields))
+    ibus_obj.logInfo("Fields received %s", fields)
+    logger.info("Fields received %s", fields)
     for field in fields:
-        ibus_obj.logInfo("processing the field {}".format(field))
-        logger.info("processing the field {}".format(field))
+        ibus_obj.logInfo("processing the field %s", field)
+        logger.info("processing the field %s", field)
         ndpd_date = get_site_tracker_proper_date_format(ndpd[field], logger)
         if ndpd_date == site_tracker[field]:
-            ibus_obj.logInfo(f"ndpd data {ndpd_date} st data {site_tracker[field]}")
-            ibus_obj.logInfo("No Changes detected in the field {}, "
-                             "so skipping update".format(field))
+            ibus_obj.logInfo("ndpd data %s st data %s", ndpd_date,
+                             site_tracker[field])
+            ibus_obj.logInfo("No Changes detected in the field %s, "
+                             "so skipping update", field)
             logger.info("No Changes detected in the field {}, "
                         "so skipping update".format(field))
             pass
@@ -557,10 +559,9 @@ def update_individual_ndpd_field(
         else:
             ibus_obj.logInfo("Actual date is present, so not "
                              "trying to update forecast date")
-            ibus_obj.logInfo(f"actual date is {ndpd['actualEndTime']}")
-            ibus_obj.logInfo(
-                f"{ndpd['ndpd-smpId']}, {ndpd['ndpd-moduleId']}, "
-                f"{ndpd['ndpd-taskName']}")
+            ibus_obj.logInfo("actual date is %s", ndpd['actualEndTime'])
+            ibus_obj.logInfo("%s, %s, %s", ndpd['ndpd-smpId'],
+                             ndpd['ndpd-moduleId'], ndpd['ndpd-taskName'])
             return success_data, failure_data, warning_data
     if field == "actualStartTime" or field == "actualEndTime":
         url = API_URL + ACTUAL_ENDPOINT
@@ -570,8 +571,8 @@ def update_individual_ndpd_field(
     if task_type == "Task" and actual_field == "actualEndTime":
         return success_data, failure_data, warning_data
     if not target_value or target_value == "" or target_value == "null":
-        ibus_obj.logInfo(f"target value is null or "
-                         f"empty so skipping -- {actual_field}")
+        ibus_obj.logInfo("target value is null or "
+                         "empty so skipping -- %s", actual_field)
         # ignoring if field is empty or null
         # ibus_obj.logInfo("Empty date received".format(target_value))
         # row_data = [customer,
@@ -590,7 +591,7 @@ def update_individual_ndpd_field(
         return success_data, failure_data, warning_data
     proper_target_value = get_proper_format(target_value, logger)
     if proper_target_value:
-        ibus_obj.logInfo("calling API {}".format(url))
+        ibus_obj.logInfo("calling API %s", url)
         post_params = {
             "sfInstanceName": SF_INSTANCE_NAME,
             "projectId": ndpd['ndpd-projectId'],
@@ -599,8 +600,7 @@ def update_individual_ndpd_field(
             "taskName": ndpd['ndpd-taskName'],
             field: proper_target_value
         }
-        ibus_obj.logInfo("post parameters to API {}".format(post_params))
-        ibus_obj.logInfo("Order ---{}".format(post_params))
+        ibus_obj.logDebug("post parameters to API %s", post_params)
         '''
         response = session.post(url=url,
                                 data=json.dumps(post_params),
@@ -613,7 +613,7 @@ def update_individual_ndpd_field(
                                  headers=header_content,
                                  auth=HTTPBasicAuth("CommonApiUser",
                                                     "Sf121Inn0@P!"))
-        ibus_obj.logInfo("response from API {}".format(response))
+        ibus_obj.logInfo("response from API %s", response)
         logger.info("Response from API {}".format(
             json.loads(response.text)))
         # Removing ST_INSTANCE_NAME for report because we don't have api to get SITE Names
@@ -841,18 +841,18 @@ def get_st_filtered_projects_dict(token,
     st_instance_version = instance_version
     st_url = api_url
     st_token = token
-    ibus_obj.logInfo("Preparing url...")
+    ibus_obj.logDebug("Preparing url...")
     url = st_instance + "/services/data/" + st_instance_version + st_url
-    ibus_obj.logInfo("url --> {0}".format(url))
-    ibus_obj.logInfo("Sending response to SiteTracker...")
+    ibus_obj.logInfo("url --> %s", url)
+    ibus_obj.logDebug("Sending response to SiteTracker...")
     logger.info("Sending response to SiteTracker...")
     response_of_api = requests.get(url, headers={
         "Authorization": "Bearer " + st_token})
-    ibus_obj.logInfo("Response received...")
+    ibus_obj.logDebug("Response received...")
     logger.info("Response received...")
     try:
         logger.info("Preparing json from response...")
-        ibus_obj.logInfo("Preparing json from response...")
+        ibus_obj.logDebug("Preparing json from response...")
         # ibus_obj.logInfo(response_of_api.json())
         if response_of_api.json()['totalSize'] != 0:
             for each in response_of_api.json()['records']:
@@ -891,13 +891,13 @@ def site_tracker_update_api_call(instance,
     st_instance_version = instance_version
     st_url = api_url
     st_token = token_value
-    ibus_obj.logInfo("Preparing url...")
+    ibus_obj.logDebug("Preparing url...")
     # /services/data/v48.0/sobjects/strk__Activity__c/a0222000002fzGIAAY
     url = st_instance + "/services/data/" + st_instance_version + st_url
-    ibus_obj.logInfo("url --> {0}".format(url))
-    logger.info("url --> {0}".format(url))
-    ibus_obj.logInfo("Sending response to SiteTracker...")
-    ibus_obj.logInfo("Data we are trying to update {}".format(json.dumps(update_data)))
+    ibus_obj.logInfo("url --> %s", url)
+    logger.info("url --> %s", url)
+    ibus_obj.logDebug("Sending response to SiteTracker...")
+    ibus_obj.logDebug("Data we are trying to update %s", update_data)
     logger.info("Sending response to SiteTracker...")
     try:
         # response_of_api = requests.post(url, headers={
@@ -931,15 +931,16 @@ def update_siteTracker_fields(token, customer, ndpd, site_tracker, fields,
     """
     success_data, failure_data = [], []
     for field in fields:
-        ibus_obj.logInfo("processing the field {}".format(field))
-        ibus_obj.logInfo(f"NDPD Date ---{ndpd[field]}")
-        ibus_obj.logInfo(f"ST Date ---{site_tracker[field]}")
+        ibus_obj.logInfo("processing the field %s", field)
+        ibus_obj.logDebug("NDPD Date ---%s", ndpd[field])
+        ibus_obj.logDebug("ST Date ---%s", site_tracker[field])
         ndpd_date = get_site_tracker_proper_date_format(ndpd[field], logger)
-        ibus_obj.logInfo(f"formatted NDPD Date ---{ndpd[field]}")
+        ibus_obj.logDebug("formatted NDPD Date ---%s", ndpd_date)
         if ndpd_date == site_tracker[field]:
-            ibus_obj.logInfo(f"ndpd data {ndpd_date} st data {site_tracker[field]}")
-            ibus_obj.logInfo("No Changes detected in the field {}, "
-                             "so skipping update".format(field))
+            ibus_obj.logInfo("ndpd data %s st data %s", ndpd_date,
+                             site_tracker[field])
+            ibus_obj.logInfo("No Changes detected in the field %s, "
+                             "so skipping update", field)
             pass
         else:
             success_data, failure_data = \
@@ -970,7 +971,7 @@ def update_individual_sitetracker_field(token, customer, site_tracker, field,
     update_data = {}
     if not target_value or target_value == "" or target_value == "null":
         # ignoring if target field value is empty or null
-        ibus_obj.logInfo("Empty value recieved so skipping : {}".format(target_value))
+        ibus_obj.logInfo("Empty value recieved so skipping : %s", target_value)
         return success_data, failure_data
     proper_value = get_site_tracker_proper_date_format(target_value, logger)
     if proper_value:
@@ -981,11 +982,11 @@ def update_individual_sitetracker_field(token, customer, site_tracker, field,
                 update_data = {"strk__Forecast_Date__c": proper_value}
             else:
                 ibus_obj.logInfo("SKipping because actual date is present")
-                ibus_obj.logInfo(
-                    f"actual end time is  = {site_tracker['actualEndTime']}")
-                ibus_obj.logInfo(
-                    f" milestone name = {site_tracker['st-milestoneName']}, "
-                    f"project id = {site_tracker['st-projectId']}")
+                ibus_obj.logInfo("actual end time is  = %s",
+                                 site_tracker['actualEndTime'])
+                ibus_obj.logInfo(" milestone name = %s, project id = %s",
+                                 site_tracker['st-milestoneName'],
+                                 site_tracker['st-projectId'])
                 return success_data, failure_data
         if field == "actualEndTime":
             update_data = {"strk__ActualDate__c": proper_value}
@@ -993,10 +994,10 @@ def update_individual_sitetracker_field(token, customer, site_tracker, field,
         response, updated = site_tracker_update_api_call(st_instance,
                                     st_instance_version, url, update_data, token,
                                             ibus_obj, logger)
-        ibus_obj.logInfo(
+        ibus_obj.logDebug(
             "Site tracker api call function called successful...")
         logger.info("function called successful...")
-        ibus_obj.logInfo("Order ---{}".format(site_tracker['st-milestoneName']))
+        ibus_obj.logDebug("Order ---%s", site_tracker['st-milestoneName'])
         # ibus_obj.logInfo("Response from "
         #                  "API {}".format(json.loads(response.text)))
         if not updated:
@@ -1777,3 +1778,145 @@ def get_site_tracker(map_data, st_data):
     if st_list:
         return st_list[0]
     return {}
+
+
+def get_ndpd_key(data):
+    """
+    :param data: mapping json or ndpd values
+    :return: key used to match ndpd values with a mapping
+    """
+    return (data['ndpd-projectId'], data['ndpd-smpId'],
+            data['ndpd-moduleId'], str(data['ndpd-taskName']).lower())
+
+
+def get_site_tracker_key(data):
+    """
+    :param data: mapping json or site tracker details
+    :return: key used to match site tracker details with a mapping
+    """
+    return data['st-projectId'], data['st-milestoneName']
+
+
+def build_index(data_list, key_func):
+    """
+    Builds a keyed lookup for get_ndpd / get_site_tracker style matching, so
+    every mapping is resolved with one dict lookup instead of a full scan
+    :param data_list: ndpd values or site tracker details
+    :param key_func: get_ndpd_key or get_site_tracker_key
+    :return: index = {key: first matching dict},
+    duplicates = {key: number of dicts having that key}
+    """
+    index = {}
+    duplicates = {}
+    for data in data_list:
+        if not data:
+            continue
+        key = key_func(data)
+        if key in index:
+            # first match wins, same as get_ndpd and get_site_tracker
+            duplicates[key] = duplicates.get(key, 1) + 1
+        else:
+            index[key] = data
+    return index, duplicates
+
+
+def group_update_data(update_data, key):
+    """
+    Groups update records in one pass, groups are in the order their first
+    record is seen and records keep their order inside the group
+    :param update_data: final ndpd or st update data
+    :param key: 'ndpd-smpId' or 'st-projectId'
+    :return: list of groups, each group is a list of update records
+    """
+    groups = {}
+    for data in update_data:
+        groups.setdefault(data[key], []).append(data)
+    return list(groups.values())
+
+
+def get_group_stats(groups):
+    """
+    :param groups: list of groups from group_update_data
+    :return: {"count": number of groups, "rows": number of records,
+    "maxSize": records in the biggest group,
+    "skew": maxSize / average group size}
+    """
+    sizes = [len(group) for group in groups]
+    rows = sum(sizes)
+    max_size = max(sizes, default=0)
+    skew = round(max_size * len(sizes) / rows, 2) if rows else 0
+    return {"count": len(sizes), "rows": rows, "maxSize": max_size,
+            "skew": skew}
+
+
+def get_pool_chunksize(group_stats, processes=None):
+    """
+    Chunk size for pool.map_async over the groups. When one group is much
+    bigger than the average the groups are handed out one by one, so the big
+    group does not hold back a whole chunk of smaller ones, otherwise the
+    same chunk size as multiprocessing's default is used
+    :param group_stats: stats from get_group_stats
+    :param processes: pool size, size of the shared thread pool by default
+    :return: chunksize
+    """
+    processes = processes or executor.get_pool_size(executor.THREAD)
+    if group_stats['skew'] > GROUP_SKEW_THRESHOLD:
+        return 1
+    chunksize, extra = divmod(group_stats['count'], processes * 4)
+    if extra:
+        chunksize += 1
+    return max(chunksize, 1)
+
+
+def call_with_index(func, run_id, indexed_group):
+    """
+    Runs in the pool worker, keeps the group index with the result
+    :param run_id: cancel flag of the map_until_deadline call
+    :return: index, result, None or index, None, error message if func
+    raised, index, None, None if the run was cancelled before the group
+    started
+    """
+    index, group = indexed_group
+    if is_run_cancelled(run_id):
+        return index, None, None
+    try:
+        return index, func(group), None
+    except Exception as error:
+        return index, None, f"{type(error).__name__}: {error}"
+
+
+def map_until_deadline(pool, func, groups, chunksize, deadline):
+    """
+    Like pool.map_async(func, groups, chunksize).get(), but stops waiting
+    TASK_STOP_GRACE seconds after the deadline, when the workers should have
+    stopped taking rows. The pool is shared, it is not terminated, the run
+    is cancelled instead when the wait stops early, its groups still queued
+    return without running
+    :param deadline: time.time() of the deadline, None to wait for all
+    :return: results in group order, None for the groups which did not
+    finish or raised, {group index: error message} of the groups which
+    raised, the other groups still run
+    """
+    results = [None] * len(groups)
+    errors = {}
+    run_id = uuid.uuid4().hex
+    iterator = pool.imap_unordered(partial(call_with_index, func, run_id),
+                                   enumerate(groups), chunksize)
+    finished = 0
+    try:
+        for _ in range(len(groups)):
+            timeout = None if deadline is None else \
+                max(deadline + TASK_STOP_GRACE - time.time(), 0)
+            index, result, error = iterator.next(timeout)
+            finished += 1
+            if error is None:
+                results[index] = result
+            else:
+                errors[index] = error
+    except multiprocessing.TimeoutError:
+        pass
+    finally:
+        if finished < len(groups):
+            # timed out or the wait raised
+            cancel_run(run_id)
+    return results, errors
@@ -0,0 +1,172 @@
+"""
+Worker process for ASYNC_TASK_MODE = 'queue'. The Flask endpoints only push
+their tasks to the list of their priority class, every worker process pulls
+one task at a time, by priority and customer limit (see scheduler.py), runs
+the @async_task function with the original request and stores the response
+in the task record for /OperationStatus.
+
+A task being run is kept in the processing list of its worker. When a worker
+stops sending its heartbeat, the tasks left in its processing list are queued
+again, up to ASYNC_TASK_MAX_ATTEMPTS runs per task.
+
+A worker started with --priority only runs the tasks of those classes, a
+worker with --priority high keeps capacity for the short stages while the
+others run update stages.
+
+usage: python worker.py [--worker-id ID] [--priority CLASS ...], start as
+many as needed
+"""
+import argparse
+import json
+import os
+import socket
+import threading
+import time
+
+from wsgi import application
+from async_execution import (get_job_environ, get_task_key, run_task,
+                             store_task_result, task_functions,
+                             write_task_record)
+from scheduler import (finish_queued_task, get_queue_key, get_wakeup_key,
+                       notify_workers, pick_queued_task)
+from setting import (ASYNC_TASK_MAX_ATTEMPTS, TASK_DEFAULT_PRIORITY,
+                     TASK_PRIORITY_CLASSES, TASK_PROCESSING_KEY_PREFIX, TASK_WAKEUP_KEY, TASKS,
+                     WORKER_HEARTBEAT_KEY_PREFIX, WORKER_HEARTBEAT_TTL)
+
+
+def get_processing_key(worker_id):
+    return TASK_PROCESSING_KEY_PREFIX + worker_id
+
+
+def get_heartbeat_key(worker_id):
+    return WORKER_HEARTBEAT_KEY_PREFIX + worker_id
+
+
+def as_text(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def send_heartbeats(worker_id, stop_event):
+    """Keeps the heartbeat key of the worker alive, also while a task runs"""
+    while not stop_event.is_set():
+        TASKS.set(get_heartbeat_key(worker_id), time.time(),
+                  ex=WORKER_HEARTBEAT_TTL)
+        stop_event.wait(WORKER_HEARTBEAT_TTL / 3)
+
+
+def fail_task(task_id, message):
+    """Completes the task with a 500 response"""
+    store_task_result(task_id, {
+        'state': 'Completed',
+        'return_value': json.dumps({"message": message}),
+        'status': 500
+    })
+
+
+def requeue_tasks(processing_key):
+    """
+    Moves the tasks of a stopped worker back to the queue, they are picked
+    before the tasks which are waiting already
+    """
+    while True:
+        task_id = TASKS.rpop(processing_key)
+        if task_id is None:
+            return
+        task_id = as_text(task_id)
+        task_key = get_task_key(task_id)
+        state, attempts, priority, customer = TASKS.hmget(
+            task_key, 'state', 'attempts', 'priority', 'customer')
+        if state is None:
+            continue
+        # the task no longer runs for its customer
+        finish_queued_task(as_text(customer))
+        attempts = int(attempts or 0)
+        if attempts >= ASYNC_TASK_MAX_ATTEMPTS:
+            print(f"Task {task_id} was interrupted {attempts} times, "
+                  f"failing it")
+            fail_task(task_id, "Task was interrupted, worker stopped")
+            continue
+        print(f"Queuing task {task_id} again from {processing_key}")
+        priority = as_text(priority) or TASK_DEFAULT_PRIORITY
+        pipeline = TASKS.pipeline()
+        write_task_record(task_id, {'state': 'Queued'}, pipeline)
+        pipeline.rpush(get_queue_key(priority), task_id)
+        notify_workers(pipeline, priority)
+        pipeline.execute()
+
+
+def requeue_orphaned_tasks():
+    """Queues again the tasks of the workers without heartbeat"""
+    for processing_key in TASKS.scan_iter(TASK_PROCESSING_KEY_PREFIX + '*'):
+        processing_key = as_text(processing_key)
+        worker_id = processing_key[len(TASK_PROCESSING_KEY_PREFIX):]
+        if not TASKS.exists(get_heartbeat_key(worker_id)):
+            requeue_tasks(processing_key)
+
+
+def run_job(task_id):
+    """Runs the queued task with the request stored in its record"""
+    task = TASKS.hmget(get_task_key(task_id), 'job', 'queued_at')
+    if task[0] is None:
+        print(f"Task {task_id} has no job, skipping")
+        return
+    job = json.loads(task[0])
+    wrapped_function = task_functions.get(job['function'])
+    if wrapped_function is None:
+        fail_task(task_id, f"Unknown task function {job['function']}")
+        return
+    TASKS.hincrby(get_task_key(task_id), 'attempts', 1)
+    run_task(application, get_job_environ(job), task_id, float(task[1]),
+             wrapped_function, **job['kwargs'])
+
+
+def run_worker(worker_id, priorities=TASK_PRIORITY_CLASSES):
+    """:param priorities: classes the worker runs, all by default"""
+    processing_key = get_processing_key(worker_id)
+    if list(priorities) == TASK_PRIORITY_CLASSES:
+        wakeup_keys = [TASK_WAKEUP_KEY]
+    else:
+        wakeup_keys = [get_wakeup_key(priority) for priority in priorities]
+    # tasks left by an earlier run of a worker with the same id
+    requeue_tasks(processing_key)
+    stop_event = threading.Event()
+    threading.Thread(target=send_heartbeats, args=(worker_id, stop_event),
+                     daemon=True).start()
+    print(f"Worker {worker_id} waiting for tasks on "
+          f"{', '.join(get_queue_key(priority) for priority in priorities)}")
+    try:
+        while True:
+            requeue_orphaned_tasks()
+            task = pick_queued_task(processing_key, priorities)
+            if task is None:
+                # woken up when a task is queued or a customer's task ends
+                TASKS.brpop(wakeup_keys, timeout=WORKER_HEARTBEAT_TTL)
+                continue
+            task_id, customer = task
+            try:
+                run_job(task_id)
+            except Exception as e:
+                print(f"Exception in task {task_id} : {e}")
+            finally:
+                TASKS.lrem(processing_key, 1, task_id)
+                finish_queued_task(customer)
+    finally:
+        stop_event.set()
+        TASKS.delete(get_heartbeat_key(worker_id))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs queued @async_task "
+                                                 "tasks")
+    parser.add_argument('--worker-id',
+                        default=f"{socket.gethostname()}-{os.getpid()}",
+                        help="processing list name, reuse it on restart to "
+                             "pick up the tasks left by the same worker")
+    parser.add_argument('--priority', action='append',
+                        choices=TASK_PRIORITY_CLASSES,
+                        help="class of the tasks to run, repeat for more "
+                             "classes, all classes by default")
+    args = parser.parse_args()
+    run_worker(args.worker_id,
+               [priority for priority in TASK_PRIORITY_CLASSES
+                if priority in (args.priority or TASK_PRIORITY_CLASSES)])
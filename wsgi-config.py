@@ -1 +1,6 @@
 workers = 3
+# every request has a thread instead of the whole worker process, a long
+# polling /OperationStatus (see OPERATION_STATUS_MAX_WAITERS in setting.py)
+# does not block the other requests of the worker
+worker_class = 'gthread'
+threads = 8